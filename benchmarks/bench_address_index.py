@@ -0,0 +1,32 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Micro-benchmark of the address suggestions served from the local prefix index.
+
+Builds an AddressIndex with a number of generated street addresses (about as many as the
+gazetteer of the city has entries) and measures the time per prefix search.
+
+Usage: python benchmarks/bench_address_index.py [number_of_entries]
+"""
+
+import sys
+import timeit
+
+from leopard_lavatory.utils.address_index import AddressIndex
+
+
+def main(num_entries=200000):
+    start = timeit.default_timer()
+    index = AddressIndex(('street', f'Gata {number}') for number in range(num_entries))
+    build_s = timeit.default_timer() - start
+
+    queries = [f'gata {number}' for number in range(1000)]
+    search_s = min(timeit.repeat(lambda: [index.search(query, limit=10) for query in queries],
+                                 number=1, repeat=5))
+    print(f'{num_entries} entries, index built in {build_s:.2f} s, '
+          f'{search_s / len(queries) * 1000:.3f} ms per search')
+
+
+if __name__ == '__main__':
+    main(*(int(arg) for arg in sys.argv[1:]))
@@ -0,0 +1,69 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Micro-benchmark of the case grid parser of SBKReader.
+
+Compares the lxml based parse_case_grid to the previous BeautifulSoup implementation on saved
+result pages and makes sure both return the same cases.
+
+Usage: python benchmarks/bench_parse_page.py [saved_page.html ...]
+"""
+
+import glob
+import os
+import sys
+import timeit
+
+from bs4 import BeautifulSoup
+
+from leopard_lavatory.readers.sthlm_sbk import parse_case_grid, parse_html
+
+FIXTURES = os.path.join(os.path.dirname(__file__), '..', 'tests', 'readers', 'fixtures')
+
+
+def parse_case_grid_soup(content):
+    """The previous implementation of SBKReader.parse_page, including the soup creation."""
+    page = BeautifulSoup(content, 'lxml')
+    cases = []
+    for row in page.find_all('tr'):
+        cells = row.find_all('td')
+        if len(cells) == 5 and cells[0].get('class') == ['DataGridItemCell']:
+            cases.append({'id': cells[0].find_all('a')[0].string,
+                          'fastighet': cells[1].string.strip(),
+                          'type': cells[2].string.strip(),
+                          'description': cells[3].string.strip(),
+                          'date': cells[4].string.strip()})
+    return cases
+
+
+def parse_case_grid_lxml(content):
+    """The current implementation, including the parsing of the page."""
+    return parse_case_grid(parse_html(content))
+
+
+def bench(function, content, number):
+    """Return the best time per call in milliseconds."""
+    return min(timeit.repeat(lambda: function(content), number=number, repeat=5)) / number * 1000
+
+
+def main(paths):
+    paths = paths or sorted(glob.glob(os.path.join(FIXTURES, 'sbk_*.html')))
+    print(f'{"page":40} {"KiB":>6} {"cases":>5} {"soup ms":>8} {"lxml ms":>8} {"speedup":>7}')
+    for path in paths:
+        with open(path, 'rb') as file:
+            content = file.read()
+
+        cases = parse_case_grid_lxml(content)
+        # the lxml parser returns Case records, the soup parser dicts
+        assert [case._asdict() for case in cases] == parse_case_grid_soup(content), \
+            f'different results for {path}'
+
+        soup_ms = bench(parse_case_grid_soup, content, 20)
+        lxml_ms = bench(parse_case_grid_lxml, content, 20)
+        print(f'{os.path.basename(path):40} {len(content) / 1024:6.0f} {len(cases):5} '
+              f'{soup_ms:8.2f} {lxml_ms:8.2f} {soup_ms / lxml_ms:6.1f}x')
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
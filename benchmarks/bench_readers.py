@@ -0,0 +1,132 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Offline benchmark suite for the readers.
+
+Replays recorded responses (see leopard_lavatory.readers.cassette) to SBKReader.get_cases and
+SthlmStreetsProperties.get_suggestion_list and reports pages per second, parse time per page and
+peak memory, so that the numbers of different releases can be compared.
+
+Usage:
+    python benchmarks/bench_readers.py [--repeat N] [--json results.json]
+    python benchmarks/bench_readers.py --record   # record new cassettes from the live sites
+"""
+
+import argparse
+import json
+import logging
+import os
+import time
+import tracemalloc
+
+from leopard_lavatory.readers.sthlm_sbk import SBKReader
+from leopard_lavatory.readers.sthlm_streets_properties import SthlmStreetsProperties
+
+CASSETTES = os.path.join(os.path.dirname(__file__), 'cassettes')
+SBK_ADDRESS = 'Brunnsgatan 1'
+SUGGESTION_PREFIX = 'B'
+SUGGESTION_MAX_ROWS = 1000
+
+
+def timed(function, timings):
+    """Wrap a function to append the duration of every call to `timings`."""
+    def wrapper(*args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return function(*args, **kwargs)
+        finally:
+            timings.append(time.perf_counter() - start)
+    return wrapper
+
+
+def run_sbk_get_cases(cassette, record):
+    """Run SBKReader.get_cases once and return the number of pages, cases and parse timings."""
+    reader = SBKReader()
+    reader.random_sleep = lambda: None
+    reader.use_cassette(cassette, record=record)
+    parse_timings = []
+    reader.parse_page = timed(reader.parse_page, parse_timings)
+    cases = reader.get_cases(SBK_ADDRESS)
+    return len(parse_timings), len(cases), parse_timings
+
+
+def run_streets_get_suggestion_list(cassette, record):
+    """Run SthlmStreetsProperties.get_suggestion_list once and return the number of pages,
+    results and timings."""
+    reader = SthlmStreetsProperties()
+    reader.random_sleep = lambda: None
+    reader.use_cassette(cassette, record=record)
+    reader.get_first_page()
+    parse_timings = []
+    get_suggestion_list = timed(reader.get_suggestion_list, parse_timings)
+    num_rows, streets, properties = get_suggestion_list(SUGGESTION_PREFIX, SUGGESTION_MAX_ROWS)
+    return 1, len(streets) + len(properties), parse_timings
+
+
+BENCHMARKS = {
+    'sbk_get_cases': run_sbk_get_cases,
+    'streets_get_suggestion_list': run_streets_get_suggestion_list,
+}
+
+
+def bench(name, repeat, record=False):
+    """Run a benchmark `repeat` times and summarize the results.
+    Returns:
+        dict: pages per second, parse milliseconds per page, peak memory in KiB and counts
+    """
+    run = BENCHMARKS[name]
+    cassette = os.path.join(CASSETTES, name)
+    if record:
+        if os.path.isdir(cassette) and os.listdir(cassette):
+            raise SystemExit(f'Cassette {cassette} is not empty, remove it to record a new one.')
+        return {'recorded': run(cassette, record=True)[0]}
+
+    pages = results = 0
+    parse_timings = []
+    peak_memory = 0
+    start = time.perf_counter()
+    for _ in range(repeat):
+        tracemalloc.start()
+        run_pages, results, run_parse_timings = run(cassette, record=False)
+        peak_memory = max(peak_memory, tracemalloc.get_traced_memory()[1])
+        tracemalloc.stop()
+        pages += run_pages
+        parse_timings.extend(run_parse_timings)
+    duration = time.perf_counter() - start
+
+    return {'pages_per_second': pages / duration,
+            'parse_ms_per_page': sum(parse_timings) / len(parse_timings) * 1000,
+            'peak_memory_kib': peak_memory / 1024,
+            'pages': pages // repeat,
+            'results': results}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--repeat', type=int, default=10, help='runs per benchmark')
+    parser.add_argument('--json', help='write the results to this file as well')
+    parser.add_argument('--record', action='store_true',
+                        help='record new cassettes from the live sites instead of benchmarking')
+    args = parser.parse_args()
+
+    # the readers log every request and case on debug level, which would dominate the timings
+    logging.getLogger().setLevel(logging.WARNING)
+
+    results = {name: bench(name, args.repeat, args.record) for name in BENCHMARKS}
+
+    if not args.record:
+        print(f'{"benchmark":30} {"pages/s":>9} {"parse ms/page":>14} {"peak KiB":>9} '
+              f'{"pages":>6} {"results":>8}')
+        for name, result in results.items():
+            print(f'{name:30} {result["pages_per_second"]:9.1f} '
+                  f'{result["parse_ms_per_page"]:14.2f} {result["peak_memory_kib"]:9.0f} '
+                  f'{result["pages"]:6} {result["results"]:8}')
+
+    if args.json:
+        with open(args.json, 'w') as file:
+            json.dump(results, file, indent=2)
+
+
+if __name__ == '__main__':
+    main()
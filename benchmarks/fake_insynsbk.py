@@ -0,0 +1,192 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Local stand-in for insynsbk.stockholm.se, for load tests.
+
+Imitates the ASP.NET search form and the paginated CaseGrid postbacks of the case search with
+generated cases, with configurable latency and error rate. New cases can be added through
+POST /_admin/cases (form fields: address, optionally fastighet and description), which returns
+the new case as json.
+
+Usage: python benchmarks/fake_insynsbk.py [--port 5050] [--latency 0.2] [--error-rate 0.01]
+Then point the readers at it with SBK_URL=http://localhost:5050/Byggochplantjansten/Arenden/
+"""
+
+import argparse
+import random
+import threading
+import time
+from datetime import date, timedelta
+from html import escape
+
+from flask import Flask, jsonify, request
+
+FIELD_PREFIX = 'ctl00$FullContentRegion$ContentRegion$SecondaryContentRegion$'
+ADDRESS_FIELD = FIELD_PREFIX + 'SearchPropertyAndCase$SearchProperty$AddressInput'
+SEARCH_BUTTON = FIELD_PREFIX + 'SearchPropertyAndCase$SearchButton'
+PAGE_SIZE = 10
+
+PAGE = '''<!DOCTYPE html>
+<html>
+<head><meta http-equiv="Content-Type" content="text/html; charset=utf-8" /><title>
+    Sök ärenden
+</title></head>
+<body>
+<form name="aspnetForm" method="post" action="./" id="aspnetForm">
+<input type="hidden" name="__EVENTTARGET" id="__EVENTTARGET" value="" />
+<input type="hidden" name="__EVENTARGUMENT" id="__EVENTARGUMENT" value="" />
+<input type="hidden" name="__VIEWSTATE" id="__VIEWSTATE" value="{viewstate}" />
+<input type="hidden" name="__EVENTVALIDATION" id="__EVENTVALIDATION" value="{viewstate}" />
+<input name="{address_field}" type="text" value="{address}" />
+<input type="submit" name="{search_button}" value="Sök" />
+<table id="ctl00_FullContentRegion_ContentRegion_SecondaryContentRegion_CaseList_CaseGrid">
+<tr class="DataGridHeader">
+<td>Diarienummer</td><td>Fastighet</td><td>Ärendetyp</td><td>Beskrivning</td><td>Inkom</td>
+</tr>
+{rows}
+</table>
+</form>
+</body>
+</html>
+'''
+
+ROW = '''<tr>
+<td class="DataGridItemCell"><a href="Arende.aspx?id={id}">{id}</a></td>
+<td class="DataGridItemCell">{fastighet}</td>
+<td class="DataGridItemCell">{type}</td>
+<td class="DataGridItemCell">{description}</td>
+<td class="DataGridItemCell">{date}</td>
+</tr>'''
+
+
+class FakeInsynsbk:
+    """Generated cases per address and the search sessions of the clients."""
+
+    def __init__(self, cases_per_address=30, latency=0.0, error_rate=0.0, viewstate_size=20000,
+                 seed=None):
+        self.cases_per_address = cases_per_address
+        self.latency = latency
+        self.error_rate = error_rate
+        self.viewstate_padding = 'x' * viewstate_size
+        self.random = random.Random(seed)
+        self.cases = {}
+        self.sessions = {}
+        self.next_number = 1
+        self.requests = 0
+        self.errors = 0
+        self.lock = threading.Lock()
+
+    def _new_case(self, address, age_days=0, description=None, fastighet=None):
+        case_date = date.today() - timedelta(days=age_days)
+        case = {'id': f'{case_date.year}-{self.next_number:05}',
+                'fastighet': fastighet or f'{address.split()[0].upper()} {len(address) % 9 + 1}',
+                'type': self.random.choice(['Bygglov', 'Rivningslov', 'Marklov', 'Anmälan']),
+                'description': description or 'Ändring av fasad',
+                'date': case_date.isoformat()}
+        self.next_number += 1
+        return case
+
+    def get_cases(self, address):
+        """Return the cases for an address, newest first, generating them on first access."""
+        with self.lock:
+            if address not in self.cases:
+                # one case per week, oldest first so the sequence numbers grow with the dates
+                self.cases[address] = [self._new_case(address, age_days=7 * (number + 1))
+                                       for number in reversed(range(self.cases_per_address))][::-1]
+            return self.cases[address]
+
+    def add_case(self, address, description=None, fastighet=None):
+        """Add a new case (newest) for an address."""
+        self.get_cases(address)
+        with self.lock:
+            case = self._new_case(address, 0, description, fastighet)
+            self.cases[address].insert(0, case)
+            return case
+
+    def render(self, session_id, cases, address):
+        viewstate = f'{session_id}.{self.random.getrandbits(32)}.{self.viewstate_padding}'
+        self.sessions[session_id]['viewstate'] = viewstate
+        rows = '\n'.join(ROW.format(**{key: escape(value) for key, value in case.items()})
+                         for case in cases)
+        return PAGE.format(viewstate=viewstate, address_field=ADDRESS_FIELD,
+                           search_button=SEARCH_BUTTON, address=escape(address or ''), rows=rows)
+
+    def respond(self, session_id, method, form):
+        """Answer a request of a session.
+        Returns:
+            Tuple[int, str]: http status and html
+        """
+        self.requests += 1
+        if self.latency:
+            time.sleep(self.random.uniform(0, 2 * self.latency))
+        if self.random.random() < self.error_rate:
+            self.errors += 1
+            return 503, '<html><head><title>Service Unavailable</title></head></html>'
+
+        if method == 'GET' or session_id not in self.sessions:
+            self.sessions[session_id] = {'address': None, 'page': 0}
+            return 200, self.render(session_id, [], None)
+
+        state = self.sessions[session_id]
+        if form.get('__VIEWSTATE') != state['viewstate']:
+            return 500, '<html><head><title>Validation of viewstate MAC failed</title></head></html>'
+
+        if form.get(SEARCH_BUTTON):
+            state['address'] = form.get(ADDRESS_FIELD, '')
+            state['page'] = 0
+        elif form.get('__EVENTARGUMENT') == 'Page$Next' and state['address'] is not None:
+            num_pages = max(1, -(-len(self.get_cases(state['address'])) // PAGE_SIZE))
+            state['page'] = min(state['page'] + 1, num_pages - 1)
+        elif form.get('__EVENTARGUMENT', '').startswith('Page$') and state['address'] is not None:
+            # like the GridView pager, jump to a page number (counted from 1)
+            num_pages = max(1, -(-len(self.get_cases(state['address'])) // PAGE_SIZE))
+            state['page'] = min(int(form['__EVENTARGUMENT'][5:]) - 1, num_pages - 1)
+
+        cases = self.get_cases(state['address']) if state['address'] is not None else []
+        start = state['page'] * PAGE_SIZE
+        return 200, self.render(session_id, cases[start:start + PAGE_SIZE], state['address'])
+
+
+def create_app(fake):
+    """Create the flask app serving the fake site."""
+    app = Flask(__name__)
+
+    @app.route('/Byggochplantjansten/Arenden/', methods=('GET', 'POST'))
+    def search():
+        session_id = request.cookies.get('ASP.NET_SessionId')
+        if session_id is None or request.method == 'GET':
+            session_id = f'{fake.random.getrandbits(64):x}'
+        status, html = fake.respond(session_id, request.method, request.form)
+        response = app.response_class(html, status=status, content_type='text/html; charset=utf-8')
+        response.set_cookie('ASP.NET_SessionId', session_id)
+        return response
+
+    @app.route('/_admin/cases', methods=('POST',))
+    def add_case():
+        case = fake.add_case(request.form['address'], request.form.get('description'),
+                             request.form.get('fastighet'))
+        return jsonify(case)
+
+    @app.route('/_admin/stats')
+    def stats():
+        return jsonify({'requests': fake.requests, 'errors': fake.errors,
+                        'sessions': len(fake.sessions), 'addresses': len(fake.cases)})
+
+    return app
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Local stand-in for insynsbk.stockholm.se')
+    parser.add_argument('--port', type=int, default=5050)
+    parser.add_argument('--cases-per-address', type=int, default=30)
+    parser.add_argument('--latency', type=float, default=0.0, help='average latency in seconds')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='share of 503 responses')
+    args = parser.parse_args()
+
+    fake = FakeInsynsbk(args.cases_per_address, args.latency, args.error_rate)
+    create_app(fake).run(port=args.port, threaded=True)
+
+
+if __name__ == '__main__':
+    main()
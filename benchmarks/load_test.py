@@ -0,0 +1,219 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+End-to-end load test of the watch pipeline against the local fake insynsbk site.
+
+Seeds a fresh database with many watchjobs, runs the celery pipeline (run_all_watchjobs ->
+check_watchjob, then send_digests) against benchmarks/fake_insynsbk.py and reports the watchjobs
+checked per minute, the latency from adding a new case on the site until it is found for its
+watchjob and until the digest with it is sent to its user, and the time to send the digests. The
+digests go to a connection that records the send time of every message instead of an SMTP server,
+so the notification latency doesn't include the mail server.
+
+By default the tasks run eagerly in this process. With --local thread or --local process, they
+run on the pool of the local executor (see leopard_lavatory.celery.local_executor), which also
+reports the throughput of every cycle. With --celery, the tasks are sent to the broker and run by
+the workers, which have to be started with the same environment (printed at the start); the
+digests are always sent in this process.
+
+Usage: python benchmarks/load_test.py [--watchjobs 2000] [--new-cases 50] [--latency 0.05]
+"""
+
+import argparse
+import json
+import os
+import statistics
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime
+
+from werkzeug.serving import make_server
+
+sys.path.insert(0, os.path.dirname(__file__))
+from fake_insynsbk import FakeInsynsbk, create_app  # noqa: E402
+
+
+def start_fake_site(fake, port):
+    """Serve the fake site in a background thread."""
+    server = make_server('localhost', port, create_app(fake), threaded=True)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    return server
+
+
+class RecordingConnection:
+    """Records when each message is sent over a connection, instead of sending it."""
+
+    def __init__(self):
+        # recipient -> time of the last message to it
+        self.sent_at = {}
+
+    def __call__(self):
+        return self
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        pass
+
+    def send(self, message):
+        self.sent_at[message['To']] = datetime.now()
+
+
+def percentile(values, share):
+    """Return the value at the given share (0..1) of the sorted values."""
+    values = sorted(values)
+    return values[min(len(values) - 1, int(share * len(values)))]
+
+
+def report_latencies(name, latencies, num_cases):
+    """Print the distribution of the latencies (seconds) of the new cases."""
+    if latencies:
+        print(f'{name}: {len(latencies)}/{num_cases}, median {statistics.median(latencies):.1f} s, '
+              f'p95 {percentile(latencies, 0.95):.1f} s, max {max(latencies):.1f} s')
+    else:
+        print(f'{name}: 0/{num_cases}')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='End-to-end load test of the watch pipeline')
+    parser.add_argument('--watchjobs', type=int, default=2000)
+    parser.add_argument('--new-cases', type=int, default=50,
+                        help='number of watchjobs that get a new case before the second cycle')
+    parser.add_argument('--cases-per-address', type=int, default=15)
+    parser.add_argument('--latency', type=float, default=0.0, help='average site latency')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='share of 503 responses')
+    parser.add_argument('--port', type=int, default=5050)
+    parser.add_argument('--celery', action='store_true',
+                        help='run the tasks on the celery workers instead of in this process')
+    parser.add_argument('--local', choices=['thread', 'process'],
+                        help='run the tasks on the pool of the local executor')
+    parser.add_argument('--workers', type=int, default=4, help='pool size of the local executor')
+    parser.add_argument('--timeout', type=float, default=3600, help='max seconds per cycle')
+    args = parser.parse_args()
+
+    # configure the pipeline before it is imported
+    os.environ.setdefault('LEOPARD_DB_URI', 'sqlite:///' + os.path.join(
+        tempfile.mkdtemp(prefix='leopard_load_test_'), 'load_test.sqlite'))
+    os.environ['SBK_URL'] = f'http://localhost:{args.port}/Byggochplantjansten/Arenden/'
+    os.environ.setdefault('RATE_LIMIT_REDIS_URL', 'memory')
+    os.environ.setdefault('RATE_LIMITS', 'localhost=10000:10000')
+    # the digests go to their users (see RecordingConnection)
+    os.environ.pop('FLASK_MAIL_RECIPIENT', None)
+    if args.local:
+        os.environ['LEOPARD_EXECUTION_MODE'] = args.local
+    print('Environment for the workers:')
+    for name in ('LEOPARD_DB_URI', 'SBK_URL', 'RATE_LIMIT_REDIS_URL', 'RATE_LIMITS'):
+        print(f'  {name}={os.environ[name]}')
+
+    import logging
+    logging.getLogger().setLevel(logging.WARNING)
+
+    from leopard_lavatory.celery import local_executor, tasks
+    from leopard_lavatory.storage.database import Watchjob, add_user_watchjob, database_session, \
+        watchjob_case
+
+    connection = RecordingConnection()
+    tasks.smtp_connection = connection
+
+    fake = FakeInsynsbk(args.cases_per_address, args.latency, args.error_rate, seed=1)
+    server = start_fake_site(fake, args.port)
+
+    executor = None
+    if args.local:
+        executor = local_executor.get_executor(args.workers, args.local == 'process')
+    elif not args.celery:
+        tasks.celery.conf.CELERY_ALWAYS_EAGER = True
+
+    def run_all_watchjobs():
+        if executor is None:
+            tasks.run_all_watchjobs.delay()
+        else:
+            print('Local executor: ' + executor.run_cycle('run_all_watchjobs').summary())
+
+    addresses = [f'Testgatan {number}' for number in range(1, args.watchjobs + 1)]
+    emails = {address: f'user{number}@example.com' for number, address in enumerate(addresses)}
+    with database_session() as dbs:
+        for number, address in enumerate(addresses):
+            add_user_watchjob(dbs, emails[address], {'street': address})
+            if number % 500 == 0:
+                dbs.commit()
+    print(f'Seeded {len(addresses)} watchjobs')
+
+    def wait_for(condition):
+        deadline = time.time() + args.timeout
+        while not condition() and time.time() < deadline:
+            time.sleep(0.5)
+
+    def watermarks():
+        with database_session() as dbs:
+            return {watchjob_id: last_case_id for watchjob_id, last_case_id in
+                    dbs.query(Watchjob.id, Watchjob.last_case_id)}
+
+    # first cycle: every watchjob gets all cases of its address
+    start = time.time()
+    run_all_watchjobs()
+    wait_for(lambda: all(watermarks().values()))
+    first_cycle = time.time() - start
+    print(f'Cycle 1 (first crawl): {len(addresses)} watchjobs in {first_cycle:.1f} s, '
+          f'{len(addresses) / first_cycle * 60:.0f} watchjobs/min')
+
+    def digest():
+        start = time.time()
+        # all checks of the cycle are done
+        num_sent = tasks.send_digests(settle_seconds=0)
+        print(f'Digests: {num_sent} sent in {time.time() - start:.1f} s')
+
+    digest()
+
+    # second cycle: some addresses got a new case
+    with database_session() as dbs:
+        watchjob_ids = {json.loads(query)['street']: watchjob_id for watchjob_id, query in
+                        dbs.query(Watchjob.id, Watchjob.query)}
+    added = {}
+    for address in addresses[:args.new_cases]:
+        added[watchjob_ids[address]] = (fake.add_case(address)['id'], datetime.now())
+    # the recipient of the digest with the new case of each watchjob
+    recipients = {watchjob_ids[address]: emails[address] for address in addresses[:args.new_cases]}
+
+    def found_at():
+        # when the new cases were related to their watchjobs
+        with database_session() as dbs:
+            return {watchjob_id: found for watchjob_id, case_id, found in
+                    dbs.query(watchjob_case.c.watchjob_id, watchjob_case.c.case_id,
+                              watchjob_case.c.found_at).
+                    filter(watchjob_case.c.case_id.in_([case_id for case_id, _ in added.values()]))
+                    if added.get(watchjob_id, (None,))[0] == case_id}
+
+    start = time.time()
+    run_all_watchjobs()
+    wait_for(lambda: all(watchjob_id in found_at() for watchjob_id in added))
+    second_cycle = time.time() - start
+
+    found = found_at()
+    latencies = [(found[watchjob_id] - added_at).total_seconds()
+                 for watchjob_id, (_, added_at) in added.items() if watchjob_id in found]
+    print(f'Cycle 2 (incremental): {len(addresses)} watchjobs in {second_cycle:.1f} s, '
+          f'{len(addresses) / second_cycle * 60:.0f} watchjobs/min')
+    report_latencies('New case found', latencies, len(added))
+
+    sent_before = dict(connection.sent_at)
+    digest()
+    sent = {watchjob_id: connection.sent_at[email] for watchjob_id, email in recipients.items()
+            if connection.sent_at.get(email) != sent_before.get(email)}
+    latencies = [(sent[watchjob_id] - added_at).total_seconds()
+                 for watchjob_id, (_, added_at) in added.items() if watchjob_id in sent]
+    report_latencies('New case notified', latencies, len(added))
+    print(f'Fake site: {fake.requests} requests, {fake.errors} errors')
+
+    server.shutdown()
+    if executor is not None:
+        executor.shutdown()
+
+
+if __name__ == '__main__':
+    main()
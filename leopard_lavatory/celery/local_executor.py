@@ -0,0 +1,261 @@
+"""Local execution of the celery tasks, without broker and workers.
+
+For small deployments and benchmark runs on a single machine, the tasks of `tasks` can run on a
+pool of threads or processes of one process instead of the celery workers. Set the environment
+variable LEOPARD_EXECUTION_MODE to "thread" or "process" (then `tasks.dispatch` sends the tasks
+here) and run the executor with its periodic scheduler:
+
+    LEOPARD_EXECUTION_MODE=thread python -m leopard_lavatory.celery.local_executor --workers 4
+
+With a thread pool and RATE_LIMIT_REDIS_URL=memory, nothing but the database is needed. The
+processes of a process pool share the rate limit only through redis.
+
+The tasks are the same task functions as with celery. They run in the pool, and the tasks they
+dispatch are handed back to the executor, which runs them when their countdown is over. A cycle
+is the run of a periodic task and all the tasks dispatched by it, directly or indirectly; its
+throughput is logged when its last task has finished.
+"""
+
+import argparse
+import heapq
+import itertools
+import logging
+import os
+import threading
+import time
+from collections import Counter
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, ThreadPoolExecutor, wait
+
+LOG = logging.getLogger(__name__)
+
+# number of tasks running at the same time
+WORKERS = int(os.environ.get('LEOPARD_LOCAL_WORKERS', '4'))
+
+# the tasks dispatched by the task running in this thread, None outside of a pool worker
+_worker = threading.local()
+# the executor running in this process
+_executor = None
+
+
+def run_task(name, args):
+    """Run a task of `tasks` in a pool worker.
+    Args:
+        name (str): name of the task function
+        args (list): arguments of the task
+    Returns:
+        Tuple[object, list[Tuple[str, list, float]]]: result of the task, and name, arguments and
+          countdown of the tasks it dispatched
+    """
+    from leopard_lavatory.celery import tasks
+
+    _worker.dispatched = []
+    try:
+        return getattr(tasks, name)(*args), _worker.dispatched
+    finally:
+        _worker.dispatched = None
+
+
+def submit(name, args=(), countdown=None):
+    """Run a task locally, see `tasks.dispatch`. Within a pool worker, the task is handed back to
+    the executor with the result of the running task. Without an executor in this process (eg in
+    the web app), the task runs right away.
+    Args:
+        name (str): name of the task function
+        args (Sequence): arguments of the task
+        countdown (float): seconds to wait before the task is run
+    """
+    dispatched = getattr(_worker, 'dispatched', None)
+    if dispatched is not None:
+        dispatched.append((name, list(args), countdown))
+    elif _executor is not None:
+        _executor.submit(name, args, countdown)
+    else:
+        from leopard_lavatory.celery import tasks
+
+        getattr(tasks, name)(*args)
+
+
+class Cycle:
+    """Throughput of a cycle: a periodic task and the tasks dispatched by it."""
+
+    def __init__(self, name):
+        self.name = name
+        self.started_at = time.monotonic()
+        self.finished_at = None
+        # number of finished runs per task, and of the failed ones
+        self.tasks = Counter()
+        self.failures = 0
+        self.new_cases = 0
+        self.pending = 0
+
+    @property
+    def seconds(self):
+        return (self.finished_at or time.monotonic()) - self.started_at
+
+    @property
+    def watchjobs_per_minute(self):
+        return self.tasks['check_watchjob'] / self.seconds * 60 if self.seconds else 0.0
+
+    def summary(self):
+        return '{}: {} watchjobs checked in {:.1f} s ({:.0f} watchjobs/min), {} new cases, {} ' \
+               'tasks, {} failed'.format(self.name, self.tasks['check_watchjob'], self.seconds,
+                                         self.watchjobs_per_minute, self.new_cases,
+                                         sum(self.tasks.values()), self.failures)
+
+
+class LocalExecutor:
+    """Runs the tasks on a pool of threads or processes of this process."""
+
+    def __init__(self, workers=WORKERS, processes=False):
+        """
+        Args:
+            workers (int): size of the pool
+            processes (bool): whether to use processes instead of threads
+        """
+        pool_class = ProcessPoolExecutor if processes else ThreadPoolExecutor
+        self.pool = pool_class(max_workers=workers)
+        # tasks waiting for their countdown: (due, sequence number, name, args, cycle)
+        self._waiting = []
+        self._sequence = itertools.count()
+        self._running = {}
+
+    def submit(self, name, args=(), countdown=None, cycle=None):
+        """Run a task when its countdown is over.
+        Args:
+            name (str): name of the task function
+            args (Sequence): arguments of the task
+            countdown (float): seconds to wait before the task is run
+            cycle (Cycle): cycle the task is part of, None for a new cycle
+        Returns:
+            Cycle: the cycle of the task
+        """
+        if cycle is None:
+            cycle = Cycle(name)
+        cycle.pending += 1
+        heapq.heappush(self._waiting, (time.monotonic() + (countdown or 0), next(self._sequence),
+                                       name, list(args), cycle))
+        return cycle
+
+    def step(self, timeout):
+        """Start the tasks that are due and handle the finished ones.
+        Args:
+            timeout (float): maximum number of seconds to wait for a task to finish
+        """
+        now = time.monotonic()
+        while self._waiting and self._waiting[0][0] <= now:
+            due, sequence, name, args, cycle = heapq.heappop(self._waiting)
+            self._running[self.pool.submit(run_task, name, args)] = (name, cycle)
+        if self._waiting:
+            timeout = min(timeout, self._waiting[0][0] - now)
+        if not self._running:
+            time.sleep(max(0.0, timeout))
+            return
+
+        done, _ = wait(self._running, timeout=max(0.0, timeout), return_when=FIRST_COMPLETED)
+        for future in done:
+            name, cycle = self._running.pop(future)
+            cycle.tasks[name] += 1
+            try:
+                result, dispatched = future.result()
+            except Exception:
+                LOG.exception('Task {} failed'.format(name))
+                cycle.failures += 1
+            else:
+                if name == 'check_watchjob':
+                    cycle.new_cases += result or 0
+                for dispatched_name, dispatched_args, countdown in dispatched:
+                    self.submit(dispatched_name, dispatched_args, countdown, cycle)
+            cycle.pending -= 1
+            if not cycle.pending:
+                cycle.finished_at = time.monotonic()
+                LOG.info('Cycle {}'.format(cycle.summary()))
+
+    def run_until_idle(self):
+        """Run the submitted tasks and the ones they dispatch, until all of them are finished."""
+        while self._waiting or self._running:
+            self.step(1.0)
+
+    def run_cycle(self, name, args=()):
+        """Run a task and the tasks it dispatches.
+        Args:
+            name (str): name of the task function
+            args (Sequence): arguments of the task
+        Returns:
+            Cycle: throughput of the cycle
+        """
+        cycle = self.submit(name, args)
+        self.run_until_idle()
+        return cycle
+
+    def serve_forever(self, periodic_tasks):
+        """Run the periodic tasks according to their schedule, and the tasks they dispatch.
+        Args:
+            periodic_tasks (list[Tuple[str, celery.schedules.crontab, celery.Task]]): name,
+              schedule and task, see `tasks.periodic_tasks`
+        """
+        last_run_at = {name: run_every.now() for name, run_every, task in periodic_tasks}
+        while True:
+            next_check = 60.0
+            for name, run_every, task in periodic_tasks:
+                is_due, next_seconds = run_every.is_due(last_run_at[name])
+                if is_due:
+                    LOG.debug('Running periodic task {}'.format(name))
+                    last_run_at[name] = run_every.now()
+                    self.submit(task.name.rpartition('.')[2])
+                next_check = min(next_check, next_seconds)
+
+            deadline = time.monotonic() + next_check
+            while time.monotonic() < deadline:
+                self.step(deadline - time.monotonic())
+
+    def shutdown(self):
+        self.pool.shutdown(wait=True)
+
+
+def get_executor(workers=WORKERS, processes=False):
+    """Create the executor of this process, which the tasks dispatched outside of its pool are
+    sent to.
+    Args:
+        workers (int): size of the pool
+        processes (bool): whether to use processes instead of threads
+    Returns:
+        LocalExecutor: the executor
+    """
+    global _executor
+    if _executor is None:
+        _executor = LocalExecutor(workers, processes)
+    return _executor
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Run the watch pipeline on a local pool, '
+                                                 'without broker and workers')
+    parser.add_argument('--workers', type=int, default=WORKERS)
+    parser.add_argument('--once', action='store_true',
+                        help='run all watchjobs and send the digests once, instead of following '
+                             'the schedule')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+
+    from leopard_lavatory.celery import tasks
+
+    if tasks.EXECUTION_MODE not in ('thread', 'process'):
+        parser.error('set LEOPARD_EXECUTION_MODE to "thread" or "process"')
+    executor = get_executor(args.workers, tasks.EXECUTION_MODE == 'process')
+    try:
+        if args.once:
+            executor.run_cycle('run_all_watchjobs')
+            # all checks are done, nothing is left to settle
+            executor.run_cycle('send_digests', [0])
+        else:
+            executor.serve_forever(tasks.periodic_tasks())
+    finally:
+        executor.shutdown()
+
+
+if __name__ == '__main__':
+    # with python -m, this module is __main__ and the tasks import it once more; the executor has to
+    #  be the one of the imported module, which the tasks dispatch to
+    from leopard_lavatory.celery import local_executor
+
+    local_executor.main()
@@ -0,0 +1,62 @@
+"""Polling schedule of the watchjobs.
+
+Every watchjob is checked once per its own poll interval, at a stable offset within the interval
+derived from its id, so that the checks are spread evenly instead of all starting at the same
+minute. The interval adapts to how often new cases appear for the watchjob: it is halved when a
+check finds new cases and grows slowly while there are none.
+"""
+
+import os
+import zlib
+from datetime import timedelta
+
+DEFAULT_POLL_INTERVAL = 3600
+MIN_POLL_INTERVAL = int(os.environ.get('LEOPARD_MIN_POLL_INTERVAL', '900'))
+MAX_POLL_INTERVAL = int(os.environ.get('LEOPARD_MAX_POLL_INTERVAL', '86400'))
+# growth of the interval after a check without new cases
+BACKOFF_FACTOR = 1.5
+
+
+def stable_offset(watchjob_id, interval):
+    """Return the offset of a watchjob within its poll interval, which is the same for every run
+    and evenly distributed over the watchjobs.
+    Args:
+        watchjob_id (int): id of the watchjob
+        interval (int): poll interval in seconds
+    Returns:
+        int: offset in seconds, 0 <= offset < interval
+    """
+    return zlib.crc32(str(watchjob_id).encode()) % interval
+
+
+def next_interval(interval, num_new_cases):
+    """Adapt the poll interval of a watchjob to the result of its last check.
+    Args:
+        interval (int): current poll interval in seconds, None for the default
+        num_new_cases (int): number of new cases found by the last check
+    Returns:
+        int: the new poll interval in seconds
+    """
+    interval = interval or DEFAULT_POLL_INTERVAL
+    if num_new_cases:
+        interval = interval / 2
+    else:
+        interval = interval * BACKOFF_FACTOR
+    return int(min(MAX_POLL_INTERVAL, max(MIN_POLL_INTERVAL, interval)))
+
+
+def next_run_at(now, watchjob_id, interval):
+    """Return when a watchjob should be checked next: the first time after `now` at its stable
+    offset within the interval.
+    Args:
+        now (datetime.datetime): the current time
+        watchjob_id (int): id of the watchjob
+        interval (int): poll interval in seconds, None for the default
+    Returns:
+        datetime.datetime: time of the next check
+    """
+    interval = interval or DEFAULT_POLL_INTERVAL
+    offset = stable_offset(watchjob_id, interval)
+    # seconds since the start of the current interval of this watchjob
+    elapsed = (now.timestamp() - offset) % interval
+    return now + timedelta(seconds=interval - elapsed)
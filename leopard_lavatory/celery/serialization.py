@@ -0,0 +1,64 @@
+"""Compact msgpack serializer for the celery messages and results.
+
+Cases are packed as msgpack extension type holding an array of their field values, instead of a
+json object repeating the field names for every case. Registered with kombu on import as
+SERIALIZER_NAME.
+"""
+
+from collections.abc import Mapping
+from datetime import date, datetime
+
+import msgpack
+from kombu.serialization import register
+
+from leopard_lavatory.readers.case import Case
+
+SERIALIZER_NAME = 'leopard_msgpack'
+CONTENT_TYPE = 'application/x-leopard-msgpack'
+
+CASE_EXT_TYPE = 1
+
+
+def _default(obj):
+    """Convert the objects msgpack doesn't pack by itself (with strict types)."""
+    if isinstance(obj, Case):
+        return msgpack.ExtType(CASE_EXT_TYPE, msgpack.packb(list(obj), use_bin_type=True))
+    if isinstance(obj, Mapping):
+        return dict(obj)
+    if isinstance(obj, (tuple, list, set, frozenset)):
+        return list(obj)
+    if isinstance(obj, str):
+        return str(obj)
+    if isinstance(obj, (datetime, date)):
+        return obj.isoformat()
+    raise TypeError(f'Cannot serialize object of type {type(obj).__name__}')
+
+
+def _ext_hook(code, data):
+    if code == CASE_EXT_TYPE:
+        return Case(*msgpack.unpackb(data, raw=False))
+    return msgpack.ExtType(code, data)
+
+
+def dumps(obj):
+    """Serialize an object, eg the arguments of a task, to msgpack.
+    Args:
+        obj: the object, may contain cases
+    Returns:
+        bytes: the packed object
+    """
+    # strict types, so that cases (tuples) reach _default instead of being packed as arrays
+    return msgpack.packb(obj, default=_default, strict_types=True, use_bin_type=True)
+
+
+def loads(data):
+    """Deserialize an object packed with `dumps`.
+    Args:
+        data (bytes): the packed object
+    Returns:
+        the object, with cases as Case and tuples as lists
+    """
+    return msgpack.unpackb(data, ext_hook=_ext_hook, raw=False, strict_map_key=False)
+
+
+register(SERIALIZER_NAME, dumps, loads, content_type=CONTENT_TYPE, content_encoding='binary')
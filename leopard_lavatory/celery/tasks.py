@@ -1,15 +1,36 @@
 import json
 import logging
 import os
+import smtplib
+import time
+import urllib.parse
+import uuid
+from datetime import date, datetime, timedelta
 
+import requests
 from celery.schedules import crontab
+from celery.signals import worker_process_init
 from flask import Flask
-from flask_mail import Mail, Message
 
+from leopard_lavatory.celery import local_executor, schedule
 from leopard_lavatory.celery.celery_factory import make_celery
-from leopard_lavatory.emailer import create_email_bodies
+from leopard_lavatory.celery.serialization import SERIALIZER_NAME
+from leopard_lavatory.emailer import create_case_fragments, create_digest_bodies, create_email_bodies, \
+    create_message, send_messages, smtp_connection
+from leopard_lavatory.readers.rate_limiter import RateLimited, get_rate_limiter
+from leopard_lavatory.readers.reader_pool import ReaderPool
 from leopard_lavatory.readers.sthlm_sbk import SBKReader
-from leopard_lavatory.storage.database import get_all_watchjobs, get_watchjob, database_session
+from leopard_lavatory.readers.sthlm_streets_properties import ALPHABET, SthlmStreetsProperties, \
+    crawl_all
+from leopard_lavatory.readers.upstream_health import UpstreamUnavailable, get_upstream_health
+from leopard_lavatory.storage.database import get_all_watchjobs, get_watchjob, database_session, \
+    get_due_watchjobs, count_leased_watchjobs, lease_watchjobs, renew_watchjob_lease, \
+    release_watchjob_lease, add_watchjob_fastigheter, upsert_cases, add_watchjob_cases, get_last_sweep, \
+    add_sweep, get_pending_gazetteer_prefixes, start_gazetteer_crawl, add_gazetteer_result, \
+    get_digest_users, get_cases_found_between, set_last_digest, get_crawl_checkpoint, save_crawl_checkpoint, \
+    delete_crawl_checkpoint
+from leopard_lavatory.utils import metrics
+from leopard_lavatory.utils.case_index import CaseIndex
 
 LOG = logging.getLogger(__name__)
 
@@ -18,113 +39,632 @@ flask_app = Flask(__name__)
 flask_app.config.update(
     CELERY_BROKER_URL='redis://localhost:6379',
     CELERY_RESULT_BACKEND='redis://localhost:6379',
-    MAIL_SERVER=os.environ.get('FLASK_MAIL_SERVER'),
-    MAIL_PORT=587,
-    MAIL_DEBUG=True,
-    MAIL_USE_TLS=True,
-    MAIL_USE_SSL=False,
-    MAIL_USERNAME=os.environ.get('FLASK_MAIL_USERNAME'),
-    MAIL_PASSWORD=os.environ.get('FLASK_MAIL_PASSWORD'),
-    MAIL_DEFAULT_SENDER=os.environ.get('FLASK_MAIL_DEFAULT_SENDER'),
+    # cases are sent as compact msgpack arrays instead of json objects
+    CELERY_TASK_SERIALIZER=SERIALIZER_NAME,
+    CELERY_RESULT_SERIALIZER=SERIALIZER_NAME,
+    CELERY_ACCEPT_CONTENT=[SERIALIZER_NAME, 'json'],
+    # most tasks don't store their results (ignore_result), drop the others after an hour
+    CELERY_TASK_RESULT_EXPIRES=3600,
 )
 celery = make_celery(flask_app)
 
-mail = Mail(flask_app)
-
-mail.debug = True
+# where the tasks run: "celery" (sent to the workers through the broker) or "thread" / "process"
+#  (on a pool of threads or processes of the local executor, without broker, see local_executor)
+EXECUTION_MODE = os.environ.get('LEOPARD_EXECUTION_MODE', 'celery')
+
+# in sweep mode, the recent cases of the whole city are read once per run and matched to all
+#  watchjobs locally, instead of searching once per watchjob
+SWEEP_MODE = os.environ.get('LEOPARD_SWEEP_MODE', '0') == '1'
+
+# without a last case (first crawl of a watchjob or sweep), only read cases from this many days
+#  back, so that the number of pages stays bounded (0 to read all cases)
+FIRST_CRAWL_DAYS = int(os.environ.get('LEOPARD_FIRST_CRAWL_DAYS', '365'))
+
+# number of watchjobs read from the database and sent to the broker at once, the watchjobs of a
+#  batch are checked one after another by one worker
+DISPATCH_BATCH_SIZE = int(os.environ.get('LEOPARD_DISPATCH_BATCH_SIZE', '50'))
+# maximum number of due watchjobs dispatched per scheduler tick (once a minute), so that the
+#  watchjobs that became due overnight are spread over the first minutes of the day
+MAX_DISPATCH_PER_TICK = int(os.environ.get('LEOPARD_MAX_DISPATCH_PER_TICK', '500'))
+
+# number of idle readers kept per worker process (more than one for thread pools), and how long
+#  they are kept (the sessions of insynsbk expire after some time)
+READER_POOL_SIZE = int(os.environ.get('LEOPARD_READER_POOL_SIZE', '2'))
+READER_MAX_IDLE = int(os.environ.get('LEOPARD_READER_MAX_IDLE', '600'))
+
+# seconds to wait for insynsbk to connect and respond, a slow request is cut off and counted as
+#  failure by the circuit breaker instead of blocking the worker
+READER_TIMEOUT = float(os.environ.get('LEOPARD_READER_TIMEOUT', '20'))
+
+# a check that failed mid-crawl is retried from its checkpoint after this many seconds (doubled for
+#  every retry, up to an hour), at most CRAWL_MAX_RETRIES times before it is left to the next
+#  scheduled run of the watchjob
+CRAWL_RETRY_SECONDS = int(os.environ.get('LEOPARD_CRAWL_RETRY_SECONDS', '60'))
+CRAWL_MAX_RETRIES = int(os.environ.get('LEOPARD_CRAWL_MAX_RETRIES', '5'))
+
+# time budget of a dispatch cycle: the checks that did not start within this many seconds after
+#  their dispatch are skipped and reported, and dispatched first by the next cycle
+CYCLE_BUDGET = int(os.environ.get('LEOPARD_CYCLE_BUDGET', '3300'))
+# a dispatched watchjob is leased by its cycle until its check is done, so that an overlapping cycle
+#  doesn't check it at the same time; at most for the budget of the cycle and this many seconds
+#  (renewed for every page and retry of the check), after which the lease of a crashed check expires
+LEASE_SECONDS = int(os.environ.get('LEOPARD_LEASE_SECONDS', '900'))
+
+# the cases found in the last this many seconds are left to the next digest: found_at is set when
+#  the page of a case is written, so its transaction may not be committed yet when the digest
+#  reads the cases (a page is committed right after it is written)
+DIGEST_SETTLE_SECONDS = int(os.environ.get('LEOPARD_DIGEST_SETTLE_SECONDS', '60'))
+
+# root url of the web app, for the links in the digests
+BASE_URL = os.environ.get('LEOPARD_BASE_URL', 'http://localhost:5000/')
+
+
+def first_crawl_date(last_case_id):
+    """Return the date watermark for a crawl: None if there is a last case to stop at, otherwise
+    the date FIRST_CRAWL_DAYS ago.
+    Args:
+        last_case_id (str): id of the newest case seen before, may be None or 0
+    Returns:
+        Optional[str]: date (YYYY-MM-DD) where to stop the backward search
+    """
+    if last_case_id or FIRST_CRAWL_DAYS <= 0:
+        return None
+    return (date.today() - timedelta(days=FIRST_CRAWL_DAYS)).isoformat()
+
+
+def periodic_tasks():
+    """Return the periodic tasks of the configured mode, run by celery beat or by the scheduler of
+    the local executor.
+    Returns:
+        list[Tuple[str, celery.schedules.crontab, celery.Task]]: name, schedule and task
+    """
+    hours = os.environ.get('CELERY_CRONTAB_HOURS', '8-20')
+    if SWEEP_MODE:
+        # by default, sweep once an hour, every day between 8 in the morning and 8 in the evening;
+        #  the digests are sent at the end of every sweep
+        return [("Run watchjobs", crontab(hour=hours, minute='0'), run_all_watchjobs)]
+    # by default, dispatch the due watchjobs every minute between 8 in the morning and 8 in the
+    #  evening, each watchjob is due once per its own poll interval (see schedule); one digest per
+    #  user and hour with the cases found by the checks in the past hour
+    return [("Run due watchjobs", crontab(hour=hours, minute='*'), run_due_watchjobs),
+            ("Send digests", crontab(hour=hours, minute='59'), send_digests)]
 
 
 @celery.on_after_configure.connect
 def setup_periodic_task(sender, **kwargs):
-    sender.add_periodic_task(
-        # by default, run jobs once an hour, every day between 8 in the morning and 8 in the evening
-        crontab(hour=os.environ.get('CELERY_CRONTAB_HOURS', '8-20'), minute='0'),
-        run_all_watchjobs.s(),
-        name="Run watchjobs")
+    for name, run_every, task in periodic_tasks():
+        sender.add_periodic_task(run_every, task.s(), name=name)
+
+
+def dispatch(task, args=(), countdown=None):
+    """Send a task to the celery workers, or to the local executor in local execution mode.
+    Args:
+        task (celery.Task): the task
+        args (Sequence): arguments of the task
+        countdown (float): seconds to wait before the task is run
+    """
+    if EXECUTION_MODE == 'celery':
+        task.apply_async(args=list(args), countdown=countdown)
+    else:
+        local_executor.submit(task.name.rpartition('.')[2], args, countdown)
+
+
+def dispatch_batch(task, batch):
+    """Send a batch of runs of a task, in one message to one celery worker or to the local
+    executor, which spreads them over its pool.
+    Args:
+        task (celery.Task): the task
+        batch (list[Sequence]): arguments of every run
+    """
+    if not batch:
+        return
+    if EXECUTION_MODE == 'celery':
+        task.chunks(batch, len(batch)).apply_async()
+    else:
+        for args in batch:
+            dispatch(task, args)
+
+
+def upstream_open_for():
+    """Return how long the circuit of insynsbk stays open, see `UpstreamHealth`.
+    Returns:
+        float: seconds, 0 if the circuit is not open
+    """
+    return get_upstream_health().open_for(urllib.parse.urlsplit(SBKReader.url).hostname)
+
+
+@celery.task(ignore_result=True)
+@metrics.timed('run_all_watchjobs')
+def run_all_watchjobs():
+    if SWEEP_MODE:
+        dispatch(sweep_watchjobs)
+        return
+
+    # the watchjobs are checked by the next run instead of failing while insynsbk is down
+    open_for = upstream_open_for()
+    if open_for:
+        LOG.warning('Upstream unavailable for {:.0f} more seconds, not running watchjobs'.format(open_for))
+        return
+
+    LOG.info('Running all watch jobs...')
+    cycle = start_cycle()
+    num_dispatched = 0
+    while True:
+        # a short transaction per batch instead of one over the whole dispatch; the most overdue
+        #  watchjobs first, so that the ones that don't fit into the budget are checked less late
+        with database_session() as dbs:
+            batch = lease_batch(dbs, cycle, DISPATCH_BATCH_SIZE, all_watchjobs=True)
+        if batch is None:
+            break
+        dispatch_batch(check_watchjob, batch)
+        num_dispatched += len(batch)
 
+    with database_session() as dbs:
+        num_in_flight = count_leased_watchjobs(dbs, cycle['now'], cycle['lease_id'], all_watchjobs=True)
+    report_cycle(num_dispatched, num_in_flight)
+
+
+@celery.task(ignore_result=True)
+@metrics.timed('run_due_watchjobs')
+def run_due_watchjobs():
+    """Dispatch the watchjobs whose next run is due, and schedule their next run right away (a
+    watchjob is not dispatched again while it is leased by the tick that dispatched it anyway)."""
+    # the due watchjobs stay due and are dispatched by a tick after the circuit closed
+    open_for = upstream_open_for()
+    if open_for:
+        LOG.warning('Upstream unavailable for {:.0f} more seconds, not dispatching'.format(open_for))
+        return 0
+
+    cycle = start_cycle()
+    num_dispatched = 0
+    while num_dispatched < MAX_DISPATCH_PER_TICK:
+        with database_session() as dbs:
+            batch = lease_batch(dbs, cycle, min(DISPATCH_BATCH_SIZE,
+                                                MAX_DISPATCH_PER_TICK - num_dispatched))
+        if batch is None:
+            break
+        dispatch_batch(check_watchjob, batch)
+        num_dispatched += len(batch)
 
-@celery.task
-def run_all_watchjobs():
     with database_session() as dbs:
-        LOG.info('Running all watch jobs...')
-        watchjobs = get_all_watchjobs(dbs)
-        for watchjob in watchjobs:
-            LOG.debug(watchjob)
+        num_in_flight = count_leased_watchjobs(dbs, cycle['now'], cycle['lease_id'])
+    report_cycle(num_dispatched, num_in_flight)
+    return num_dispatched
+
+
+def start_cycle():
+    """Start a dispatch cycle.
+    Returns:
+        dict: the time the cycle started, its lease id, when its leases expire and its deadline
+          (seconds since the epoch) for the start of its checks
+    """
+    now = datetime.now()
+    return {'now': now,
+            'lease_id': uuid.uuid4().hex,
+            'lease_until': now + timedelta(seconds=CYCLE_BUDGET + LEASE_SECONDS),
+            'deadline': time.time() + CYCLE_BUDGET}
+
+
+def lease_batch(dbs, cycle, limit, all_watchjobs=False):
+    """Lease the next batch of due watchjobs for a cycle, the longest overdue first, skipping the
+    ones leased by another cycle, and schedule their next run.
+    Args:
+        dbs (sqlalchemy.orm.session.Session): database session
+        cycle (dict): the cycle, see `start_cycle`
+        limit (int): maximum number of watchjobs in the batch
+        all_watchjobs (bool): whether to lease the watchjobs that are not due yet as well
+    Returns:
+        Optional[list[tuple]]: arguments of check_watchjob for the leased watchjobs, None if there
+          are no more watchjobs
+    """
+    watchjobs = get_due_watchjobs(dbs, cycle['now'], limit, all_watchjobs, cycle['lease_id'])
+    if not watchjobs:
+        return None
+    leased = lease_watchjobs(dbs, [watchjob.id for watchjob in watchjobs], cycle['lease_id'],
+                             cycle['now'], cycle['lease_until'])
+    batch = []
+    for watchjob in watchjobs:
+        if watchjob.id in leased:
+            batch.append((watchjob.id, watchjob.query, watchjob.last_case_id, cycle['lease_id'],
+                          cycle['deadline']))
+            watchjob.next_run_at = schedule.next_run_at(cycle['now'], watchjob.id, watchjob.poll_interval)
+    return batch
+
+
+def report_cycle(num_dispatched, num_in_flight):
+    """Log the number of dispatched watchjobs of a cycle, and of the ones skipped as their check
+    of a previous cycle is still in flight."""
+    if num_in_flight > 0:
+        metrics.WATCHJOBS_SKIPPED.labels('in_flight').inc(num_in_flight)
+        LOG.warning('Skipped {} watchjobs that are still in flight from a previous cycle'.format(num_in_flight))
+    LOG.info('Dispatched {} watchjobs'.format(num_dispatched))
+
+
+def create_reader():
+    """Create a reader that draws from the rate limiter and upstream health controller shared by
+    all workers and raises `RateLimited` instead of blocking the worker."""
+    return SBKReader(rate_limiter=get_rate_limiter(), block_on_rate_limit=False,
+                     upstream_health=get_upstream_health(), timeout=READER_TIMEOUT)
+
+
+_reader_pool = None
+_reader_pool_pid = None
+
+
+def get_reader_pool():
+    """Return the pool of readers of this process, so that the browser session, connections and
+    search form state of a reader are reused by the following checks instead of being set up
+    again for every watchjob. Created again in a forked process, which can't share them.
+    Returns:
+        ReaderPool: the pool
+    """
+    global _reader_pool, _reader_pool_pid
+    if _reader_pool is None or _reader_pool_pid != os.getpid():
+        _reader_pool = ReaderPool(create_reader, size=READER_POOL_SIZE, max_idle=READER_MAX_IDLE)
+        _reader_pool_pid = os.getpid()
+    return _reader_pool
+
+
+@worker_process_init.connect
+def init_reader_pool(**kwargs):
+    """Create the reader pool of a worker process when it starts, instead of in its first task."""
+    get_reader_pool().warm()
+
+
+@celery.task(bind=True, max_retries=None, ignore_result=True)
+@metrics.timed('sweep_watchjobs')
+def sweep_watchjobs(self):
+    """Read the recent cases of the whole city once and match them to all watchjobs using an
+    inverted index on street addresses and fastigheter.
+
+    Watchjobs without any known fastighet yet are checked individually, which also records their
+    fastigheter for the next sweep.
+    """
+    with database_session() as dbs:
+        last_sweep = get_last_sweep(dbs)
+        newer_than_case = last_sweep.last_case_id if last_sweep else None
 
-            (check_watchjob.s(watchjob.id, watchjob.query, watchjob.last_case_id) | notify_users.s(watchjob.id)). \
-                apply_async()
+        LOG.info('Sweeping all cases newer than case {}'.format(newer_than_case))
+        try:
+            with get_reader_pool().checkout() as reader:
+                # without a last case (first sweep), only the first page of the whole city; the
+                #  date watermark of first_crawl_date is for the checks of single watchjobs
+                new_cases = reader.get_recent_cases(newer_than_case)
+        except RateLimited as error:
+            LOG.info(str(error))
+            if self.request.called_directly:
+                dispatch(sweep_watchjobs, countdown=error.retry_after)
+                return
+            raise self.retry(countdown=error.retry_after)
+        LOG.debug('Found {} results'.format(len(new_cases)))
+        metrics.CASES_FOUND.labels('sweep_watchjobs').inc(len(new_cases))
+
+        index = CaseIndex()
+        unindexed = []
+        for watchjob in get_all_watchjobs(dbs):
+            fastigheter = json.loads(watchjob.fastigheter or '[]')
+            if not fastigheter:
+                unindexed.append((watchjob.id, watchjob.query, watchjob.last_case_id))
+                continue
+
+            try:
+                street = json.loads(watchjob.query).get('street')
+            except ValueError:
+                LOG.exception('Error parsing query JSON')
+                continue
+            index.add(watchjob.id, [street] + fastigheter)
+
+        with metrics.TASK_DB_WRITE_SECONDS.labels('sweep_watchjobs').time():
+            upsert_cases(dbs, new_cases)
+            for watchjob_id, cases in index.match_all(new_cases).items():
+                watchjob = get_watchjob(dbs, watchjob_id)
+                LOG.debug('Matched {} cases to watchjob {}'.format(len(cases), watchjob_id))
+                watchjob.last_case_id = cases[0]['id']
+                add_watchjob_cases(dbs, watchjob_id, [case['id'] for case in cases])
 
+            add_sweep(dbs, new_cases[0]['id'] if new_cases else newer_than_case, len(new_cases))
+            # the digests read the cases from the database
+            dbs.commit()
 
-@celery.task
-def check_watchjob(watchjob_id, query_json, last_case_id):
+    # the leases are committed before the checks are dispatched, skipping the watchjobs whose
+    #  check of a previous sweep is still in flight
+    cycle = start_cycle()
     with database_session() as dbs:
-        reader = SBKReader()
+        leased = lease_watchjobs(dbs, [args[0] for args in unindexed], cycle['lease_id'],
+                                 cycle['now'], cycle['lease_until'])
+    for watchjob_id, query_json, last_case_id in unindexed:
+        if watchjob_id in leased:
+            dispatch(check_watchjob, [watchjob_id, query_json, last_case_id, cycle['lease_id'],
+                                      cycle['deadline']])
+    report_cycle(len(leased), len(unindexed) - len(leased))
+
+    # after the cases of the sweep have settled, see send_digests
+    dispatch(send_digests, countdown=DIGEST_SETTLE_SECONDS)
+
+
+@celery.task(bind=True, max_retries=None, ignore_result=True)
+@metrics.timed('check_watchjob')
+def check_watchjob(self, watchjob_id, query_json, last_case_id, lease_id=None, deadline=None, failures=0):
+    """Check a watchjob for new cases and store them for the next digest.
+    Args:
+        watchjob_id (int): watchjob id
+        query_json (str): query of the watchjob
+        last_case_id (str): id of the newest case seen before
+        lease_id (str): lease of the watchjob held by the dispatching cycle, released when the
+          check is done
+        deadline (float): time (seconds since the epoch) after which the check is skipped, as it
+          did not fit into the budget of its cycle
+        failures (int): number of failed attempts of this check so far, passed on to its retries
+          (also when they are run directly, see retry_later)
+    Returns:
+        int: number of new cases
+    """
+    if deadline is not None and time.time() > deadline:
+        LOG.warning('Watchjob {} did not fit into the budget of its cycle, skipped'.format(watchjob_id))
+        metrics.WATCHJOBS_SKIPPED.labels('budget').inc()
+        with database_session() as dbs:
+            watchjob = get_watchjob(dbs, watchjob_id)
+            if watchjob is not None and (lease_id is None or watchjob.lease_id == lease_id):
+                # check it first in the next cycle
+                watchjob.next_run_at = None
+            release_watchjob_lease(dbs, watchjob_id, lease_id)
+        return 0
+
+    def lease_until(countdown=0):
+        return datetime.now() + timedelta(seconds=countdown + LEASE_SECONDS)
+
+    def retry_later(countdown, retry_deadline=None, retry_failures=failures):
+        # the lease is kept for the retry, which continues a started crawl regardless of the
+        #  deadline
+        renew_watchjob_lease(dbs, watchjob_id, lease_id, lease_until(countdown))
+        dbs.commit()
+        args = [watchjob_id, query_json, last_case_id, lease_id, retry_deadline, retry_failures]
+        if self.request.called_directly:
+            # part of a batch (see run_all_watchjobs) or run by the local executor, reschedule
+            #  only this watchjob
+            dispatch(check_watchjob, args, countdown)
+            return 0
+        raise self.retry(args=args, countdown=countdown)
 
+    with database_session() as dbs:
         try:
             query = json.loads(query_json)
         except ValueError:
             # JSON parsing error, just return nothing
             LOG.exception('Error parsing query JSON')
-            return []
+            release_watchjob_lease(dbs, watchjob_id, lease_id)
+            return 0
 
         if 'street' in query:
             address = query['street']
             newer_than_case = last_case_id
+            newer_than_date = first_crawl_date(last_case_id)
+
+            # continue an unfinished crawl after its last stored page, with the same watermarks
+            checkpoint = get_crawl_checkpoint(dbs, watchjob_id)
+            resume_state = None
+            new_last_case_id = None
+            num_new_cases = 0
+            if checkpoint is not None and (checkpoint.newer_than_case or None) == (newer_than_case or None):
+                resume_state = json.loads(checkpoint.state)
+                newer_than_date = checkpoint.newer_than_date
+                new_last_case_id = checkpoint.new_last_case_id
+                num_new_cases = checkpoint.num_cases
 
             LOG.debug('Getting all results for address {}, newer than case {}'.format(address, newer_than_case))
-            new_cases = reader.get_cases(address, newer_than_case)
-
-            LOG.debug('Found {} results'.format(len(new_cases)))
-            # LOG.debug(json.dumps(new_cases, indent=2, ensure_ascii=False))
-
-            if len(new_cases):
-                new_last_case_id = new_cases[0]['id']
+            # stream the results page by page: every page is stored while the next one is
+            #  requested, instead of holding all pages of the crawl in memory
+            try:
+                with get_reader_pool().checkout() as reader:
+                    for new_cases in reader.iter_pages(address, newer_than_case, newer_than_date,
+                                                       resume_state):
+                        if new_last_case_id is None:
+                            new_last_case_id = new_cases[0]['id']
+                        num_new_cases += len(new_cases)
+                        metrics.CASES_FOUND.labels('check_watchjob').inc(len(new_cases))
+
+                        with metrics.TASK_DB_WRITE_SECONDS.labels('check_watchjob').time():
+                            if not renew_watchjob_lease(dbs, watchjob_id, lease_id, lease_until()):
+                                # the lease expired and the watchjob is checked by another cycle
+                                LOG.warning('Lost the lease of watchjob {}, stopped checking it'.format(watchjob_id))
+                                dbs.rollback()
+                                return 0
+                            # remember the fastigheter of this address for city wide sweeps
+                            add_watchjob_fastigheter(dbs, watchjob_id, new_cases)
+                            # the next digest reads the cases found for the watchjob from the
+                            #  database; cases that are related to the watchjob already (by a
+                            #  retried or overlapping check) keep their first found_at, so they are
+                            #  not in a digest again
+                            add_watchjob_cases(dbs, watchjob_id, upsert_cases(dbs, new_cases))
+                            # in the same transaction as the cases of the page
+                            save_crawl_checkpoint(dbs, watchjob_id, newer_than_case, newer_than_date,
+                                                  new_last_case_id, num_new_cases,
+                                                  json.dumps(reader.checkpoint()))
+                            dbs.commit()
+            except RateLimited as error:
+                # reschedule this task for when a token or request slot is available, instead of
+                #  blocking the worker (only the first page can be rate limited, the following
+                #  ones wait); until the first page is stored, the retries keep the deadline, so
+                #  that they end with the budget of the cycle
+                LOG.info(str(error))
+                if not (isinstance(error, UpstreamUnavailable) and error.reason == 'open'):
+                    return retry_later(error.retry_after,
+                                       deadline if new_last_case_id is None else None)
+                # the circuit of insynsbk opened (also mid-crawl), a failure like the ones below
+                failure, retry_after = error, error.retry_after
+            except (requests.RequestException, ValueError) as error:
+                # a timeout or error of insynsbk (counted by the circuit breaker) fails only this
+                #  watchjob instead of the rest of its batch
+                failure, retry_after = error, 0
+            else:
+                failure = None
+
+            if failure is not None:
+                # the crawl is retried with backoff from the checkpoint of the last stored page,
+                #  up to CRAWL_MAX_RETRIES times, then it is left to the next scheduled run
+                if failures >= CRAWL_MAX_RETRIES:
+                    LOG.warning('Checking watchjob {} failed {} times, giving up: {}'.format(
+                        watchjob_id, failures + 1, failure))
+                    release_watchjob_lease(dbs, watchjob_id, lease_id)
+                    return 0
+                LOG.warning('Checking watchjob {} failed: {}'.format(watchjob_id, failure))
+                return retry_later(max(retry_after, min(3600, CRAWL_RETRY_SECONDS * 2 ** failures)),
+                                   retry_failures=failures + 1)
+
+            LOG.debug('Found {} results'.format(num_new_cases))
 
-                watchjob = get_watchjob(dbs, watchjob_id)
+            watchjob = get_watchjob(dbs, watchjob_id)
 
+            delete_crawl_checkpoint(dbs, watchjob_id)
+            release_watchjob_lease(dbs, watchjob_id, lease_id)
+            if new_last_case_id is not None:
+                # the watermark is only moved after the last page, so a crawl that fails halfway
+                #  is continued from its checkpoint instead of losing the older cases
                 LOG.debug('The new last_case_id is {}, write it to the database'.format(new_last_case_id))
 
                 watchjob.last_case_id = new_last_case_id
             else:
                 LOG.debug('No new cases found.')
 
-            return new_cases
+            # check busy addresses more often and quiet ones less often (the first crawl finds
+            #  the older cases too, which says nothing about how busy the address is)
+            if last_case_id:
+                watchjob.poll_interval = schedule.next_interval(watchjob.poll_interval, num_new_cases)
+            watchjob.next_run_at = schedule.next_run_at(datetime.now(), watchjob_id, watchjob.poll_interval)
+
+            return num_new_cases
         else:
-            return []
+            release_watchjob_lease(dbs, watchjob_id, lease_id)
+            return 0
+
+
+@celery.task(ignore_result=True)
+@metrics.timed('send_digests')
+def send_digests(settle_seconds=None):
+    """Send every user one message with the new cases of all their watchjobs since their last
+    digest.
+
+    The list of new cases of a watchjob is rendered once and shared by the digests of all users
+    watching it, only the rest of the digest (eg the delete link) is rendered per user. All
+    messages are sent over one pooled connection to the mail server.
+    Args:
+        settle_seconds (float): leave the cases found in the last seconds to the next digest,
+          DIGEST_SETTLE_SECONDS if None (0 when no check is running)
+    Returns:
+        int: number of sent digests
+    """
+    if settle_seconds is None:
+        settle_seconds = DIGEST_SETTLE_SECONDS
+    # the watermark of the digests, all cases found up to it are committed before they are read
+    until = datetime.now() - timedelta(seconds=settle_seconds)
+    with database_session() as dbs:
+        users = get_digest_users(dbs)
+        if not users:
+            return 0
+        since = min(user.last_digest_at or user.created_at for user in users)
+        found = {}
+        for watchjob_id, found_at, case in get_cases_found_between(dbs, since, until):
+            found.setdefault(watchjob_id, []).append((found_at, case))
+
+        fragments = {}
+        digests = []
+        for user in users:
+            user_since = user.last_digest_at or user.created_at
+            user_fragments = []
+            for watchjob in user.watchjobs:
+                cases = [case for found_at, case in found.get(watchjob.id, ()) if found_at > user_since]
+                if not cases:
+                    continue
+                # users that got their last digest at the same time share the fragment
+                key = (watchjob.id, tuple(case.case_id for case in cases))
+                if key not in fragments:
+                    try:
+                        address = json.loads(watchjob.query).get('street')
+                    except ValueError:
+                        LOG.exception('Error parsing query JSON')
+                        address = watchjob.query
+                    fragments[key] = create_case_fragments(address, cases)
+                user_fragments.append(fragments[key])
+            digests.append((user.id, user.email, user.delete_token, user_fragments))
+    LOG.debug('Rendered {} case fragments for {} users'.format(len(fragments), len(digests)))
+
+    # users without new cases are up to date as well
+    done_user_ids = [user_id for user_id, email, delete_token, user_fragments in digests
+                     if not user_fragments]
+    num_sent = 0
+    try:
+        with smtp_connection() as connection:
+            for user_id, email, delete_token, user_fragments in digests:
+                if not user_fragments:
+                    continue
+                delete_link = urllib.parse.urljoin(BASE_URL, 'delete?' + urllib.parse.urlencode({'t': delete_token}))
+                text_body, html_body = create_digest_bodies(user_fragments, {'button_href': delete_link})
+                # FLASK_MAIL_RECIPIENT redirects all digests to one address, for testing
+                msg = create_message(os.environ.get('FLASK_MAIL_RECIPIENT', email), "Nya byggärenden",
+                                     text_body, html_body)
+                try:
+                    connection.send(msg)
+                except smtplib.SMTPServerDisconnected:
+                    raise
+                except smtplib.SMTPException as error:
+                    # a message the server refused (eg the recipient) doesn't keep the following
+                    #  users from their digests; the user gets the cases with the next digest
+                    LOG.warning('Sending the digest to user {} failed: {}'.format(user_id, error))
+                    continue
+                done_user_ids.append(user_id)
+                num_sent += 1
+    finally:
+        # the users that got their digest before an error don't get the same cases again
+        with database_session() as dbs:
+            set_last_digest(dbs, done_user_ids, until)
+
+    LOG.info('Sent {} digests'.format(num_sent))
+    return num_sent
 
 
 @celery.task
-def notify_users(new_cases, watchjob_id):
+@metrics.timed('crawl_gazetteer')
+def crawl_gazetteer(num_workers=4):
+    """Crawl all street addresses and fastighet names from kartor.stockholm.se into the gazetteer
+    tables. Continues an interrupted crawl from its pending prefixes, otherwise a new crawl is
+    started, which adds new entries to the gazetteer.
+    Args:
+        num_workers (int): number of parallel requests (all of them share the rate limit)
+    Returns:
+        int: number of crawled prefixes
+    """
     with database_session() as dbs:
-        if new_cases:
-            LOG.debug('There\'s new cases, get the users for watch job %s and notify them!', watchjob_id)
+        prefixes = get_pending_gazetteer_prefixes(dbs)
+        if not prefixes:
+            start_gazetteer_crawl(dbs, ALPHABET)
+            prefixes = list(ALPHABET)
+    LOG.info('Crawling gazetteer, {} prefixes pending'.format(len(prefixes)))
 
-            watchjob = get_watchjob(dbs, watchjob_id)
-
-            # TODO send actual emails
-            LOG.debug('Sending notifications to %s', [user.email for user in watchjob.users])
-        else:
-            LOG.debug('Nothing to do.')
+    def store(prefix, num_rows, streets, properties, children):
+        # one transaction per prefix, so that an interrupted crawl only repeats the running ones
+        with database_session() as dbs:
+            add_gazetteer_result(dbs, prefix, num_rows, streets, properties, children)
 
-        return len(new_cases)
+    return crawl_all(prefixes, store,
+                     lambda: SthlmStreetsProperties(rate_limiter=get_rate_limiter()),
+                     num_workers=num_workers)
 
 
-@celery.task
+@celery.task(ignore_result=True)
+@metrics.timed('send_confirm_email')
 def send_confirm_email(email_address, confirm_link, address):
     text_body, html_body = create_email_bodies('activation', {'button_href': confirm_link, 'address': address})
-    msg = Message("Bekräfta bevakning av byggärende", recipients=[os.environ['FLASK_MAIL_RECIPIENT']])
-    msg.body = text_body
-    msg.html = html_body
+    msg = create_message(os.environ['FLASK_MAIL_RECIPIENT'], "Bekräfta bevakning av byggärende",
+                         text_body, html_body)
 
-    mail.send(msg)
+    send_messages([msg])
 
 
-@celery.task
+@celery.task(ignore_result=True)
+@metrics.timed('send_welcome_email')
 def send_welcome_email(email_address, delete_link):
     text_body, html_body = create_email_bodies('welcome', {'button_href': delete_link})
-    msg = Message("Välkommen!", recipients=[os.environ['FLASK_MAIL_RECIPIENT']])
-    msg.body = text_body
-    msg.html = html_body
+    msg = create_message(os.environ['FLASK_MAIL_RECIPIENT'], "Välkommen!", text_body, html_body)
 
-    mail.send(msg)
+    send_messages([msg])
 
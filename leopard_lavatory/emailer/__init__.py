@@ -1,16 +1,33 @@
 #!/usr/bin/env python3
 import os
-import smtplib
+import threading
+from contextlib import contextmanager
 from email.headerregistry import Address
 from email.message import EmailMessage
 
 import yaml
 from jinja2 import Environment, PackageLoader, select_autoescape
-
-FROM_ADDRESS = Address('Display Name From', 'from@example.com')
-SMTP_SERVER = 'localhost'
+from markupsafe import Markup
+
+from leopard_lavatory.emailer.smtp_pool import SMTPPool
+
+FROM_ADDRESS = Address(addr_spec=os.environ['FLASK_MAIL_DEFAULT_SENDER']) \
+    if os.environ.get('FLASK_MAIL_DEFAULT_SENDER') else Address('Display Name From', 'from@example.com')
+SMTP_SERVER = os.environ.get('FLASK_MAIL_SERVER', 'localhost')
+SMTP_PORT = int(os.environ.get('FLASK_MAIL_PORT', '587'))
+SMTP_USE_TLS = os.environ.get('FLASK_MAIL_USE_TLS', '1') == '1'
+SMTP_USERNAME = os.environ.get('FLASK_MAIL_USERNAME')
+SMTP_PASSWORD = os.environ.get('FLASK_MAIL_PASSWORD')
+# number of SMTP connections kept open per process
+SMTP_POOL_SIZE = int(os.environ.get('LEOPARD_SMTP_POOL_SIZE', '2'))
+# render the messages, but don't send them (for load tests)
+SUPPRESS_SEND = os.environ.get('FLASK_MAIL_SUPPRESS_SEND', '0') == '1'
 DEBUG_DRYRUN = True
 
+_smtp_pool = None
+_smtp_pool_pid = None
+_smtp_pool_lock = threading.Lock()
+
 ENV = Environment(
     loader=PackageLoader('leopard_lavatory.emailer'),
     autoescape=select_autoescape(default=True)
@@ -56,6 +73,22 @@ def _read_templates():
 TEMPLATES, DEFAULT_DATA = _read_templates()
 
 
+def get_smtp_pool():
+    """Return the SMTP connection pool of this process, which is created on first use (and
+    again in a forked worker process, as the connections can't be shared between processes).
+
+    Returns:
+        leopard_lavatory.emailer.smtp_pool.SMTPPool: the pool
+    """
+    global _smtp_pool, _smtp_pool_pid
+    with _smtp_pool_lock:
+        if _smtp_pool is None or _smtp_pool_pid != os.getpid():
+            _smtp_pool = SMTPPool(SMTP_SERVER, SMTP_PORT, SMTP_USERNAME, SMTP_PASSWORD,
+                                  use_tls=SMTP_USE_TLS, size=SMTP_POOL_SIZE)
+            _smtp_pool_pid = os.getpid()
+        return _smtp_pool
+
+
 def send_email(template_name, to_address, data=None):
     """Send an email to the recipient `to_address` using the given template that will be rendered
     with the default values (read from <template_name.yml>) updated with the optionally provided
@@ -77,16 +110,56 @@ def send_email(template_name, to_address, data=None):
         subject = DEFAULT_DATA[template_name]['subject']
     txt_body, html_body = create_email_bodies(template_name, data)
 
-    msg = _create_message(to_address, subject, txt_body, html_body)
+    msg = create_message(to_address, subject, txt_body, html_body)
 
     if DEBUG_DRYRUN:
         # Make a local copy of what we would have sent.
         with open('outgoing.msg', 'wb') as f:
             f.write(bytes(msg))
     else:
-        # Send the message via the SMTP server.
-        with smtplib.SMTP(SMTP_SERVER) as smtp_server:
-            smtp_server.send_message(msg)
+        # Send the message via a pooled connection to the SMTP server.
+        send_messages([msg])
+
+
+class _SuppressedConnection:
+    """Stands in for a pooled connection if `SUPPRESS_SEND` is set."""
+
+    def send(self, message):
+        pass
+
+
+@contextmanager
+def smtp_connection():
+    """Borrow a connection to the SMTP server from the pool of this process, for sending a batch
+    of messages with its `send(message)` method.
+
+    Usage:
+        with smtp_connection() as connection:
+            for message in messages:
+                connection.send(message)
+    """
+    if SUPPRESS_SEND:
+        yield _SuppressedConnection()
+        return
+    with get_smtp_pool().connection() as connection:
+        yield connection
+
+
+def send_messages(messages):
+    """Send messages over one pooled connection to the SMTP server.
+
+    Args:
+        messages (Iterable[email.message.EmailMessage]): the messages, eg from `create_message`
+
+    Returns:
+        int: number of sent messages
+    """
+    num_sent = 0
+    with smtp_connection() as connection:
+        for message in messages:
+            connection.send(message)
+            num_sent += 1
+    return num_sent
 
 
 def create_email_bodies(template_name, data=None):
@@ -102,7 +175,7 @@ def create_email_bodies(template_name, data=None):
     Returns:
         Tuple[str, str]: a tuple of the text body and the html body as strings
     """
-    complete_data = DEFAULT_DATA.get(template_name, {})
+    complete_data = dict(DEFAULT_DATA.get(template_name, {}))
     if data:
         complete_data.update(data)
     txt_template = ENV.get_template(f'{template_name}.txt')
@@ -112,7 +185,44 @@ def create_email_bodies(template_name, data=None):
     return txt_body, html_body
 
 
-def _create_message(to_address, subject, txt_body, html_body=None):
+def create_case_fragments(address, cases):
+    """Render the list of new cases of a watchjob, to be included in the digests of all users
+    that watch it (see `create_digest_bodies`).
+
+    Args:
+        address (str): the watched address
+        cases (List[leopard_lavatory.storage.database.StoredCase]): the new cases, newest first
+
+    Returns:
+        Tuple[str, str]: a tuple of the text fragment and the html fragment as strings
+    """
+    data = {'address': address, 'cases': cases}
+    txt_fragment = ENV.get_template('fragments/cases.txt').render(data)
+    html_fragment = ENV.get_template('fragments/cases.html').render(data)
+    return txt_fragment, html_fragment
+
+
+def create_digest_bodies(fragments, data=None):
+    """Create the txt and html bodies of a digest from rendered case fragments.
+    Only the digest around the fragments is rendered per user, with the per-user values in `data`
+    (eg the 'button_href' to delete the account).
+
+    Args:
+        fragments (List[Tuple[str, str]]): text and html fragments from `create_case_fragments`
+        data (dict): additional key-value pairs of data to pass on to the template (overrides
+          default values if they have the same name (key)
+
+    Returns:
+        Tuple[str, str]: a tuple of the text body and the html body as strings
+    """
+    complete_data = dict(data or {})
+    complete_data['cases_text'] = '\n\n'.join(txt for txt, html in fragments)
+    # the fragments are escaped already
+    complete_data['cases_html'] = Markup('\n'.join(html for txt, html in fragments))
+    return create_email_bodies('digest', complete_data)
+
+
+def create_message(to_address, subject, txt_body, html_body=None):
     """Create an email message object from the given arguments.
 
     Args:
@@ -0,0 +1,195 @@
+"""Pool of reusable SMTP connections.
+
+Opening a connection to the mail server (TCP, STARTTLS handshake and login) takes much longer
+than sending a message over it. The pool keeps a few authenticated connections open per worker
+process and sends the messages over them, reconnecting when the server closed a connection.
+"""
+
+import logging
+import queue
+import select
+import smtplib
+import ssl
+import threading
+import time
+from contextlib import contextmanager
+
+from leopard_lavatory.utils import metrics
+
+LOG = logging.getLogger(__name__)
+
+# errors of a lost connection, after which it is opened again if the message was not sent yet
+CONNECTION_ERRORS = (smtplib.SMTPServerDisconnected, ConnectionError, TimeoutError)
+
+
+class PooledConnection:
+    """An SMTP connection borrowed from the pool, see `SMTPPool.connection`."""
+
+    def __init__(self, pool, smtp):
+        self.pool = pool
+        self.smtp = smtp
+        # when the connection was checked or used last (the pool checks idle connections)
+        self.last_used = time.monotonic()
+
+    def _closed_by_server(self):
+        """Return whether the server closed the connection since its last reply, without a round
+        trip: the socket is readable then (the end of the stream, or a 421 reply)."""
+        if self.smtp.sock is None:
+            return True
+        readable, _, _ = select.select([self.smtp.sock], [], [], 0)
+        return bool(readable)
+
+    def send(self, message, max_attempts=2):
+        """Send a message, reconnecting if the connection was lost before the message is sent.
+        A connection that was idle for longer than the `max_idle` of the pool is checked with a
+        NOOP first; a lost connection while the message is sent is not retried, as the server may
+        have accepted the message already.
+        Args:
+            message (email.message.EmailMessage): the message
+            max_attempts (int): number of connections to try before the error is raised
+        """
+        for attempt in range(1, max_attempts + 1):
+            try:
+                if self.smtp is None:
+                    self.smtp = self.pool.connect()
+                elif time.monotonic() - self.last_used > self.pool.max_idle:
+                    self.smtp.noop()
+                elif self._closed_by_server():
+                    raise smtplib.SMTPServerDisconnected('Connection closed by the server')
+                break
+            except CONNECTION_ERRORS as error:
+                LOG.warning('SMTP connection lost (%s), attempt %s of %s', error, attempt,
+                            max_attempts)
+                self.pool.disconnect(self.smtp)
+                self.smtp = None
+                if attempt == max_attempts:
+                    raise
+
+        try:
+            with metrics.SMTP_SEND_SECONDS.time():
+                self.smtp.send_message(message)
+        except CONNECTION_ERRORS:
+            # sending the message again could send it twice
+            self.pool.disconnect(self.smtp)
+            self.smtp = None
+            raise
+        self.last_used = time.monotonic()
+        metrics.EMAILS_SENT.inc()
+
+
+class SMTPPool:
+    """Up to `size` SMTP connections, which are opened when they are needed first and reused by
+    the following sends. Thread safe, every thread borrows its own connection."""
+
+    def __init__(self, host, port=25, username=None, password=None, use_tls=False, size=2,
+                 timeout=30, max_idle=60):
+        """
+        Args:
+            host (str): hostname of the mail server
+            port (int): port of the mail server
+            username (str): username for the login, None to send without login
+            password (str): password for the login
+            use_tls (bool): whether to upgrade the connections with STARTTLS
+            size (int): maximum number of open connections
+            timeout (float): socket timeout in seconds
+            max_idle (float): connections that were idle for longer are checked with a NOOP
+              before they are used again, as the server may have closed them
+        """
+        self.host = host
+        self.port = port
+        self.username = username
+        self.password = password
+        self.use_tls = use_tls
+        self.timeout = timeout
+        self.max_idle = max_idle
+        # the most recently used connection first, the others can time out on the server
+        self._idle = queue.LifoQueue()
+        self._slots = threading.BoundedSemaphore(size)
+
+    def connect(self):
+        """Open and authenticate a new connection.
+        Returns:
+            smtplib.SMTP: the connection
+        """
+        smtp = smtplib.SMTP(self.host, self.port, timeout=self.timeout)
+        try:
+            if self.use_tls:
+                smtp.starttls(context=ssl.create_default_context())
+            if self.username:
+                smtp.login(self.username, self.password)
+        except Exception:
+            self.disconnect(smtp)
+            raise
+        LOG.debug('Opened SMTP connection to %s:%s', self.host, self.port)
+        metrics.SMTP_CONNECTIONS.inc()
+        return smtp
+
+    @staticmethod
+    def disconnect(smtp):
+        """Close a connection, ignoring errors of connections that are broken already."""
+        if smtp is None:
+            return
+        try:
+            smtp.quit()
+        except (smtplib.SMTPException, OSError):
+            smtp.close()
+
+    def _acquire(self):
+        self._slots.acquire()
+        try:
+            smtp, last_used = self._idle.get_nowait()
+        except queue.Empty:
+            return None
+        if time.monotonic() - last_used > self.max_idle:
+            try:
+                smtp.noop()
+            except CONNECTION_ERRORS:
+                self.disconnect(smtp)
+                return None
+        return smtp
+
+    @contextmanager
+    def connection(self):
+        """Borrow a connection for sending a batch of messages, blocks while all connections are
+        in use. The connection is opened with the first message, if there was no open one.
+
+        Usage:
+            with pool.connection() as connection:
+                for message in messages:
+                    connection.send(message)
+        """
+        connection = PooledConnection(self, self._acquire())
+        try:
+            yield connection
+        except BaseException:
+            # the connection may be in the middle of a transaction
+            self.disconnect(connection.smtp)
+            connection.smtp = None
+            raise
+        finally:
+            if connection.smtp is not None:
+                self._idle.put((connection.smtp, time.monotonic()))
+            self._slots.release()
+
+    def send(self, messages):
+        """Send a batch of messages over one connection.
+        Args:
+            messages (Iterable[email.message.EmailMessage]): the messages
+        Returns:
+            int: number of sent messages
+        """
+        num_sent = 0
+        with self.connection() as connection:
+            for message in messages:
+                connection.send(message)
+                num_sent += 1
+        return num_sent
+
+    def close(self):
+        """Close all idle connections."""
+        while True:
+            try:
+                smtp, last_used = self._idle.get_nowait()
+            except queue.Empty:
+                return
+            self.disconnect(smtp)
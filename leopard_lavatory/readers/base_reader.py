@@ -4,15 +4,20 @@
 """
 Class BaseReader
 
-Provides a mechanical soup browser and a sleep random time function.
+Provides a mechanical soup browser, a sleep random time function, an optional shared rate
+limiter and upstream health controller, a record/replay transport and the metrics of the requests.
 """
 
 import logging
 import random
 import time
+from urllib.parse import urlsplit
 
 import mechanicalsoup
 
+from leopard_lavatory.readers.cassette import RecordingAdapter, ReplayAdapter
+from leopard_lavatory.utils import metrics
+
 
 class BaseReader:
     """
@@ -20,26 +25,113 @@ class BaseReader:
 
     A StatfulBrowser from mechanicalsoup.
     Random sleep function for rate limiting.
+    Optional rate limiter shared with other readers, see `throttle`.
+    Optional upstream health controller shared with other readers and request timeouts, see
+    `request`.
+    Record/replay of all responses from/to disk, see `use_cassette`.
+    Metrics of all requests and waits, labeled with the class name of the reader.
     """
 
     def __init__(self, avg_delay_seconds=5,
-                 user_agent_string='Mozilla/5.0 (Windows; U; Windows NT 6.0; en-US; rv:1.9.0.6'):
+                 user_agent_string='Mozilla/5.0 (Windows; U; Windows NT 6.0; en-US; rv:1.9.0.6',
+                 rate_limiter=None, block_on_rate_limit=True, upstream_health=None, timeout=20):
         self.avg_delay_seconds = avg_delay_seconds
+        self.rate_limiter = rate_limiter
+        self.block_on_rate_limit = block_on_rate_limit
+        self.upstream_health = upstream_health
+        # seconds to wait for the connection and for the response (between two bytes)
+        self.timeout = timeout
 
         logger = logging.getLogger(self.__class__.__name__)
         self.log = logger
+        # reader label of the metrics
+        self.metrics_label = self.__class__.__name__
 
         browser = mechanicalsoup.StatefulBrowser()
         browser.set_user_agent(user_agent_string)
         browser.set_debug(self.log.level == logging.DEBUG)
+        browser.session.hooks['response'].append(self._record_response)
         self.browser = browser
 
+    def _record_response(self, response, *args, **kwargs):
+        """Response hook of the session, records the metrics of every response."""
+        metrics.record_response(self.metrics_label, response, time.perf_counter())
+
+    def throttle(self, url, blocking=None):
+        """Take a token from the shared rate limiter (if any) before requesting the url.
+
+        If not blocking, this raises `RateLimited` instead of waiting, so that eg a celery task
+        can be rescheduled for when a token is available. Readers should only do that before the
+        first request of a crawl, later requests should block to not lose the progress.
+        Args:
+            url (str): the url that is going to be requested
+            blocking (bool): whether to wait for a token, defaults to `block_on_rate_limit`
+        Raises:
+            leopard_lavatory.readers.rate_limiter.RateLimited: if not blocking and no token is
+              available
+        """
+        if blocking is None:
+            blocking = self.block_on_rate_limit
+        if self.rate_limiter is not None:
+            started_at = time.perf_counter()
+            self.rate_limiter.acquire(urlsplit(url).hostname, blocking=blocking)
+            metrics.READER_WAIT_SECONDS.labels(self.metrics_label, 'rate_limit').\
+                inc(time.perf_counter() - started_at)
+
+    def request(self, method, url, blocking=None, **kwargs):
+        """Send a request with the session of the browser and the timeout of this reader, after
+        taking a request slot from the upstream health controller and a token from the rate
+        limiter (see `throttle`), if any. The slot is taken first, so that no token is spent on a
+        request that is rejected as the host is busy. The outcome of the request adapts the
+        concurrency limit and the circuit of the host.
+        Args:
+            method (str): http method
+            url (str): the url
+            blocking (bool): whether to wait for a token and a request slot, defaults to
+              `block_on_rate_limit`; an open circuit is never waited for
+            **kwargs: further arguments of `requests.Session.request`, eg data
+        Returns:
+            requests.Response: the response
+        Raises:
+            leopard_lavatory.readers.rate_limiter.RateLimited: if not blocking and no token or
+              request slot is available, or if the circuit of the host is open (as
+              `UpstreamUnavailable`)
+        """
+        if blocking is None:
+            blocking = self.block_on_rate_limit
+        if self.upstream_health is None:
+            self.throttle(url, blocking)
+            return self.browser.session.request(method, url, timeout=self.timeout, **kwargs)
+
+        host = urlsplit(url).hostname
+        lease_id = self.upstream_health.acquire(host, blocking)
+        try:
+            self.throttle(url, blocking)
+        except BaseException:
+            self.upstream_health.release(host, lease_id)
+            raise
+        started_at = time.perf_counter()
+        ok = False
+        try:
+            response = self.browser.session.request(method, url, timeout=self.timeout, **kwargs)
+            ok = response.status_code < 500
+            return response
+        finally:
+            self.upstream_health.record(host, lease_id, time.perf_counter() - started_at, ok)
+
     def random_sleep(self):
-        """Wait random number of seconds to avoid rate-limiting"""
+        """Wait random number of seconds to avoid rate-limiting.
+
+        Readers with a shared rate limiter don't sleep, their requests are spaced out by the rate
+        limiter already.
+        """
+        if self.rate_limiter is not None:
+            return
 
         seconds = random.uniform(1, int(self.avg_delay_seconds) * 2)
         self.log.debug('Waiting {:.2} seconds to avoid rate limiting.'.format(seconds))
         time.sleep(seconds)
+        metrics.READER_WAIT_SECONDS.labels(self.metrics_label, 'sleep').inc(seconds)
 
     def set_avg_delay_seconds(self, avg_delay_seconds):
         """Set the average number of seconds to sleep when calling random_sleep().
@@ -47,3 +139,23 @@ class BaseReader:
             avg_delay_seconds (int): the average delay in seconds
         """
         self.avg_delay_seconds = avg_delay_seconds
+
+    def close(self):
+        """Close the browser session and its connections."""
+        self.browser.close()
+
+    def use_cassette(self, directory, record=False, adapter=None):
+        """Record all responses of this reader to a cassette directory or replay them from there
+        instead of using the network.
+        Args:
+            directory (str): the cassette directory
+            record (bool): True to record the responses, False to replay them
+            adapter (requests.adapters.BaseAdapter): adapter to send the requests with when
+              recording, the default HTTPAdapter if None
+        """
+        if record:
+            transport = RecordingAdapter(directory, adapter)
+        else:
+            transport = ReplayAdapter(directory)
+        for prefix in ('http://', 'https://'):
+            self.browser.session.mount(prefix, transport)
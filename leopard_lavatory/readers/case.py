@@ -0,0 +1,33 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Record type for the cases read from the case search.
+"""
+
+from typing import NamedTuple
+
+
+class Case(NamedTuple):
+    """A case (ärende) from the case search of the stadsbyggnadskontor.
+
+    A tuple instead of a dict per case, which needs less than half of the memory and is sent as a
+    compact array between the tasks (see leopard_lavatory.celery.serialization). The fields can
+    still be read like dict keys, eg case['id'].
+    """
+    id: str
+    fastighet: str
+    type: str
+    description: str
+    date: str
+
+    def __getitem__(self, key):
+        if isinstance(key, str):
+            if key not in self._fields:
+                raise KeyError(key)
+            return getattr(self, key)
+        return tuple.__getitem__(self, key)
+
+    def get(self, key, default=None):
+        """Return the value of a field, or `default` if there is no such field (like dict.get)."""
+        return getattr(self, key) if key in self._fields else default
@@ -0,0 +1,107 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Record/replay transport for the readers.
+
+Transport adapters for the requests session of a reader that write every response to a cassette
+directory, or serve the responses from such a directory instead of the network. Used for offline
+tests and benchmarks of the readers.
+"""
+
+import base64
+import json
+import logging
+import os
+from collections import defaultdict, deque
+
+import requests
+from requests.adapters import BaseAdapter, HTTPAdapter
+
+LOG = logging.getLogger(__name__)
+
+
+class RecordingAdapter(BaseAdapter):
+    """Transport adapter that sends requests with another adapter and records the responses."""
+
+    def __init__(self, directory, adapter=None):
+        """
+        Args:
+            directory (str): cassette directory to write the responses to
+            adapter (requests.adapters.BaseAdapter): adapter that actually sends the requests,
+              a new HTTPAdapter if None
+        """
+        super().__init__()
+        self.directory = directory
+        self.adapter = adapter or HTTPAdapter()
+        os.makedirs(directory, exist_ok=True)
+        self._count = len(os.listdir(directory))
+
+    def send(self, request, **kwargs):
+        response = self.adapter.send(request, **kwargs)
+        record = {'method': request.method,
+                  'url': request.url,
+                  'status_code': response.status_code,
+                  'content_type': response.headers.get('Content-Type', '')}
+        try:
+            record['body'] = response.content.decode('utf-8')
+        except UnicodeDecodeError:
+            record['body_base64'] = base64.b64encode(response.content).decode('ascii')
+
+        path = os.path.join(self.directory, f'{self._count:04}.json')
+        self._count += 1
+        LOG.debug('Recording %s %s to %s', request.method, request.url, path)
+        with open(path, 'w', encoding='utf-8') as file:
+            json.dump(record, file, ensure_ascii=False, indent=1)
+        return response
+
+    def close(self):
+        self.adapter.close()
+
+
+class ReplayAdapter(BaseAdapter):
+    """Transport adapter that serves recorded responses from a cassette directory.
+
+    Responses are served per method and url in the order they were recorded, the last response
+    for a method and url is repeated when all of them have been served (like the search pages
+    repeat the last page of results).
+    """
+
+    def __init__(self, directory):
+        """
+        Args:
+            directory (str): cassette directory to read the responses from
+        """
+        super().__init__()
+        self.directory = directory
+        self._records = defaultdict(deque)
+        for name in sorted(os.listdir(directory)):
+            if name.endswith('.json'):
+                with open(os.path.join(directory, name), encoding='utf-8') as file:
+                    record = json.load(file)
+                self._records[(record['method'], record['url'])].append(record)
+
+    def send(self, request, **kwargs):
+        records = self._records.get((request.method, request.url))
+        if not records:
+            raise requests.exceptions.ConnectionError(
+                f'No recorded response for {request.method} {request.url} in {self.directory}',
+                request=request)
+        record = records.popleft() if len(records) > 1 else records[0]
+
+        response = requests.Response()
+        response.status_code = record['status_code']
+        response.headers['Content-Type'] = record['content_type']
+        if 'body' in record:
+            response._content = record['body'].encode('utf-8')
+            response.encoding = 'utf-8'
+        else:
+            response._content = base64.b64decode(record['body_base64'])
+            response.encoding = requests.utils.get_encoding_from_headers(response.headers)
+        response.url = request.url
+        response.request = request
+        response.reason = 'Replayed'
+        return response
+
+    def close(self):
+        pass
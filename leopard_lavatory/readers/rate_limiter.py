@@ -0,0 +1,180 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Class RateLimiter
+
+Token buckets per host, shared by all readers of all workers through redis (or in-process for
+tests and single process setups).
+"""
+
+import logging
+import os
+import threading
+import time
+
+LOG = logging.getLogger(__name__)
+
+# requests per second and burst size for the hosts we read from, by default one request every
+#  five seconds to insynsbk (like the random sleep of the readers) and one per second to kartor
+DEFAULT_RATES = {
+    'insynsbk.stockholm.se': (0.2, 1),
+    'kartor.stockholm.se': (1.0, 5),
+}
+DEFAULT_RATE = (1.0, 1)
+
+# take one token from the bucket at KEYS[1], refilling it with ARGV[1] tokens per second up to
+#  ARGV[2] tokens; returns the number of seconds to wait for the next token, 0 if one was taken
+TAKE_TOKEN_SCRIPT = """
+local rate = tonumber(ARGV[1])
+local capacity = tonumber(ARGV[2])
+local time = redis.call('TIME')
+local now = tonumber(time[1]) + tonumber(time[2]) / 1000000
+local bucket = redis.call('HMGET', KEYS[1], 'tokens', 'updated')
+local tokens = tonumber(bucket[1]) or capacity
+local updated = tonumber(bucket[2]) or now
+tokens = math.min(capacity, tokens + math.max(0, now - updated) * rate)
+local wait = 0
+if tokens >= 1 then
+    tokens = tokens - 1
+else
+    wait = (1 - tokens) / rate
+end
+redis.call('HSET', KEYS[1], 'tokens', tostring(tokens), 'updated', tostring(now))
+redis.call('EXPIRE', KEYS[1], math.ceil(capacity / rate) + 1)
+return tostring(wait)
+"""
+
+
+class RateLimited(Exception):
+    """Raised by a non-blocking rate limiter if no token is available."""
+
+    def __init__(self, host, retry_after):
+        super().__init__(f'Rate limit for {host} reached, retry after {retry_after:.2f} seconds')
+        self.host = host
+        self.retry_after = retry_after
+
+
+class MemoryBucketBackend:
+    """Token buckets in the memory of this process."""
+
+    def __init__(self, clock=time.monotonic):
+        self.clock = clock
+        self._buckets = {}
+        self._lock = threading.Lock()
+
+    def take(self, key, rate, capacity):
+        """Take a token from the bucket `key`.
+        Args:
+            key (str): name of the bucket
+            rate (float): tokens added to the bucket per second
+            capacity (int): maximum number of tokens in the bucket
+        Returns:
+            float: seconds to wait until a token is available, 0 if a token was taken
+        """
+        with self._lock:
+            now = self.clock()
+            tokens, updated = self._buckets.get(key, (capacity, now))
+            tokens = min(capacity, tokens + max(0, now - updated) * rate)
+            wait = 0
+            if tokens >= 1:
+                tokens -= 1
+            else:
+                wait = (1 - tokens) / rate
+            self._buckets[key] = (tokens, now)
+            return wait
+
+
+class RedisBucketBackend:
+    """Token buckets in redis, shared by all processes using the same redis server."""
+
+    key_prefix = 'leopard_lavatory:rate_limit:'
+
+    def __init__(self, redis_client):
+        self.redis = redis_client
+        self._take_token = redis_client.register_script(TAKE_TOKEN_SCRIPT)
+
+    def take(self, key, rate, capacity):
+        """Take a token from the bucket `key`, see `MemoryBucketBackend.take`."""
+        return float(self._take_token(keys=[self.key_prefix + key], args=[rate, capacity]))
+
+
+class RateLimiter:
+    """Rate limit requests per host with token buckets."""
+
+    def __init__(self, backend, rates=None, default_rate=DEFAULT_RATE):
+        """
+        Args:
+            backend (Union[MemoryBucketBackend, RedisBucketBackend]): where the buckets are kept
+            rates (dict): requests per second and burst size (as tuple) per host name
+            default_rate (Tuple[float, int]): requests per second and burst size for other hosts
+        """
+        self.backend = backend
+        self.rates = dict(DEFAULT_RATES if rates is None else rates)
+        self.default_rate = default_rate
+
+    def try_acquire(self, host):
+        """Take a token for a request to `host` if one is available.
+        Args:
+            host (str): host name
+        Returns:
+            float: seconds to wait until a token is available, 0 if a token was taken
+        """
+        rate, capacity = self.rates.get(host, self.default_rate)
+        return self.backend.take(host, rate, capacity)
+
+    def acquire(self, host, blocking=True):
+        """Take a token for a request to `host`, waiting for it if necessary.
+        Args:
+            host (str): host name
+            blocking (bool): whether to wait for a token or raise `RateLimited` instead
+        Raises:
+            RateLimited: if not blocking and no token is available
+        """
+        while True:
+            wait = self.try_acquire(host)
+            if not wait:
+                return
+            if not blocking:
+                raise RateLimited(host, wait)
+            LOG.debug('Waiting {:.2} seconds for rate limit of {}.'.format(wait, host))
+            time.sleep(wait)
+
+
+def parse_rates(rates_string):
+    """Parse per host rates from a string like "insynsbk.stockholm.se=0.2:1,kartor.stockholm.se=1".
+    Args:
+        rates_string (str): comma separated host=rate[:burst] entries
+    Returns:
+        dict: requests per second and burst size (as tuple) per host name
+    """
+    rates = {}
+    for entry in filter(None, (entry.strip() for entry in rates_string.split(','))):
+        host, _, rate = entry.partition('=')
+        rate, _, burst = rate.partition(':')
+        rates[host] = (float(rate), int(burst or 1))
+    return rates
+
+
+_rate_limiter = None
+
+
+def get_rate_limiter():
+    """Return the rate limiter shared by the readers of this process, configured by the
+    environment variables RATE_LIMIT_REDIS_URL (a redis url or "memory", default is the local
+    redis also used as celery broker) and RATE_LIMITS (see `parse_rates`).
+    Returns:
+        RateLimiter: the rate limiter
+    """
+    global _rate_limiter
+    if _rate_limiter is None:
+        redis_url = os.environ.get('RATE_LIMIT_REDIS_URL', 'redis://localhost:6379')
+        if redis_url == 'memory':
+            backend = MemoryBucketBackend()
+        else:
+            import redis
+            backend = RedisBucketBackend(redis.Redis.from_url(redis_url))
+        rates = dict(DEFAULT_RATES)
+        rates.update(parse_rates(os.environ.get('RATE_LIMITS', '')))
+        _rate_limiter = RateLimiter(backend, rates)
+    return _rate_limiter
@@ -0,0 +1,113 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Class ReaderPool.
+
+Keeps readers (their browser session with cookies, open connections and form state) for reuse by
+the following crawls of the same process, instead of starting every crawl with a cold session.
+"""
+
+import logging
+import threading
+import time
+from contextlib import contextmanager
+
+from leopard_lavatory.readers.rate_limiter import RateLimited
+
+LOG = logging.getLogger(__name__)
+
+
+class ReaderPool:
+    """Idle readers of a process, checked out by one crawl at a time.
+
+    A checkout takes the most recently used idle reader or creates a new one if there is none, so
+    it never blocks. Readers that were idle for longer than `max_idle` (their server session has
+    probably expired) or that were used `max_uses` times are closed instead of being reused, and
+    so are readers whose crawl failed, as their state is unknown.
+    """
+
+    def __init__(self, create_reader, size=2, max_idle=600, max_uses=1000):
+        """
+        Args:
+            create_reader (Callable[[], BaseReader]): creates a new reader
+            size (int): maximum number of idle readers kept
+            max_idle (float): seconds after which an idle reader is closed
+            max_uses (int): number of checkouts after which a reader is closed
+        """
+        self.create_reader = create_reader
+        self.size = size
+        self.max_idle = max_idle
+        self.max_uses = max_uses
+        # (reader, number of uses, time of the last checkin), the most recently used last
+        self._idle = []
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._idle)
+
+    def warm(self, num_readers=1):
+        """Create readers up front, eg when a worker process starts.
+        Args:
+            num_readers (int): number of readers to create, at most `size`
+        """
+        readers = [self.create_reader() for _ in range(min(num_readers, self.size))]
+        with self._lock:
+            self._idle.extend((reader, 0, time.monotonic()) for reader in readers)
+
+    def evict_idle(self):
+        """Close the readers that were idle for longer than `max_idle`.
+        Returns:
+            int: number of closed readers
+        """
+        deadline = time.monotonic() - self.max_idle
+        with self._lock:
+            expired = [reader for reader, uses, last_used in self._idle if last_used < deadline]
+            self._idle = [entry for entry in self._idle if entry[2] >= deadline]
+        for reader in expired:
+            reader.close()
+        return len(expired)
+
+    @contextmanager
+    def checkout(self):
+        """Check out a reader for a crawl and check it back in afterwards.
+
+        Usage:
+            with pool.checkout() as reader:
+                cases = reader.get_cases(address)
+        """
+        self.evict_idle()
+        with self._lock:
+            reader, uses, _ = self._idle.pop() if self._idle else (None, 0, None)
+        if reader is None:
+            LOG.debug('Creating a new reader')
+            reader = self.create_reader()
+
+        try:
+            yield reader
+        except RateLimited:
+            # raised before a request, the reader is still fine
+            self._checkin(reader, uses + 1)
+            raise
+        except BaseException:
+            reader.close()
+            raise
+        else:
+            self._checkin(reader, uses + 1)
+
+    def _checkin(self, reader, uses):
+        if uses >= self.max_uses:
+            reader.close()
+            return
+        with self._lock:
+            if len(self._idle) < self.size:
+                self._idle.append((reader, uses, time.monotonic()))
+                return
+        reader.close()
+
+    def close(self):
+        """Close all idle readers."""
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for reader, uses, last_used in idle:
+            reader.close()
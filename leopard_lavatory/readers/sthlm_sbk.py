@@ -7,141 +7,457 @@ Class SBKReader.
 Reading from Stockholms Stadsbyggndskontor website.
 """
 
+import logging
+import os
+import time
+from urllib.parse import urljoin
+
+import lxml.html
+import requests
+
 from leopard_lavatory.readers.base_reader import BaseReader
+from leopard_lavatory.readers.case import Case
+from leopard_lavatory.utils import metrics
+
+LOG = logging.getLogger(__name__)
+
+# number of tries of a result page before a crawl fails, and the seconds to wait before the second
+#  try (doubled before every following one)
+PAGE_ATTEMPTS = 3
+PAGE_RETRY_SECONDS = 2
+
+
+def parse_html(content, encoding=None):
+    """Parse a html page with lxml.
+    Args:
+        content (Union[bytes, str]): the html page
+        encoding (str): encoding of the page (eg from the http headers), None to detect it from
+          the page itself
+    Returns:
+        lxml.html.HtmlElement: the root element of the page
+    """
+    parser = lxml.html.HTMLParser(encoding=encoding) if encoding and \
+        isinstance(content, bytes) else None
+    return lxml.html.document_fromstring(content, parser=parser)
+
+
+def parse_case_grid(page):
+    """Parse the page for a result table and return the table content as cases.
+
+    Only rows that contain a cell of the case grid are looked at, and their cells are read
+    directly from the lxml tree.
+    Args:
+        page (lxml.html.HtmlElement): lxml representation of the page
+    Returns:
+        list[Case]: a list of the cases
+    """
+    cases = []
+    for row in page.xpath('//tr[td[contains(@class, "DataGridItemCell")]]'):
+        cells = row.xpath('.//td')
+        # use only rows with 5 columns and a specific class to distinguish them from other table
+        #  elements
+        if len(cells) == 5 and cells[0].get('class', '').split() == ['DataGridItemCell']:
+            case_id = cells[0].xpath('.//a')[0].text_content()
+            LOG.debug('Found case with ID: %s', case_id)
+            case = Case(id=case_id,
+                        fastighet=cells[1].text_content().strip(),
+                        type=cells[2].text_content().strip(),
+                        description=cells[3].text_content().strip(),
+                        date=cells[4].text_content().strip())
+            cases.append(case)
+
+    return cases
+
+
+def find_form(page, form_id):
+    """Find a form by id.
+    Args:
+        page (lxml.html.HtmlElement): lxml representation of the page
+        form_id (str): id of the form element
+    Returns:
+        Optional[lxml.html.FormElement]: the form, None if there is no such form on the page
+    """
+    forms = page.xpath('//form[@id=$form_id]', form_id=form_id)
+    return forms[0] if forms else None
+
+
+def extract_form_fields(form):
+    """Collect the values a browser would submit for the given form, except for submit buttons.
+
+    This is what is needed to post back to an ASP.NET page (__VIEWSTATE, __EVENTVALIDATION and
+    the other hidden and visible inputs) without a stateful browser.
+    Args:
+        form (lxml.html.FormElement): the form element
+    Returns:
+        dict: field names and values
+    """
+    fields = {}
+    for element in form.xpath('.//input[@name] | .//textarea[@name] | .//select[@name]'):
+        if 'disabled' in element.attrib:
+            continue
+        name = element.get('name')
+        if element.tag == 'input':
+            input_type = element.get('type', '').lower()
+            if input_type in ('submit', 'image', 'button', 'reset', 'file'):
+                continue
+            if input_type in ('radio', 'checkbox'):
+                if 'checked' not in element.attrib:
+                    continue
+                fields[name] = element.get('value', 'on')
+            else:
+                fields[name] = element.get('value', '')
+        elif element.tag == 'textarea':
+            fields[name] = element.text_content()
+        else:
+            # like browsers, use the last selected option or the first option if none is selected
+            options = element.xpath('.//option')
+            selected = [option for option in options if 'selected' in option.attrib]
+            option = selected[-1] if selected else next(iter(options), None)
+            if option is not None:
+                fields[name] = option.get('value', option.text_content())
+    return fields
+
+
+def case_sort_key(case_id):
+    """Turn a case id (diarienummer) like "2008-09960" into a key that sorts cases by year and
+    then by sequence number.
+    Args:
+        case_id (str): the case id
+    Returns:
+        Optional[Tuple[int, int]]: year and sequence number, None if the case id has another format
+    """
+    year, _, number = str(case_id or '').strip().partition('-')
+    if year.isdigit() and number.isdigit():
+        return int(year), int(number)
+    return None
+
+
+def take_new_cases(cases, previous_case_ids, newer_than_case=None, newer_than_date=None):
+    """Decide which cases of a result page are new and whether to stop paginating.
+
+    The results are ordered from the newest to the oldest case. We stop at the first case that is
+    not newer than the `newer_than_case` (by year and sequence number of the diarienummer, so
+    this also works if that case was withdrawn or renumbered), at the first case older than
+    `newer_than_date`, or when a page repeats the previous one (requesting the page after the
+    last page returns the last page again).
+    Args:
+        cases (list[Case]): the cases of the current page
+        previous_case_ids (set): the case ids of the previous page
+        newer_than_case (str): case id where to stop the backward search
+        newer_than_date (str): date (YYYY-MM-DD) where to stop the backward search
+    Returns:
+        Tuple[list[Case], bool]: the new cases of this page and whether to stop
+    """
+    if set(case['id'] for case in cases) == previous_case_ids:
+        return [], True
+
+    watermark = case_sort_key(newer_than_case)
+
+    new_cases = []
+    for case in cases:
+        if case['id'] == newer_than_case:
+            return new_cases, True
+        case_key = case_sort_key(case['id'])
+        if watermark is not None and case_key is not None and case_key <= watermark:
+            return new_cases, True
+        if newer_than_date is not None and case['date'] < newer_than_date:
+            return new_cases, True
+        new_cases.append(case)
+
+    return new_cases, False
 
 
 class SBKReader(BaseReader):
     """Reader for the website of the Stockholm stadsbyggnadskontor (insynsbk.stockholm.se)."""
 
-    url = 'http://insynsbk.stockholm.se/Byggochplantjansten/Arenden/'
-    form_name = '#aspnetForm'
+    # can be overridden, eg to point the readers at a local stand-in for load tests
+    url = os.environ.get('SBK_URL', 'http://insynsbk.stockholm.se/Byggochplantjansten/Arenden/')
+    form_id = 'aspnetForm'
     field_name_prefix = 'ctl00$FullContentRegion$ContentRegion$SecondaryContentRegion$'
     event_target_field_name = 'CaseList$CaseGrid'
     address_field_name = 'SearchPropertyAndCase$SearchProperty$AddressInput'
     fastighetsbeteckning_field_name = 'SearchPropertyAndCase$SearchProperty$PropertyIdInput'
     search_button_name = 'SearchPropertyAndCase$SearchButton'
     search_button_value = 'Sök'
+    # address query used for city wide sweeps, an empty address matches all cases
+    sweep_query_value = ''
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # url and fields of the form of the last page (viewstate, event validation, ...), reused
+        #  for the next search or page in the same session
+        self.form_url = None
+        self.form_fields = None
+        # page number and case ids of the last page of the running crawl, see `checkpoint`
+        self._crawl_position = (0, set())
+
+    def _update_form_state(self, response):
+        """Parse the response and remember its form state.
+        Args:
+            response (requests.Response): response with a page containing the search form
+        Returns:
+            lxml.html.HtmlElement: the parsed page, None if the page doesn't contain the search
+              form
+        """
+        with metrics.READER_PARSE_SECONDS.labels(self.metrics_label, 'html').time():
+            content_type = response.headers.get('Content-Type', '')
+            page = parse_html(response.content,
+                              response.encoding if 'charset' in content_type else None)
+            form = find_form(page, self.form_id)
+            if response.status_code >= 400 or form is None:
+                return None
+
+            self.log.debug('Got page with title "%s"', page.findtext('.//title', '').strip())
+            self.form_url = urljoin(response.url, form.get('action'))
+            self.form_fields = extract_form_fields(form)
+            return page
 
     def parse_page(self, page):
-        """Parse the page for a result table and return the table content in json friendly format.
+        """Parse the page for a result table and return the table content as cases.
         Args:
-            page (bs4.BeautifulSoup): BeautifulSoup object representation of the page
+            page (lxml.html.HtmlElement): lxml representation of the page
         Returns:
-            list[dict]: a list of the cases, each case is represented as a dict
+            list[Case]: a list of the cases
         """
-        all_rows = page.find_all('tr')
-
-        cases = []
-        for row in all_rows:
-            cells = row.find_all('td')
-            # use only rows with 5 columns and a specific class to distinguish them from other table
-            #  elements
-            if len(cells) == 5 and cells[0].get('class') == ['DataGridItemCell']:
-                case_id = cells[0].find_all('a')[0].string
-                self.log.debug('Found case with ID: %s', case_id)
-                case = {'id': case_id,
-                        'fastighet': cells[1].string.strip(),
-                        'type': cells[2].string.strip(),
-                        'description': cells[3].string.strip(),
-                        'date': cells[4].string.strip()}
-                cases.append(case)
-
-        return cases
+        with metrics.READER_PARSE_SECONDS.labels(self.metrics_label, 'cases').time():
+            return parse_case_grid(page)
 
-    def get_first_page(self, address_query_value):
-        """Requests the search page and issues a query with the given values. Returns the cases
-        found on the first page of results.
+    def open_search_form(self, blocking=None):
+        """Request the page with the search form and remember its form state.
         Args:
-            address_query_value (str): the address query string
+            blocking (bool): whether to wait for the rate limiter, see `request`
+        """
+        self.log.debug('Requesting %s', self.url)
+        response = self.request('GET', self.url, blocking)
+        response.raise_for_status()
+        if self._update_form_state(response) is None:
+            raise ValueError(f'No search form found on {self.url}')
+
+    def _post_form(self, extra_fields, blocking=None):
+        """Post back the remembered form state with the given additional fields.
+        Args:
+            extra_fields (dict): fields to add to or override in the form
+            blocking (bool): whether to wait for the rate limiter, see `request`
         Returns:
-            list[dict]: a list of the cases, each case is represented as a dict
+            lxml.html.HtmlElement: the resulting page, None if the server rejected the form state
+        Raises:
+            requests.HTTPError: if the server is unavailable
         """
+        fields = dict(self.form_fields)
+        fields.update(extra_fields)
+        response = self.request('POST', self.form_url, blocking, data=fields)
+        # a rejected form state is answered with 500, an overloaded server with one of these
+        if response.status_code in (502, 503, 504):
+            response.raise_for_status()
+        return self._update_form_state(response)
 
-        # requesting page with search form
-        self.log.debug('Requesting %s', self.url)
-        self.browser.open(self.url)
-        current_page = self.browser.get_current_page()
-        self.log.debug('Got page with title "%s"', current_page.title.text.strip())
+    def get_first_page(self, address_query_value):
+        """Issues a query with the given values and returns the cases found on the first page of
+        results.
 
-        # fill form
-        self.browser.select_form(self.form_name)
-        self.browser[self.field_name_prefix + self.address_field_name] = address_query_value
+        The form state of the previous search in this reader (and the session cookies and
+        connections) is reused, so the page with the search form is only requested for the first
+        search or when the server rejects the old form state.
+        Args:
+            address_query_value (str): the address query string
+        Returns:
+            list[Case]: a list of the cases
+        """
+        reused_form_state = self.form_fields is not None
+        if not reused_form_state:
+            self.open_search_form()
 
-        # get form to add the search_button key value pair (stupid ASP.NET)
-        form = self.browser.get_current_form()
-        form.new_control('input', self.field_name_prefix + self.search_button_name,
-                         self.search_button_value)
+        # fill form and add the search_button key value pair (stupid ASP.NET)
+        search_fields = {'__EVENTTARGET': '',
+                         '__EVENTARGUMENT': '',
+                         self.field_name_prefix + self.address_field_name: address_query_value,
+                         self.field_name_prefix + self.search_button_name:
+                             self.search_button_value}
 
         # send search request
         self.log.debug('Requesting first page of search results for address %s',
                        address_query_value)
-        self.browser.submit_selected()
+        current_page = self._post_form(search_fields,
+                                       blocking=True if not reused_form_state else None)
+
+        if current_page is None and reused_form_state:
+            self.log.info('Search form state was rejected, requesting a new one')
+            self.open_search_form(blocking=True)
+            current_page = self._post_form(search_fields, blocking=True)
 
-        current_page = self.browser.get_current_page()
-        self.log.debug('Got page with title "%s"', current_page.title.text.strip())
+        if current_page is None:
+            raise ValueError(f'Search for {address_query_value} was rejected by {self.form_url}')
 
         return self.parse_page(current_page)
 
-    def get_next_page(self):
-        """Request the next result page and return cases found on that.
+    def _post_page(self, event_argument):
+        """Post a pager event of the result grid and return the cases found on the resulting page.
+        Args:
+            event_argument (str): "Page$Next" or "Page$<number>"
         Returns:
-            list[dict]: a list of the cases, each case is represented as a dict
+            list[Case]: a list of the cases
         """
+        current_page = self._post_form({'__EVENTTARGET': self.field_name_prefix +
+                                                          self.event_target_field_name,
+                                        '__EVENTARGUMENT': event_argument},
+                                       blocking=True)
+        if current_page is None:
+            raise ValueError(f'Request for page {event_argument} was rejected by {self.form_url}')
 
-        self.browser.select_form(self.form_name)
-
-        self.browser.new_control('hidden', '__EVENTTARGET', self.field_name_prefix +
-                                 self.event_target_field_name)
-        self.browser.new_control('hidden', '__EVENTARGUMENT', 'Page$Next')
+        return self.parse_page(current_page)
 
+    def get_next_page(self):
+        """Request the next result page and return cases found on that.
+        Returns:
+            list[Case]: a list of the cases
+        """
         self.log.info('Requesting next page of search results')
-        self.browser.submit_selected()
-
-        current_page = self.browser.get_current_page()
-        self.log.debug('Got page with title "%s"', current_page.title.text.strip())
+        return self._post_page('Page$Next')
 
-        return self.parse_page(current_page)
+    def get_page(self, page_number):
+        """Jump to a result page of the current search and return the cases found on that.
+        Args:
+            page_number (int): number of the page, counted from 1
+        Returns:
+            list[Case]: a list of the cases
+        """
+        self.log.info('Requesting page %s of search results', page_number)
+        return self._post_page(f'Page${page_number}')
 
-    def get_cases(self, address_query_value, newer_than_case=None):
-        """Get all cases newer than the case id provided in `newer_than_case`
-        (diarienummer). This traverses arbitrarily many pages until the `newer_than_case` is
-        found or all cases have been listed.
+    def _get_page_with_retry(self, address_query_value, page_number):
+        """Request the next result page, retrying with backoff on errors. A retry searches again
+        and jumps to the page, in case the session and its form state were lost.
+        Args:
+            address_query_value (str): address query string of the crawl
+            page_number (int): number of the next page, counted from 1
+        Returns:
+            list[Case]: a list of the cases
+        """
+        for attempt in range(1, PAGE_ATTEMPTS + 1):
+            try:
+                if attempt == 1:
+                    return self.get_next_page()
+                self.get_first_page(address_query_value)
+                return self.get_page(page_number)
+            except (requests.RequestException, ValueError) as error:
+                if attempt == PAGE_ATTEMPTS:
+                    raise
+                self.log.warning('Request for page %s failed (%s), attempt %s of %s', page_number,
+                                 error, attempt, PAGE_ATTEMPTS)
+                # a rejected form state is replaced right away, errors of the server are waited out
+                if attempt > 1 or not isinstance(error, ValueError):
+                    seconds = PAGE_RETRY_SECONDS * 2 ** (attempt - 1)
+                    time.sleep(seconds)
+                    metrics.READER_WAIT_SECONDS.labels(self.metrics_label, 'backoff').inc(seconds)
+
+    def checkpoint(self):
+        """Return the state of the running `iter_pages` crawl after the page it yielded last, to
+        continue the crawl from there, also in another reader or process.
+        Returns:
+            dict: json serializable crawl state
+        """
+        page_number, case_ids = self._crawl_position
+        return {'page': page_number,
+                'case_ids': sorted(case_ids),
+                'form_url': self.form_url,
+                'form_fields': self.form_fields,
+                'cookies': [[cookie.name, cookie.value, cookie.domain, cookie.path]
+                            for cookie in self.browser.session.cookies]}
+
+    def _restore(self, checkpoint):
+        """Take over the session cookies and form state of a checkpoint, see `checkpoint`."""
+        self.form_url = checkpoint['form_url']
+        self.form_fields = checkpoint['form_fields']
+        for name, value, domain, path in checkpoint['cookies']:
+            self.browser.session.cookies.set(name, value, domain=domain, path=path)
+
+    def iter_pages(self, address_query_value, newer_than_case=None, newer_than_date=None,
+                   checkpoint=None):
+        """Generate the new cases page by page, newer than the case id provided in
+        `newer_than_case` (diarienummer) and the date in `newer_than_date`. The next page is only
+        requested when the previous one has been consumed, so callers can process the cases
+        while the crawl is running, with only one page in memory.
+
+        Failed page requests are retried with backoff. If the crawl fails anyway, it can be
+        continued after the last processed page by passing the `checkpoint` taken after that
+        page. The pages may have moved by the cases that were added since, which only repeats
+        some cases, as the new cases are added at the top.
         Args:
             address_query_value (str): address query string
             newer_than_case (str): case id where to stop the backward search
-        Returns:
-            list[dict]: a list of the cases, each case is represented as a dict
+            newer_than_date (str): date (YYYY-MM-DD) where to stop the backward search
+            checkpoint (dict): state of the crawl to continue, see `checkpoint`
+        Yields:
+            list[Case]: the new cases of a page, newest first (pages without new cases are
+              skipped)
         """
-
-        cases = self.get_first_page(address_query_value)
-        self.log.debug('[1] found %s cases', len(cases))
-
-        result_cases = []
-
         # set to save ids of previous page, to detect whether we reached the last page
         # (when visiting the next page of the last page, we get the same results)
-        previous_case_ids = set()
+        if checkpoint is None:
+            page_number = 1
+            previous_case_ids = set()
+            cases = self.get_first_page(address_query_value)
+        else:
+            self.log.info('Continuing search for %s after page %s', address_query_value,
+                          checkpoint['page'])
+            self._restore(checkpoint)
+            page_number = checkpoint['page'] + 1
+            previous_case_ids = set(checkpoint['case_ids'])
+            cases = self._get_page_with_retry(address_query_value, page_number)
 
         while True:
-            new_case_ids = set([case['id'] for case in cases])
-
-            # stop if we don't get new cases
-            if new_case_ids == previous_case_ids:
-                return result_cases
-
-            # read cases into result
-            for case in cases:
-                if case['id'] == newer_than_case:
-                    # if we reached the newer_than_case, don't continue
-                    return result_cases
-                else:
-                    result_cases.append(case)
+            self.log.debug('[%s] found %s cases', page_number, len(cases))
+            new_cases, done = take_new_cases(cases, previous_case_ids, newer_than_case,
+                                             newer_than_date)
+            # update state
+            previous_case_ids = set(case['id'] for case in cases)
+            self._crawl_position = (page_number, previous_case_ids)
+            if new_cases:
+                yield new_cases
+            if done:
+                return
 
             self.random_sleep()
 
             # proceed to next page
-            cases = self.get_next_page()
-            self.log.debug('found %s cases', len(cases))
+            page_number += 1
+            cases = self._get_page_with_retry(address_query_value, page_number)
 
-            # update state
-            previous_case_ids = new_case_ids
+    def iter_cases(self, address_query_value, newer_than_case=None, newer_than_date=None):
+        """Generate the new cases one by one, newest first, see `iter_pages`.
+        Args:
+            address_query_value (str): address query string
+            newer_than_case (str): case id where to stop the backward search
+            newer_than_date (str): date (YYYY-MM-DD) where to stop the backward search
+        Yields:
+            Case: a case
+        """
+        for cases in self.iter_pages(address_query_value, newer_than_case, newer_than_date):
+            yield from cases
+
+    def get_cases(self, address_query_value, newer_than_case=None, newer_than_date=None):
+        """Get all cases newer than the case id provided in `newer_than_case`
+        (diarienummer) and the date in `newer_than_date`. This traverses the pages until the
+        first older case is found or all cases have been listed.
+        Args:
+            address_query_value (str): address query string
+            newer_than_case (str): case id where to stop the backward search
+            newer_than_date (str): date (YYYY-MM-DD) where to stop the backward search
+        Returns:
+            list[Case]: a list of the cases
+        """
+        return list(self.iter_cases(address_query_value, newer_than_case, newer_than_date))
+
+    def get_recent_cases(self, newer_than_case=None, newer_than_date=None):
+        """Get the most recent cases of the whole city, newer than the case id provided in
+        `newer_than_case` (diarienummer) and the date in `newer_than_date`. Without any of
+        them only the first page is returned, to avoid crawling the complete history of the city.
+        Args:
+            newer_than_case (str): case id where to stop the backward search
+            newer_than_date (str): date (YYYY-MM-DD) where to stop the backward search
+        Returns:
+            list[Case]: a list of the cases
+        """
+        if newer_than_case is None and newer_than_date is None:
+            return self.get_first_page(self.sweep_query_value)
+        return self.get_cases(self.sweep_query_value, newer_than_case, newer_than_date)
@@ -0,0 +1,179 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Class AsyncSBKReader.
+
+Reading from Stockholms Stadsbyggndskontor website with asyncio, running many address searches
+concurrently on one event loop.
+"""
+
+import asyncio
+import logging
+import random
+from urllib.parse import urljoin, urlsplit
+
+import aiohttp
+
+from leopard_lavatory.readers.sthlm_sbk import SBKReader, extract_form_fields, find_form, \
+    parse_case_grid, parse_html, take_new_cases
+
+
+class AsyncSBKReader:
+    """Asyncio reader for the website of the Stockholm stadsbyggnadskontor
+    (insynsbk.stockholm.se).
+
+    Every search gets its own cookie jar (and with it its own ASP.NET session), while all
+    searches share one connection pool. The number of concurrent requests per host is limited by
+    `max_per_host`.
+    """
+
+    url = SBKReader.url
+    form_id = SBKReader.form_id
+    field_name_prefix = SBKReader.field_name_prefix
+    event_target_field_name = SBKReader.event_target_field_name
+    address_field_name = SBKReader.address_field_name
+    search_button_name = SBKReader.search_button_name
+    search_button_value = SBKReader.search_button_value
+
+    def __init__(self, max_per_host=4, avg_delay_seconds=5, timeout_seconds=60,
+                 user_agent_string='Mozilla/5.0 (Windows; U; Windows NT 6.0; en-US; rv:1.9.0.6',
+                 rate_limiter=None):
+        self.max_per_host = max_per_host
+        self.rate_limiter = rate_limiter
+        self.avg_delay_seconds = avg_delay_seconds
+        self.timeout = aiohttp.ClientTimeout(total=timeout_seconds)
+        self.headers = {'User-Agent': user_agent_string}
+        self.log = logging.getLogger(self.__class__.__name__)
+        self._semaphores = {}
+
+    def _host_semaphore(self, url):
+        """Return the semaphore limiting the concurrent requests to the host of the url."""
+        host = urlsplit(url).hostname
+        if host not in self._semaphores:
+            self._semaphores[host] = asyncio.Semaphore(self.max_per_host)
+        return self._semaphores[host]
+
+    async def throttle(self, url):
+        """Wait for a token of the shared rate limiter (if any), without blocking the loop."""
+        if self.rate_limiter is None:
+            return
+        host = urlsplit(url).hostname
+        wait = self.rate_limiter.try_acquire(host)
+        while wait:
+            await asyncio.sleep(wait)
+            wait = self.rate_limiter.try_acquire(host)
+
+    async def random_sleep(self):
+        """Wait random number of seconds to avoid rate-limiting, without blocking the loop.
+        Not needed with a shared rate limiter."""
+        if self.rate_limiter is not None:
+            return
+        seconds = random.uniform(1, int(self.avg_delay_seconds) * 2)
+        self.log.debug('Waiting {:.2} seconds to avoid rate limiting.'.format(seconds))
+        await asyncio.sleep(seconds)
+
+    async def _request(self, session, method, url, data=None):
+        """Send a request and return the url of the response and the parsed page.
+        Returns:
+            Tuple[str, lxml.html.HtmlElement]: the (possibly redirected) url and the parsed page
+        """
+        await self.throttle(url)
+        async with self._host_semaphore(url):
+            async with session.request(method, url, data=data) as response:
+                response.raise_for_status()
+                body = await response.text()
+                response_url = str(response.url)
+
+        page = parse_html(body)
+        self.log.debug('Got page with title "%s"', page.findtext('.//title', '').strip())
+        return response_url, page
+
+    async def _post_back(self, session, page_url, page, extra_fields):
+        """Submit the ASP.NET form of the page with the given additional fields."""
+        form = find_form(page, self.form_id)
+        fields = extract_form_fields(form)
+        fields.update(extra_fields)
+        return await self._request(session, 'POST', urljoin(page_url, form.get('action')), fields)
+
+    async def get_cases(self, address_query_value, newer_than_case=None, newer_than_date=None,
+                        connector=None):
+        """Get all cases newer than the case id provided in `newer_than_case`
+        (diarienummer) and the date in `newer_than_date`, see `SBKReader.get_cases`.
+        Args:
+            address_query_value (str): address query string
+            newer_than_case (str): case id where to stop the backward search
+            newer_than_date (str): date (YYYY-MM-DD) where to stop the backward search
+            connector (aiohttp.BaseConnector): connection pool to use, a new one if None
+        Returns:
+            list[Case]: a list of the cases
+        """
+        async with aiohttp.ClientSession(connector=connector,
+                                         connector_owner=connector is None,
+                                         cookie_jar=aiohttp.CookieJar(),
+                                         headers=self.headers,
+                                         timeout=self.timeout) as session:
+            self.log.debug('Requesting %s', self.url)
+            page_url, page = await self._request(session, 'GET', self.url)
+
+            self.log.debug('Requesting first page of search results for address %s',
+                           address_query_value)
+            page_url, page = await self._post_back(session, page_url, page, {
+                self.field_name_prefix + self.address_field_name: address_query_value,
+                self.field_name_prefix + self.search_button_name: self.search_button_value,
+            })
+            cases = parse_case_grid(page)
+
+            result_cases = []
+            previous_case_ids = set()
+
+            while True:
+                new_cases, done = take_new_cases(cases, previous_case_ids, newer_than_case,
+                                                 newer_than_date)
+                result_cases.extend(new_cases)
+                if done:
+                    return result_cases
+
+                await self.random_sleep()
+
+                previous_case_ids = set(case['id'] for case in cases)
+
+                self.log.info('Requesting next page of search results')
+                page_url, page = await self._post_back(session, page_url, page, {
+                    '__EVENTTARGET': self.field_name_prefix + self.event_target_field_name,
+                    '__EVENTARGUMENT': 'Page$Next',
+                })
+                cases = parse_case_grid(page)
+
+    async def get_cases_for_addresses(self, queries):
+        """Run the searches for many addresses concurrently.
+        Args:
+            queries (Iterable[Tuple[str, str, str]]): address query string, `newer_than_case`
+              and `newer_than_date` (both may be None) per search
+        Returns:
+            list[Union[list[Case], Exception]]: the cases for every query in the same order, or
+              the exception if the search failed
+        """
+        connector = aiohttp.TCPConnector(limit_per_host=self.max_per_host)
+        try:
+            return await asyncio.gather(
+                *(self.get_cases(address, newer_than_case, newer_than_date, connector)
+                  for address, newer_than_case, newer_than_date in queries),
+                return_exceptions=True)
+        finally:
+            await connector.close()
+
+    def run(self, queries):
+        """Blocking wrapper around `get_cases_for_addresses`, eg to be used from a celery task.
+        Args:
+            queries (Iterable[Tuple[str, str, str]]): address query string, `newer_than_case`
+              and `newer_than_date` per search, see `get_cases_for_addresses`
+        Returns:
+            list[Union[list[Case], Exception]]: the cases for every query in the same order
+        """
+        # a new loop per run, as there is no asyncio.run before python 3.7
+        loop = asyncio.new_event_loop()
+        try:
+            return loop.run_until_complete(self.get_cases_for_addresses(queries))
+        finally:
+            loop.close()
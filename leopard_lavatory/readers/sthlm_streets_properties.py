@@ -8,11 +8,95 @@ Crawling a list of all street addresses and fastighet names from kartor.stockhol
 """
 import json
 import logging
+import threading
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
 
 from leopard_lavatory.readers.base_reader import BaseReader
 
 LOG = logging.getLogger(__name__)
 
+# first letters of all street addresses and fastighet names
+ALPHABET = 'ABCDEFGHIJKLMNOPQRSTUVWXYZÅÄÖ'
+# characters appended to a prefix with too many results to split it into longer prefixes
+SPLIT_CHARACTERS = 'abcdefghijklmnopqrstuvwxyzåäöéü0123456789 -:.'
+# max number of suggestions requested per prefix
+MAX_ROWS = 10000
+# prefixes are not split beyond this length, to not loop on entries that are prefixes of many
+#  other entries
+MAX_PREFIX_LENGTH = 40
+
+
+def split_prefix(prefix):
+    """Split a prefix with too many results into the longer prefixes that cover its results,
+    eg "Br" into "Bra", "Brb", ..., "Br9", "Br ", ...
+    Args:
+        prefix (str): the saturated prefix
+    Returns:
+        List[str]: the longer prefixes
+    """
+    return [prefix + character for character in SPLIT_CHARACTERS]
+
+
+def crawl_all(prefixes, store, create_reader, num_workers=4, max_rows=MAX_ROWS,
+              max_prefix_length=MAX_PREFIX_LENGTH):
+    """Crawl the suggestions for all prefixes in parallel, splitting every prefix that returns
+    `max_rows` suggestions (and probably missed some) into longer prefixes.
+
+    Every worker thread uses its own reader, the requests of all readers should be spaced out by
+    a shared rate limiter. The results are handed to `store` in the calling thread as soon as a
+    prefix is done, so that the crawl can be resumed from the stored state after an interruption.
+    Args:
+        prefixes (Iterable[str]): the prefixes to crawl, eg ALPHABET or the pending prefixes of
+          an interrupted crawl
+        store (Callable[[str, int, dict, dict, List[str]], None]): called with the prefix, the
+          number of rows, the streets, the properties (see `get_suggestion_list`) and the longer
+          prefixes that will be crawled because this one was saturated (empty if it wasn't)
+        create_reader (Callable[[], SthlmStreetsProperties]): creates the reader of a worker
+        num_workers (int): number of parallel requests
+        max_rows (int): max number of suggestions requested per prefix
+        max_prefix_length (int): longest prefix to split further
+    Returns:
+        int: number of crawled prefixes
+    """
+    local = threading.local()
+
+    def crawl_prefix(prefix):
+        if not hasattr(local, 'reader'):
+            local.reader = create_reader()
+            local.reader.get_first_page()
+        # (only sleeps if the reader has no rate limiter)
+        local.reader.random_sleep()
+        return local.reader.get_suggestion_list(prefix, max_rows)
+
+    num_crawled = 0
+    pending = list(prefixes)
+    with ThreadPoolExecutor(max_workers=num_workers) as executor:
+        running = {}
+        while pending or running:
+            while pending and len(running) < num_workers:
+                prefix = pending.pop()
+                running[executor.submit(crawl_prefix, prefix)] = prefix
+
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                prefix = running.pop(future)
+                num_rows, streets, properties = future.result()
+                num_crawled += 1
+
+                children = []
+                if num_rows >= max_rows:
+                    if len(prefix) < max_prefix_length:
+                        LOG.debug('Prefix {} returned {} rows, splitting it.'.format(prefix,
+                                                                                   num_rows))
+                        children = split_prefix(prefix)
+                    else:
+                        LOG.error('Probably missed results for prefix {}, got {} rows and it '
+                                  'is too long to split.'.format(prefix, num_rows))
+                store(prefix, num_rows, streets, properties, children)
+                pending.extend(children)
+
+    return num_crawled
+
 
 class SthlmStreetsProperties(BaseReader):
     """
@@ -33,11 +117,13 @@ class SthlmStreetsProperties(BaseReader):
         # get frontpage
         url = self.url
         self.log.debug('GET {}'.format(url))
-        self.browser.open(url)
+        self.throttle(url)
+        self.browser.open(url, timeout=self.timeout)
         # get page that frontpage would redirect to
         url = self.url + self.map_path
         self.log.debug('GET {}'.format(url))
-        self.browser.open(url)
+        self.throttle(url)
+        self.browser.open(url, timeout=self.timeout)
         current_page = self.browser.get_current_page()
         self.log.debug('Got page with title "{}"'.format(current_page.title.text.strip()))
 
@@ -60,7 +146,8 @@ class SthlmStreetsProperties(BaseReader):
         url = self.url + self.suggestions_path.format(prefix=prefix, maxrows=max_rows)
         self.log.debug('Requesting suggestions for prefix {} (max {} rows).'.format(prefix,
                                                                                     max_rows))
-        response = self.browser.open(url)
+        self.throttle(url)
+        response = self.browser.open(url, timeout=self.timeout)
         self.log.debug(response.content)
 
         j = json.loads(response.content)
@@ -80,17 +167,20 @@ class SthlmStreetsProperties(BaseReader):
 
         return num_rows, streets, properties
 
-    def get_all(self):
-        """ Request all street addresses and fastigheter."""
-
-        self.get_first_page()
-        max_rows = 100000
-        for prefix in list('ABCDEFGHIJKLMNOPQRSTUVWXYZÄÖÅ'):
-            self.random_sleep()
-            num_rows, streets, properties = self.get_suggestion_list(prefix, max_rows)
-            if not num_rows < max_rows:
-                self.log.error('Probably missed results due to too low max_row value. Got {} '
-                               'rows and requested max {} rows.'.format(num_rows, max_rows))
-            LOG.debug(streets.keys())
-            LOG.debug(properties.keys())
-            break
+    def get_all(self, max_rows=MAX_ROWS):
+        """Request all street addresses and fastigheter, splitting prefixes with too many
+        results (see `crawl_all` for a parallel and resumable crawl).
+        Args:
+            max_rows (int): max number of suggestions requested per prefix
+        Returns:
+            Tuple[dict, dict]: all streets and all properties, see `get_suggestion_list`
+        """
+        all_streets = {}
+        all_properties = {}
+
+        def store(prefix, num_rows, streets, properties, children):
+            all_streets.update(streets)
+            all_properties.update(properties)
+
+        crawl_all(ALPHABET, store, lambda: self, num_workers=1, max_rows=max_rows)
+        return all_streets, all_properties
@@ -0,0 +1,334 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Class UpstreamHealth
+
+Adaptive concurrency limit and circuit breaker per host, shared by all readers of all workers
+through redis (or in-process for tests and single process setups), like the rate limiter.
+
+The number of concurrent requests to a host is limited with AIMD: the limit grows by one per
+`limit` fast successful responses and is halved by a failed or slow one. After `failure_threshold`
+failures in a row, the circuit of the host opens and no requests are sent for `open_seconds`.
+Then a single probe request is let through (half open), which closes the circuit again if it
+succeeds.
+"""
+
+import logging
+import os
+import threading
+import time
+import uuid
+
+from leopard_lavatory.readers.rate_limiter import RateLimited
+from leopard_lavatory.utils import metrics
+
+LOG = logging.getLogger(__name__)
+
+MIN_LIMIT = 1
+MAX_LIMIT = 8
+INITIAL_LIMIT = 2
+# responses slower than this count as congestion and decrease the limit
+LATENCY_TARGET = 5.0
+FAILURE_THRESHOLD = 5
+OPEN_SECONDS = 60
+# a request slot of a crashed worker is freed after this many seconds
+LEASE_SECONDS = 120
+# seconds between two tries of a blocking acquire of a request slot
+BUSY_RETRY_SECONDS = 0.5
+# assumed duration of a request before the first response from a host, a non-blocking acquire of a
+#  busy host is retried after the typical duration of its requests, when a slot is likely free
+INITIAL_LATENCY = 1.0
+
+# ARGV: now, lease id, lease expiry, initial limit; returns "ok", "open:<seconds>" or "busy"
+ACQUIRE_SCRIPT = """
+local now = tonumber(ARGV[1])
+redis.call('ZREMRANGEBYSCORE', KEYS[2], '-inf', now)
+local state = redis.call('HMGET', KEYS[1], 'limit', 'open_until')
+local limit = tonumber(state[1]) or tonumber(ARGV[4])
+local open_until = tonumber(state[2]) or 0
+if open_until > now then
+    return 'open:' .. tostring(open_until - now)
+end
+local allowed = math.floor(limit)
+if open_until > 0 then
+    allowed = 1
+end
+if redis.call('ZCARD', KEYS[2]) >= allowed then
+    return 'busy'
+end
+redis.call('ZADD', KEYS[2], tonumber(ARGV[3]), ARGV[2])
+redis.call('EXPIRE', KEYS[2], math.ceil(tonumber(ARGV[3]) - now) + 1)
+return 'ok'
+"""
+
+# ARGV: now, lease id, outcome ("ok", "slow" or "failure"), initial limit, min limit, max limit,
+#  failure threshold, open seconds; returns the new limit
+RECORD_SCRIPT = """
+local now = tonumber(ARGV[1])
+redis.call('ZREM', KEYS[2], ARGV[2])
+local state = redis.call('HMGET', KEYS[1], 'limit', 'open_until', 'failures')
+local limit = tonumber(state[1]) or tonumber(ARGV[4])
+local open_until = tonumber(state[2]) or 0
+local failures = tonumber(state[3]) or 0
+local outcome = ARGV[3]
+if outcome == 'ok' then
+    limit = math.min(tonumber(ARGV[6]), limit + 1 / limit)
+else
+    limit = math.max(tonumber(ARGV[5]), limit / 2)
+end
+if outcome == 'failure' then
+    failures = failures + 1
+    if open_until > 0 or failures >= tonumber(ARGV[7]) then
+        open_until = now + tonumber(ARGV[8])
+        failures = 0
+    end
+elseif open_until <= now then
+    failures = 0
+    open_until = 0
+end
+redis.call('HSET', KEYS[1], 'limit', tostring(limit), 'open_until', tostring(open_until),
+           'failures', tostring(failures))
+return tostring(limit)
+"""
+
+
+class UpstreamUnavailable(RateLimited):
+    """Raised if the circuit of a host is open, or if no request slot is available without
+    blocking. A `RateLimited`, so the callers defer their work in the same way."""
+
+    def __init__(self, host, retry_after, reason='open'):
+        Exception.__init__(self, f'Upstream {host} is unavailable ({reason}), retry after '
+                                 f'{retry_after:.2f} seconds')
+        self.host = host
+        self.retry_after = retry_after
+        self.reason = reason
+
+
+class MemoryHealthBackend:
+    """Limits, circuits and request slots in the memory of this process."""
+
+    def __init__(self):
+        self._states = {}
+        self._leases = {}
+        self._lock = threading.Lock()
+
+    def acquire(self, host, now, lease_id, expires_at, initial_limit):
+        """Take a request slot for `host` if its circuit is not open and the limit allows it.
+        Returns:
+            str: "ok", "open:<seconds until the circuit is half open>" or "busy"
+        """
+        with self._lock:
+            leases = {lease: expiry for lease, expiry in self._leases.get(host, {}).items()
+                      if expiry > now}
+            self._leases[host] = leases
+            limit, open_until, failures = self._states.get(host, (initial_limit, 0, 0))
+            if open_until > now:
+                return f'open:{open_until - now}'
+            allowed = 1 if open_until > 0 else int(limit)
+            if len(leases) >= allowed:
+                return 'busy'
+            leases[lease_id] = expires_at
+            return 'ok'
+
+    def release(self, host, lease_id):
+        """Free a request slot of `host` that was not used for a request."""
+        with self._lock:
+            self._leases.get(host, {}).pop(lease_id, None)
+
+    def record(self, host, now, lease_id, outcome, initial_limit, min_limit, max_limit,
+               failure_threshold, open_seconds):
+        """Free a request slot and adapt limit and circuit of `host` to the outcome of the request.
+        Returns:
+            float: the new limit
+        """
+        with self._lock:
+            self._leases.get(host, {}).pop(lease_id, None)
+            limit, open_until, failures = self._states.get(host, (initial_limit, 0, 0))
+            if outcome == 'ok':
+                limit = min(max_limit, limit + 1 / limit)
+            else:
+                limit = max(min_limit, limit / 2)
+            if outcome == 'failure':
+                failures += 1
+                if open_until > 0 or failures >= failure_threshold:
+                    open_until = now + open_seconds
+                    failures = 0
+            elif open_until <= now:
+                failures = 0
+                open_until = 0
+            self._states[host] = (limit, open_until, failures)
+            return limit
+
+    def open_until(self, host):
+        """Return until when the circuit of `host` is open (0 if it is closed)."""
+        with self._lock:
+            return self._states.get(host, (0, 0, 0))[1]
+
+
+class RedisHealthBackend:
+    """Limits, circuits and request slots in redis, shared by all processes using the same redis
+    server. The time is passed by the clients, whose clocks are assumed to be in sync to the
+    second."""
+
+    key_prefix = 'leopard_lavatory:upstream:'
+
+    def __init__(self, redis_client):
+        self.redis = redis_client
+        self._acquire = redis_client.register_script(ACQUIRE_SCRIPT)
+        self._record = redis_client.register_script(RECORD_SCRIPT)
+
+    def _keys(self, host):
+        return [self.key_prefix + host, self.key_prefix + host + ':leases']
+
+    def acquire(self, host, now, lease_id, expires_at, initial_limit):
+        """See `MemoryHealthBackend.acquire`."""
+        result = self._acquire(keys=self._keys(host), args=[now, lease_id, expires_at, initial_limit])
+        return result.decode() if isinstance(result, bytes) else result
+
+    def release(self, host, lease_id):
+        """See `MemoryHealthBackend.release`."""
+        self.redis.zrem(self._keys(host)[1], lease_id)
+
+    def record(self, host, now, lease_id, outcome, initial_limit, min_limit, max_limit,
+               failure_threshold, open_seconds):
+        """See `MemoryHealthBackend.record`."""
+        return float(self._record(keys=self._keys(host),
+                                  args=[now, lease_id, outcome, initial_limit, min_limit,
+                                        max_limit, failure_threshold, open_seconds]))
+
+    def open_until(self, host):
+        """See `MemoryHealthBackend.open_until`."""
+        return float(self.redis.hget(self._keys(host)[0], 'open_until') or 0)
+
+
+class UpstreamHealth:
+    """Adaptive concurrency limit and circuit breaker per host."""
+
+    def __init__(self, backend, clock=time.time, min_limit=MIN_LIMIT, max_limit=MAX_LIMIT,
+                 initial_limit=INITIAL_LIMIT, latency_target=LATENCY_TARGET,
+                 failure_threshold=FAILURE_THRESHOLD, open_seconds=OPEN_SECONDS,
+                 lease_seconds=LEASE_SECONDS):
+        """
+        Args:
+            backend (Union[MemoryHealthBackend, RedisHealthBackend]): where the state is kept
+            clock (Callable[[], float]): current time in seconds (wall clock, as it is shared)
+            min_limit (int): lowest limit of concurrent requests per host
+            max_limit (int): highest limit of concurrent requests per host
+            initial_limit (int): limit of a host without any responses yet
+            latency_target (float): responses slower than this (in seconds) decrease the limit
+            failure_threshold (int): number of failures in a row that open the circuit
+            open_seconds (float): how long the circuit stays open
+            lease_seconds (float): request slots that were not released are freed after this
+        """
+        self.backend = backend
+        self.clock = clock
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.initial_limit = initial_limit
+        self.latency_target = latency_target
+        self.failure_threshold = failure_threshold
+        self.open_seconds = open_seconds
+        self.lease_seconds = lease_seconds
+        # moving average of the duration of the successful requests per host, of this process
+        self._latencies = {}
+
+    def acquire(self, host, blocking=True):
+        """Take a request slot for `host`.
+
+        Never waits for an open circuit. If blocking, waits while all request slots are taken.
+        Args:
+            host (str): host name
+            blocking (bool): whether to wait for a request slot
+        Returns:
+            str: id of the slot, to be passed to `record`
+        Raises:
+            UpstreamUnavailable: if the circuit is open, or if not blocking and all request slots
+              are taken
+        """
+        lease_id = uuid.uuid4().hex
+        while True:
+            now = self.clock()
+            result = self.backend.acquire(host, now, lease_id, now + self.lease_seconds,
+                                          self.initial_limit)
+            if result == 'ok':
+                return lease_id
+            if result.startswith('open:'):
+                metrics.UPSTREAM_REJECTIONS.labels(host=host, reason='open').inc()
+                raise UpstreamUnavailable(host, float(result[5:]), 'open')
+            if not blocking:
+                metrics.UPSTREAM_REJECTIONS.labels(host=host, reason='busy').inc()
+                raise UpstreamUnavailable(host, self.typical_latency(host), 'busy')
+            time.sleep(BUSY_RETRY_SECONDS)
+
+    def release(self, host, lease_id):
+        """Release a request slot that was not used for a request (eg as the request was rate
+        limited), without adapting the limit or the circuit of `host`.
+        Args:
+            host (str): host name
+            lease_id (str): id of the slot from `acquire`
+        """
+        self.backend.release(host, lease_id)
+
+    def typical_latency(self, host):
+        """Return the typical duration of a successful request to `host`.
+        Args:
+            host (str): host name
+        Returns:
+            float: seconds, at least BUSY_RETRY_SECONDS
+        """
+        return max(BUSY_RETRY_SECONDS, self._latencies.get(host, INITIAL_LATENCY))
+
+    def record(self, host, lease_id, seconds, ok):
+        """Release a request slot and adapt the limit and the circuit of `host`.
+        Args:
+            host (str): host name
+            lease_id (str): id of the slot from `acquire`
+            seconds (float): duration of the request
+            ok (bool): False if the request failed (connection error, timeout or server error)
+        """
+        if not ok:
+            outcome = 'failure'
+        elif seconds > self.latency_target:
+            outcome = 'slow'
+        else:
+            outcome = 'ok'
+        if ok:
+            latency = self._latencies.get(host, seconds)
+            self._latencies[host] = latency + (seconds - latency) * 0.2
+        limit = self.backend.record(host, self.clock(), lease_id, outcome, self.initial_limit,
+                                    self.min_limit, self.max_limit, self.failure_threshold,
+                                    self.open_seconds)
+        if outcome != 'ok':
+            LOG.info('Request to {} was {}, limit is now {:.2f}'.format(host, outcome, limit))
+
+    def open_for(self, host):
+        """Return how long the circuit of `host` stays open.
+        Args:
+            host (str): host name
+        Returns:
+            float: seconds until the circuit is half open, 0 if it is not open
+        """
+        return max(0.0, self.backend.open_until(host) - self.clock())
+
+
+_upstream_health = None
+
+
+def get_upstream_health():
+    """Return the upstream health controller shared by the readers of this process, kept in the
+    same place as the rate limiter (environment variable RATE_LIMIT_REDIS_URL, see
+    `get_rate_limiter`).
+    Returns:
+        UpstreamHealth: the controller
+    """
+    global _upstream_health
+    if _upstream_health is None:
+        redis_url = os.environ.get('RATE_LIMIT_REDIS_URL', 'redis://localhost:6379')
+        if redis_url == 'memory':
+            backend = MemoryHealthBackend()
+        else:
+            import redis
+            backend = RedisHealthBackend(redis.Redis.from_url(redis_url))
+        _upstream_health = UpstreamHealth(backend)
+    return _upstream_health
@@ -2,17 +2,20 @@
 Database class, general interface for storing different objects.
 """
 import json
+import os
 from contextlib import contextmanager
 from datetime import datetime
 
-from sqlalchemy import DateTime, Integer, String
-from sqlalchemy import create_engine, Column, ForeignKey, Table
+from sqlalchemy import DateTime, Integer, String, Text
+from sqlalchemy import create_engine, func, insert, or_, select, update, Column, ForeignKey, Index, Table, \
+    UniqueConstraint
+from sqlalchemy.dialects import postgresql, sqlite
 from sqlalchemy.ext.declarative import declarative_base, declared_attr
-from sqlalchemy.orm import sessionmaker, relationship
+from sqlalchemy.orm import sessionmaker, relationship, selectinload
 
 from leopard_lavatory.utils import create_token
 
-DB_URI = 'sqlite:///leopardlavatory.sqlite'
+DB_URI = os.environ.get('LEOPARD_DB_URI', 'sqlite:///leopardlavatory.sqlite')
 LOG_ALL_SQL_STATEMENTS = False
 
 
@@ -50,14 +53,92 @@ class User(Base):
     """User table and object."""
     email = Column(String(255), unique=True)
     delete_token = Column(String(255), default=create_token)
+    # when the last digest of new cases was sent to the user, None before the first digest
+    last_digest_at = Column(DateTime)
     watchjobs = relationship('Watchjob', secondary=user_watchjob, back_populates='users')
 
 
 class Watchjob(Base):
     """Watchjob table and object"""
     query = Column(String(255), unique=True)
-    last_case_id = Column(Integer, default=0)
+    # the diarienummer of the newest case seen for this query
+    last_case_id = Column(String(32))
+    # json list of the fastighet names seen in the results for this query, used to match cases
+    #  from a city wide sweep to this watchjob
+    fastigheter = Column(Text, default='[]')
+    # seconds between two checks, adapted to how often new cases appear (see celery.schedule)
+    poll_interval = Column(Integer, default=3600)
+    # when to check the watchjob next, None to check it as soon as possible
+    next_run_at = Column(DateTime, index=True)
+    # the last cycle that dispatched this watchjob, and until when its check is queued or running
+    #  (None when it is done, a lease of a crashed worker expires), so that overlapping cycles don't
+    #  check it at the same time
+    lease_id = Column(String(32))
+    lease_until = Column(DateTime)
     users = relationship('User', secondary=user_watchjob, back_populates='watchjobs')
+    cases = relationship('StoredCase', secondary='watchjob_case')
+    crawl_checkpoint = relationship('CrawlCheckpoint', uselist=False, cascade='all, delete-orphan')
+
+
+class StoredCase(Base):
+    """Case table and object, the cases found by the readers (see readers.case.Case)."""
+    __tablename__ = 'case'
+
+    # the diarienummer
+    case_id = Column(String(32), unique=True)
+    fastighet = Column(String(255), index=True)
+    type = Column(String(255))
+    description = Column(Text)
+    date = Column(String(10), index=True)
+
+
+# watchjob_case table: many-to-many relation table of the cases found for a watchjob, and when
+watchjob_case = Table('watchjob_case', Base.metadata,
+                      Column('watchjob_id', ForeignKey('watchjob.id'), primary_key=True),
+                      Column('case_id', ForeignKey('case.case_id'), primary_key=True),
+                      Column('found_at', DateTime, default=datetime.now),
+                      Index('ix_watchjob_case_found_at', 'watchjob_id', 'found_at'))
+
+
+class CrawlCheckpoint(Base):
+    """Progress of an unfinished crawl of a watchjob, to continue it after the last stored page
+    instead of starting it over."""
+    watchjob_id = Column(ForeignKey('watchjob.id'), unique=True)
+    # watermarks of the crawl, only a crawl with the same last case continues it
+    newer_than_case = Column(String(32))
+    newer_than_date = Column(String(10))
+    # newest case of the crawl, the last case of the watchjob once the crawl is finished
+    new_last_case_id = Column(String(32))
+    num_cases = Column(Integer, default=0)
+    # session and form state of the reader after the last stored page as json, see
+    #  SBKReader.checkpoint
+    state = Column(Text)
+
+
+class Sweep(Base):
+    """Sweep table and object, one row per city wide sweep of recent cases."""
+    last_case_id = Column(String(32))
+    num_cases = Column(Integer, default=0)
+
+
+class GazetteerEntry(Base):
+    """Gazetteer table and object: all street addresses and fastighet names of the city, as
+    suggested by kartor.stockholm.se."""
+    __table_args__ = (UniqueConstraint('kind', 'name'),)
+
+    # 'street' or 'property'
+    kind = Column(String(16))
+    name = Column(String(255))
+    # the raw suggestion row as json
+    data = Column(Text)
+
+
+class GazetteerPrefix(Base):
+    """Crawl state of the gazetteer, one row per search prefix."""
+    prefix = Column(String(64), unique=True)
+    # 'pending', 'done' or 'split' (when it had too many results and longer prefixes were added)
+    status = Column(String(16), default='pending')
+    num_rows = Column(Integer)
 
 
 class UserRequest(Base):
@@ -178,6 +259,109 @@ def get_all_watchjobs(dbs):
     return dbs.query(Watchjob).all()
 
 
+def _not_leased(now):
+    return or_(Watchjob.lease_until.is_(None), Watchjob.lease_until <= now)
+
+
+def get_due_watchjobs(dbs, now, limit=500, all_watchjobs=False, lease_id=None):
+    """Return the watchjobs that should be checked now and are not leased by a cycle, the longest
+    overdue first.
+    Args:
+        dbs (sqlalchemy.orm.session.Session): database session
+        now (datetime.datetime): the current time
+        limit (int): maximum number of watchjobs to return
+        all_watchjobs (bool): whether to return the watchjobs that are not due yet as well, after
+          the due ones
+        lease_id (str): id of the dispatching cycle, the watchjobs it dispatched already are not
+          returned again
+    Returns:
+        List[Watchjob]: the due watchjobs
+    """
+    query = dbs.query(Watchjob).filter(_not_leased(now))
+    if lease_id is not None:
+        query = query.filter(or_(Watchjob.lease_id.is_(None), Watchjob.lease_id != lease_id))
+    if not all_watchjobs:
+        query = query.filter(or_(Watchjob.next_run_at.is_(None), Watchjob.next_run_at <= now))
+    return query.order_by(Watchjob.next_run_at.is_not(None), Watchjob.next_run_at, Watchjob.id).\
+        limit(limit).all()
+
+
+def count_leased_watchjobs(dbs, now, lease_id, all_watchjobs=False):
+    """Return the number of due watchjobs whose check of another cycle is queued or running.
+    Args:
+        dbs (sqlalchemy.orm.session.Session): database session
+        now (datetime.datetime): the current time
+        lease_id (str): id of the cycle, whose own leases are not counted
+        all_watchjobs (bool): whether to count the watchjobs that are not due yet as well
+    Returns:
+        int: number of watchjobs
+    """
+    query = dbs.query(func.count(Watchjob.id)).\
+        filter(Watchjob.lease_until > now, Watchjob.lease_id != lease_id)
+    if not all_watchjobs:
+        query = query.filter(or_(Watchjob.next_run_at.is_(None), Watchjob.next_run_at <= now))
+    return query.scalar()
+
+
+def lease_watchjobs(dbs, watchjob_ids, lease_id, now, lease_until):
+    """Lease the given watchjobs for a cycle, except the ones that are leased by another cycle.
+    Leasing is atomic, so of two cycles that lease the same watchjob at the same time only one
+    gets it.
+    Args:
+        dbs (sqlalchemy.orm.session.Session): database session
+        watchjob_ids (list[int]): ids of the watchjobs
+        lease_id (str): id of the cycle
+        now (datetime.datetime): the current time
+        lease_until (datetime.datetime): when the lease expires
+    Returns:
+        set[int]: ids of the leased watchjobs
+    """
+    if not watchjob_ids:
+        return set()
+    dbs.execute(update(Watchjob).
+                where(Watchjob.id.in_(watchjob_ids), _not_leased(now)).
+                values(lease_id=lease_id, lease_until=lease_until).
+                execution_options(synchronize_session=False))
+    return {watchjob_id for watchjob_id, in
+            dbs.query(Watchjob.id).filter(Watchjob.id.in_(watchjob_ids),
+                                          Watchjob.lease_id == lease_id)}
+
+
+def renew_watchjob_lease(dbs, watchjob_id, lease_id, lease_until):
+    """Extend the lease of a watchjob, if the cycle still holds it.
+    Args:
+        dbs (sqlalchemy.orm.session.Session): database session
+        watchjob_id (int): watchjob id
+        lease_id (str): id of the cycle, None if the check runs without a lease
+        lease_until (datetime.datetime): when the lease expires
+    Returns:
+        bool: False if the lease expired and was taken by another cycle
+    """
+    if lease_id is None:
+        return True
+    result = dbs.execute(update(Watchjob).
+                         where(Watchjob.id == watchjob_id, Watchjob.lease_id == lease_id).
+                         values(lease_until=lease_until).
+                         execution_options(synchronize_session=False))
+    return result.rowcount == 1
+
+
+def release_watchjob_lease(dbs, watchjob_id, lease_id):
+    """Release the lease of a watchjob when its check is done, if the cycle still holds it. The
+    id of the cycle is kept, see `get_due_watchjobs`.
+    Args:
+        dbs (sqlalchemy.orm.session.Session): database session
+        watchjob_id (int): watchjob id
+        lease_id (str): id of the cycle, None if the check runs without a lease
+    """
+    if lease_id is None:
+        return
+    dbs.execute(update(Watchjob).
+                where(Watchjob.id == watchjob_id, Watchjob.lease_id == lease_id).
+                values(lease_until=None).
+                execution_options(synchronize_session=False))
+
+
 def get_watchjob(dbs, watchjob_id):
     """Return the specified watchjob from database.
     Returns:
@@ -187,6 +371,328 @@ def get_watchjob(dbs, watchjob_id):
     return dbs.query(Watchjob).filter(Watchjob.id == watchjob_id).first()
 
 
+def add_watchjob_fastigheter(dbs, watchjob_id, cases):
+    """Remember the fastigheter of the given cases for the watchjob, so that the watchjob can
+    be matched in city wide sweeps.
+
+    Args:
+        dbs (sqlalchemy.orm.session.Session): database session
+        watchjob_id (int): id of the watchjob
+        cases (List[Case]): cases found for the watchjob query
+    Returns:
+        List[str]: all known fastigheter of the watchjob
+    """
+    watchjob = get_watchjob(dbs, watchjob_id)
+    fastigheter = set(json.loads(watchjob.fastigheter or '[]'))
+    fastigheter.update(case['fastighet'] for case in cases if case.get('fastighet'))
+    watchjob.fastigheter = json.dumps(sorted(fastigheter), ensure_ascii=False)
+    return sorted(fastigheter)
+
+
+def _insert(dbs, table):
+    """Return an insert statement for the table, with the on conflict clause of the database
+    dialect if it has one.
+    Args:
+        dbs (sqlalchemy.orm.session.Session): database session
+        table (sqlalchemy.Table): the table
+    Returns:
+        Tuple[sqlalchemy.sql.Insert, bool]: the insert statement and whether it supports
+          on_conflict_do_nothing/on_conflict_do_update
+    """
+    dialect = dbs.get_bind().dialect.name
+    if dialect == 'sqlite':
+        return sqlite.insert(table), True
+    if dialect == 'postgresql':
+        return postgresql.insert(table), True
+    return insert(table), False
+
+
+def upsert_cases(dbs, cases):
+    """Store the cases with one bulk insert, updating the cases that are in the database
+    already.
+    Args:
+        dbs (sqlalchemy.orm.session.Session): database session
+        cases (List[Case]): cases as returned by the readers
+    Returns:
+        List[str]: the case ids (diarienummer) of all given cases
+    """
+    # the last of duplicate cases wins, like it would with an update per case
+    rows = {case['id']: {'case_id': case['id'], 'fastighet': case['fastighet'],
+                         'type': case['type'], 'description': case['description'],
+                         'date': case['date']} for case in cases}
+    if rows:
+        statement, on_conflict = _insert(dbs, StoredCase.__table__)
+        if on_conflict:
+            statement = statement.on_conflict_do_update(
+                index_elements=['case_id'],
+                set_=dict({column: statement.excluded[column]
+                           for column in ('fastighet', 'type', 'description', 'date')},
+                          modified_at=datetime.now()))
+            dbs.execute(statement, list(rows.values()))
+        else:
+            known = set(dbs.scalars(select(StoredCase.case_id).
+                                    where(StoredCase.case_id.in_(list(rows)))))
+            new_rows = [row for case_id, row in rows.items() if case_id not in known]
+            if new_rows:
+                dbs.execute(statement, new_rows)
+    return [case['id'] for case in cases]
+
+
+def add_watchjob_cases(dbs, watchjob_id, case_ids):
+    """Relate stored cases to a watchjob, with one bulk insert.
+
+    Cases that are related to the watchjob already are skipped, so that a retried or
+    overlapping check doesn't notify the users twice about the same case.
+    Args:
+        dbs (sqlalchemy.orm.session.Session): database session
+        watchjob_id (int): id of the watchjob
+        case_ids (List[str]): case ids (diarienummer) of stored cases
+    Returns:
+        List[str]: the case ids that were not related to the watchjob before, in the same order
+    """
+    case_ids = list(dict.fromkeys(case_ids))
+    if not case_ids:
+        return []
+    # the related cases are selected first instead of returned by the insert, as RETURNING with
+    #  executemany needs sqlalchemy 2
+    known = set(dbs.scalars(select(watchjob_case.c.case_id).where(
+        watchjob_case.c.watchjob_id == watchjob_id, watchjob_case.c.case_id.in_(case_ids))))
+    rows = [{'watchjob_id': watchjob_id, 'case_id': case_id} for case_id in case_ids
+            if case_id not in known]
+    if rows:
+        statement, on_conflict = _insert(dbs, watchjob_case)
+        if on_conflict:
+            # related by an overlapping check in the meantime
+            statement = statement.on_conflict_do_nothing()
+        dbs.execute(statement, rows)
+    new_case_ids = {row['case_id'] for row in rows}
+    return [case_id for case_id in case_ids if case_id in new_case_ids]
+
+
+def get_watchjob_cases_since(dbs, watchjob_id, since):
+    """Return the cases found for a watchjob after the given time, newest case first.
+    Args:
+        dbs (sqlalchemy.orm.session.Session): database session
+        watchjob_id (int): id of the watchjob
+        since (datetime.datetime): only cases found after this time
+    Returns:
+        List[StoredCase]: the cases
+    """
+    return dbs.query(StoredCase).join(watchjob_case, watchjob_case.c.case_id == StoredCase.case_id).\
+        filter(watchjob_case.c.watchjob_id == watchjob_id, watchjob_case.c.found_at > since).\
+        order_by(StoredCase.date.desc(), StoredCase.case_id.desc()).all()
+
+
+def get_digest_users(dbs):
+    """Return all users that watch at least one watchjob, with their watchjobs loaded.
+    Args:
+        dbs (sqlalchemy.orm.session.Session): database session
+    Returns:
+        List[User]: the users
+    """
+    return dbs.query(User).filter(User.watchjobs.any()).options(selectinload(User.watchjobs)).\
+        order_by(User.id).all()
+
+
+def get_cases_found_between(dbs, since, until):
+    """Return the cases found for all watchjobs in a time range, newest case first.
+    Args:
+        dbs (sqlalchemy.orm.session.Session): database session
+        since (datetime.datetime): only cases found after this time
+        until (datetime.datetime): only cases found at or before this time
+    Returns:
+        List[Tuple[int, datetime.datetime, StoredCase]]: id of the watchjob, when the case was
+          found for it and the case
+    """
+    return dbs.query(watchjob_case.c.watchjob_id, watchjob_case.c.found_at, StoredCase).\
+        join(watchjob_case, watchjob_case.c.case_id == StoredCase.case_id).\
+        filter(watchjob_case.c.found_at > since, watchjob_case.c.found_at <= until).\
+        order_by(StoredCase.date.desc(), StoredCase.case_id.desc()).all()
+
+
+def set_last_digest(dbs, user_ids, digest_at):
+    """Record when the users got their last digest, with one update.
+    Args:
+        dbs (sqlalchemy.orm.session.Session): database session
+        user_ids (List[int]): ids of the users
+        digest_at (datetime.datetime): the cases found up to this time were in the digest
+    """
+    if user_ids:
+        dbs.query(User).filter(User.id.in_(user_ids)).\
+            update({User.last_digest_at: digest_at}, synchronize_session=False)
+
+
+def get_cases(dbs, case_ids):
+    """Return the stored cases with the given case ids, in the same order.
+    Args:
+        dbs (sqlalchemy.orm.session.Session): database session
+        case_ids (List[str]): case ids (diarienummer)
+    Returns:
+        List[StoredCase]: the cases, cases that are not stored are left out
+    """
+    cases = {case.case_id: case for case in
+             dbs.query(StoredCase).filter(StoredCase.case_id.in_(case_ids))}
+    return [cases[case_id] for case_id in case_ids if case_id in cases]
+
+
+def get_crawl_checkpoint(dbs, watchjob_id):
+    """Return the checkpoint of the unfinished crawl of a watchjob.
+    Args:
+        dbs (sqlalchemy.orm.session.Session): database session
+        watchjob_id (int): watchjob id
+    Returns:
+        Optional[CrawlCheckpoint]: the checkpoint, None if there is no unfinished crawl
+    """
+    return dbs.query(CrawlCheckpoint).filter(CrawlCheckpoint.watchjob_id == watchjob_id).\
+        one_or_none()
+
+
+def save_crawl_checkpoint(dbs, watchjob_id, newer_than_case, newer_than_date, new_last_case_id,
+                          num_cases, state):
+    """Store the progress of the crawl of a watchjob, replacing its previous checkpoint.
+    Args:
+        dbs (sqlalchemy.orm.session.Session): database session
+        watchjob_id (int): watchjob id
+        newer_than_case (str): case id where the crawl stops
+        newer_than_date (str): date (YYYY-MM-DD) where the crawl stops
+        new_last_case_id (str): id of the newest case found by the crawl
+        num_cases (int): number of new cases found so far
+        state (str): reader state after the last stored page as json
+    Returns:
+        CrawlCheckpoint: the checkpoint
+    """
+    checkpoint = get_crawl_checkpoint(dbs, watchjob_id)
+    if checkpoint is None:
+        checkpoint = CrawlCheckpoint(watchjob_id=watchjob_id)
+        dbs.add(checkpoint)
+    checkpoint.newer_than_case = newer_than_case
+    checkpoint.newer_than_date = newer_than_date
+    checkpoint.new_last_case_id = new_last_case_id
+    checkpoint.num_cases = num_cases
+    checkpoint.state = state
+    return checkpoint
+
+
+def delete_crawl_checkpoint(dbs, watchjob_id):
+    """Delete the checkpoint of a finished or abandoned crawl of a watchjob.
+    Args:
+        dbs (sqlalchemy.orm.session.Session): database session
+        watchjob_id (int): watchjob id
+    """
+    dbs.query(CrawlCheckpoint).filter(CrawlCheckpoint.watchjob_id == watchjob_id).delete()
+
+
+def get_last_sweep(dbs):
+    """Return the most recent sweep from the database.
+    Args:
+        dbs (sqlalchemy.orm.session.Session): database session
+    Returns:
+        Optional[Sweep]: the last sweep, None if there has not been any sweep yet
+    """
+    return dbs.query(Sweep).order_by(Sweep.id.desc()).first()
+
+
+def add_sweep(dbs, last_case_id, num_cases):
+    """Record a finished sweep.
+    Args:
+        dbs (sqlalchemy.orm.session.Session): database session
+        last_case_id (str): id of the newest case seen in the sweep
+        num_cases (int): number of new cases found in the sweep
+    Returns:
+        Sweep: the new sweep
+    """
+    sweep = Sweep(last_case_id=last_case_id, num_cases=num_cases)
+    dbs.add(sweep)
+    return sweep
+
+
+def get_pending_gazetteer_prefixes(dbs):
+    """Return the prefixes of the gazetteer crawl that still have to be crawled.
+    Args:
+        dbs (sqlalchemy.orm.session.Session): database session
+    Returns:
+        List[str]: the pending prefixes, empty if the crawl is finished or was never started
+    """
+    return [prefix for prefix, in dbs.query(GazetteerPrefix.prefix).
+            filter(GazetteerPrefix.status == 'pending')]
+
+
+def start_gazetteer_crawl(dbs, prefixes):
+    """Start a new gazetteer crawl: forget the state of the previous crawl, so that all prefixes
+    (including the longer ones of split prefixes, found again by the new crawl) are pending again
+    and an interrupted crawl continues where it stopped.
+    Args:
+        dbs (sqlalchemy.orm.session.Session): database session
+        prefixes (Iterable[str]): the prefixes to start with
+    """
+    dbs.query(GazetteerPrefix).delete()
+    add_gazetteer_prefixes(dbs, prefixes)
+
+
+def add_gazetteer_prefixes(dbs, prefixes):
+    """Add prefixes to crawl to the gazetteer crawl state, if they are not known yet.
+    Args:
+        dbs (sqlalchemy.orm.session.Session): database session
+        prefixes (Iterable[str]): the prefixes
+    """
+    prefixes = set(prefixes)
+    known = {prefix for prefix, in dbs.query(GazetteerPrefix.prefix).
+             filter(GazetteerPrefix.prefix.in_(prefixes))}
+    dbs.add_all(GazetteerPrefix(prefix=prefix) for prefix in prefixes - known)
+
+
+def add_gazetteer_result(dbs, prefix, num_rows, streets, properties, children):
+    """Store the result of a crawled prefix: its entries, its new status and the longer prefixes
+    if it was split.
+    Args:
+        dbs (sqlalchemy.orm.session.Session): database session
+        prefix (str): the crawled prefix
+        num_rows (int): number of results of the prefix
+        streets (dict): raw suggestion rows by street address
+        properties (dict): raw suggestion rows by fastighet name
+        children (List[str]): longer prefixes to crawl instead, empty if the prefix is done
+    """
+    for kind, rows in (('street', streets), ('property', properties)):
+        if not rows:
+            continue
+        known = {name for name, in dbs.query(GazetteerEntry.name).
+                 filter(GazetteerEntry.kind == kind, GazetteerEntry.name.in_(list(rows)))}
+        dbs.add_all(GazetteerEntry(kind=kind, name=name, data=json.dumps(row, ensure_ascii=False))
+                    for name, row in rows.items() if name not in known)
+
+    state = dbs.query(GazetteerPrefix).filter(GazetteerPrefix.prefix == prefix).one_or_none()
+    if state is None:
+        state = GazetteerPrefix(prefix=prefix)
+        dbs.add(state)
+    state.status = 'split' if children else 'done'
+    state.num_rows = num_rows
+    add_gazetteer_prefixes(dbs, children)
+
+
+def get_gazetteer_names(dbs, kind=None):
+    """Return the names in the gazetteer.
+    Args:
+        dbs (sqlalchemy.orm.session.Session): database session
+        kind (str): 'street' or 'property' to return only those, None for all names
+    Returns:
+        List[str]: the names
+    """
+    query = dbs.query(GazetteerEntry.name)
+    if kind is not None:
+        query = query.filter(GazetteerEntry.kind == kind)
+    return [name for name, in query]
+
+
+def get_gazetteer_entries(dbs):
+    """Return kind and name of all entries in the gazetteer.
+    Args:
+        dbs (sqlalchemy.orm.session.Session): database session
+    Returns:
+        List[Tuple[str, str]]: kind ('street' or 'property') and name of every entry
+    """
+    return [(kind, name) for kind, name in dbs.query(GazetteerEntry.kind, GazetteerEntry.name)]
+
+
 def get_all_requests(dbs):
     """Return all user request entries from the database.
     Returns:
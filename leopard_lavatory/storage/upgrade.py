@@ -0,0 +1,92 @@
+"""
+Upgrade of an existing database to the current schema.
+
+`Base.metadata.create_all` creates the missing tables, but never changes the existing ones. This
+adds the columns (and their indexes) that were added to existing tables since the database was
+created, and changes `watchjob.last_case_id` from an integer to a case id string. It can be run
+any number of times:
+
+    LEOPARD_DB_URI=... python -m leopard_lavatory.storage.upgrade
+"""
+import logging
+
+from sqlalchemy import Integer, inspect, text
+
+from leopard_lavatory.storage.database import Base, engine
+
+LOG = logging.getLogger(__name__)
+
+
+def add_missing_columns(connection):
+    """Add the columns of the models that are missing in their existing tables, with their
+    default value for the existing rows and their indexes.
+    Args:
+        connection (sqlalchemy.engine.Connection): database connection
+    Returns:
+        List[str]: the added columns as table.column
+    """
+    inspector = inspect(connection)
+    preparer = connection.dialect.identifier_preparer
+    added = []
+    for table in Base.metadata.sorted_tables:
+        if not inspector.has_table(table.name):
+            continue
+        existing = {column['name'] for column in inspector.get_columns(table.name)}
+        missing = [column for column in table.columns if column.name not in existing]
+        for column in missing:
+            connection.execute(text('ALTER TABLE {} ADD COLUMN {} {}'.format(
+                preparer.format_table(table), preparer.format_column(column),
+                column.type.compile(connection.dialect))))
+            if column.default is not None and column.default.is_scalar:
+                values = {column.name: column.default.arg}
+                if 'modified_at' in table.columns:
+                    # not a modification of the rows
+                    values['modified_at'] = table.columns.modified_at
+                connection.execute(table.update().values(values))
+            added.append('{}.{}'.format(table.name, column.name))
+
+        missing_names = {column.name for column in missing}
+        for index in table.indexes:
+            if missing_names.intersection(column.name for column in index.columns):
+                index.create(connection)
+    return added
+
+
+def upgrade_last_case_id(connection):
+    """Change `watchjob.last_case_id` to a string column, where no last case is None instead of 0.
+    Args:
+        connection (sqlalchemy.engine.Connection): database connection
+    """
+    column = next(column for column in inspect(connection).get_columns('watchjob')
+                  if column['name'] == 'last_case_id')
+    if connection.dialect.name != 'sqlite' and isinstance(column['type'], Integer):
+        # sqlite keeps the case ids in the integer column as text anyway
+        connection.execute(text('ALTER TABLE watchjob ALTER COLUMN last_case_id TYPE VARCHAR(32) '
+                                'USING CAST(last_case_id AS VARCHAR(32))'))
+    connection.execute(text("UPDATE watchjob SET last_case_id = NULL "
+                            "WHERE CAST(last_case_id AS VARCHAR(32)) = '0'"))
+
+
+def upgrade(bind=engine):
+    """Upgrade the database to the current schema (and create the missing tables), in one
+    transaction.
+    Args:
+        bind (sqlalchemy.engine.Engine): the database
+    Returns:
+        List[str]: the added columns as table.column
+    """
+    with bind.begin() as connection:
+        Base.metadata.create_all(connection)
+        added = add_missing_columns(connection)
+        upgrade_last_case_id(connection)
+    return added
+
+
+def main():
+    logging.basicConfig(level=logging.INFO)
+    added = upgrade()
+    LOG.info('Database upgraded, added columns: {}'.format(', '.join(added) or 'none'))
+
+
+if __name__ == '__main__':
+    main()
@@ -59,6 +59,21 @@ def valid_address(address):
     return regex.match(address) is not None
 
 
+def normalize_address(address):
+    """Turn a street address or property name into a canonical lookup key.
+
+    Leading and trailing white space is removed, inner runs of white space are collapsed into a
+    single space and the string is case folded, so that "Brunnsgatan  1" and "brunnsgatan 1"
+    result in the same key.
+
+    Args:
+        address (str): street address or property (fastighet) name
+    Returns:
+        str: the normalized key
+    """
+    return ' '.join(address.split()).casefold()
+
+
 def log_safe(string, max_len=300):
     """Turns any string into a quoted string (%xx escaping) to safely write it to log output.
 
@@ -0,0 +1,163 @@
+"""Index of street addresses and property names for address suggestions and for finding the
+gazetteer entry of an address typed by a user."""
+
+import re
+import unicodedata
+from bisect import bisect_left
+from collections import Counter, defaultdict
+
+from leopard_lavatory.utils import normalize_address
+
+# separate letters in Swedish, not a with a ring or diaeresis, so they are not folded to a and o
+SWEDISH_LETTERS = 'åäö'
+# the Danish/Norwegian spellings of ä and ö, which are the same letters in Swedish
+NORDIC_VARIANTS = str.maketrans({'æ': 'ä', 'ø': 'ö'})
+# sort å, ä and ö after z, like the Swedish alphabet (characters after z in ascii)
+SWEDISH_ORDER = str.maketrans({'å': '{', 'ä': '|', 'ö': '}'})
+# common abbreviations at the end of street names (folded), eg "Brunnsg. 1" for "Brunnsgatan 1"
+ABBREVIATIONS = {
+    'g.': 'gatan',
+    'gt': 'gatan',
+    'gt.': 'gatan',
+    'v.': 'vägen',
+    'vg': 'vägen',
+    'vg.': 'vägen',
+    'gr.': 'gränd',
+    'pl.': 'plan',
+}
+# fuzzy matches need at least this share of common trigrams (jaccard similarity)
+MIN_SIMILARITY = 0.5
+
+
+def fold_swedish(text):
+    """Fold a street address or property name for matching user input.
+
+    On top of `normalize_address`, accents are removed (é -> e, ü -> u) except from å, ä and ö,
+    so that "Väster" doesn't match "Vasterbotten", but "Café" matches "cafe".
+    Args:
+        text (str): the address, name or user input
+    Returns:
+        str: the folded string
+    """
+    folded = []
+    for character in normalize_address(text).translate(NORDIC_VARIANTS):
+        if character in SWEDISH_LETTERS:
+            folded.append(character)
+        else:
+            folded.append(''.join(part for part in unicodedata.normalize('NFKD', character)
+                                  if not unicodedata.combining(part)))
+    return ''.join(folded)
+
+
+def expand_abbreviations(folded):
+    """Expand the abbreviated street types in a folded address, eg "brunnsg. 1" to
+    "brunnsgatan 1".
+    Args:
+        folded (str): address folded with `fold_swedish`
+    Returns:
+        str: the address with expanded abbreviations
+    """
+    words = []
+    for word in folded.split(' '):
+        for abbreviation, expansion in ABBREVIATIONS.items():
+            if word.endswith(abbreviation) and len(word) > len(abbreviation):
+                word = word[:-len(abbreviation)] + expansion
+                break
+        words.append(word)
+    return ' '.join(words)
+
+
+def trigrams(folded):
+    """Return the set of character trigrams of a folded string, padded with spaces at the start
+    and the end."""
+    padded = f'  {folded} '
+    return {padded[position:position + 3] for position in range(len(padded) - 2)}
+
+
+class AddressIndex:
+    """Sorted array of the folded names, searched with bisect, and a trigram index for fuzzy
+    matching.
+
+    Looking up a prefix is a binary search for the first name starting with it and then a scan
+    of the following names, so it takes microseconds even for all addresses of the city.
+    """
+
+    def __init__(self, entries=()):
+        """
+        Args:
+            entries (Iterable[Tuple[str, str]]): kind ('street' or 'property') and name of every
+              entry, eg from `get_gazetteer_entries`
+        """
+        rows = sorted((fold_swedish(name).translate(SWEDISH_ORDER), name, kind)
+                      for kind, name in entries)
+        self._keys = [key for key, name, kind in rows]
+        self._entries = [(name, kind) for key, name, kind in rows]
+
+        self._exact = {}
+        self._trigrams = defaultdict(list)
+        for position, (name, kind) in enumerate(self._entries):
+            folded = fold_swedish(name)
+            self._exact.setdefault(folded, position)
+            for trigram in trigrams(folded):
+                self._trigrams[trigram].append(position)
+
+    def __len__(self):
+        return len(self._keys)
+
+    def search(self, prefix, limit=10):
+        """Find the names starting with a prefix, in Swedish alphabetical order.
+        Args:
+            prefix (str): user input, folded with `fold_swedish` like the names
+            limit (int): maximum number of results
+        Returns:
+            List[Tuple[str, str]]: name and kind of the matching entries
+        """
+        key = fold_swedish(prefix).translate(SWEDISH_ORDER)
+        if not key:
+            return []
+
+        results = []
+        position = bisect_left(self._keys, key)
+        while position < len(self._keys) and len(results) < limit and \
+                self._keys[position].startswith(key):
+            results.append(self._entries[position])
+            position += 1
+        return results
+
+    def canonicalize(self, address, min_similarity=MIN_SIMILARITY):
+        """Find the gazetteer entry a user means with an address.
+
+        Tries an exact match of the folded address, then with expanded abbreviations and finally
+        the most similar entry by common trigrams. A fuzzy match must contain the same numbers as
+        the address, so that eg "Brunnsgatan 12" is never turned into "Brunnsgatan 1".
+        Args:
+            address (str): user input
+            min_similarity (float): minimum jaccard similarity of the trigrams of a fuzzy match
+        Returns:
+            Optional[Tuple[str, str]]: name and kind of the entry, None if there is no good match
+        """
+        folded = fold_swedish(address)
+        for candidate in (folded, expand_abbreviations(folded)):
+            if candidate in self._exact:
+                return self._entries[self._exact[candidate]]
+
+        folded = expand_abbreviations(folded)
+        numbers = re.findall(r'\d+', folded)
+        query_trigrams = trigrams(folded)
+        common = Counter()
+        for trigram in query_trigrams:
+            common.update(self._trigrams.get(trigram, ()))
+
+        best_position, best_similarity = None, min_similarity
+        for position, num_common in common.most_common():
+            # the similarity can't be higher than the share of common trigrams of the query
+            if num_common / len(query_trigrams) < best_similarity:
+                break
+            name = self._entries[position][0]
+            entry_trigrams = trigrams(fold_swedish(name))
+            similarity = num_common / (len(query_trigrams) + len(entry_trigrams) - num_common)
+            if (similarity > best_similarity or best_position is None and
+                    similarity == best_similarity) and re.findall(r'\d+', name) == numbers:
+                best_position, best_similarity = position, similarity
+
+        return self._entries[best_position] if best_position is not None else None
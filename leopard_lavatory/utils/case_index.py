@@ -0,0 +1,58 @@
+"""Inverted index to match cases from a city wide sweep to watchjobs."""
+
+from collections import defaultdict
+
+from leopard_lavatory.utils import normalize_address
+
+
+class CaseIndex:
+    """Inverted index from normalized street addresses and property (fastighet) names to
+    watchjob ids.
+
+    Each watchjob registers the keys it is interested in, eg its street address and the
+    fastigheter that have been seen for that address before. Matching a case is then a dictionary
+    lookup per key of the case, independent of the number of watchjobs.
+    """
+
+    def __init__(self):
+        self._index = defaultdict(set)
+
+    def __len__(self):
+        return len(self._index)
+
+    def add(self, watchjob_id, keys):
+        """Register a watchjob for the given keys.
+        Args:
+            watchjob_id (int): id of the watchjob
+            keys (Iterable[str]): street addresses and/or fastighet names (not yet normalized)
+        """
+        for key in keys:
+            if key:
+                self._index[normalize_address(key)].add(watchjob_id)
+
+    def match(self, case):
+        """Find all watchjobs interested in a case.
+        Args:
+            case (Case): a case as returned by the readers
+        Returns:
+            Set[int]: ids of the matching watchjobs
+        """
+        watchjob_ids = set()
+        for field in ('fastighet', 'address'):
+            value = case.get(field)
+            if value:
+                watchjob_ids.update(self._index.get(normalize_address(value), ()))
+        return watchjob_ids
+
+    def match_all(self, cases):
+        """Match a list of cases, keeping the order of the cases for each watchjob.
+        Args:
+            cases (Iterable[Case]): cases as returned by the readers, newest first
+        Returns:
+            Dict[int, List[Case]]: the matching cases for every watchjob id with at least one match
+        """
+        matches = defaultdict(list)
+        for case in cases:
+            for watchjob_id in self.match(case):
+                matches[watchjob_id].append(case)
+        return dict(matches)
@@ -0,0 +1,128 @@
+"""Metrics of the watch pipeline (readers, tasks and emailer) in the Prometheus format.
+
+The metrics are recorded in the registry of prometheus_client of each process. To report the
+metrics of all processes of a machine (eg the prefork worker processes of celery), set the
+environment variable PROMETHEUS_MULTIPROC_DIR to the same empty directory for all of them. The
+metrics are served by the /metrics endpoint of the web app (if LEOPARD_METRICS_TOKEN is set, to
+clients sending it as bearer token) or by a sidecar next to the workers:
+
+    PROMETHEUS_MULTIPROC_DIR=/tmp/leopard_metrics python -m leopard_lavatory.utils.metrics --port 9100
+"""
+
+import argparse
+import os
+import time
+from functools import wraps
+
+from prometheus_client import CONTENT_TYPE_LATEST, REGISTRY, CollectorRegistry, Counter, \
+    Histogram, generate_latest, multiprocess, start_http_server
+
+# most requests and tasks take between a few milliseconds and a minute
+SECONDS_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+
+READER_REQUEST_SECONDS = Histogram(
+    'leopard_reader_request_seconds',
+    'Duration of the http requests of the readers, until the response body is received',
+    ['reader', 'method'], buckets=SECONDS_BUCKETS)
+READER_PAGES = Counter(
+    'leopard_reader_pages', 'Pages fetched by the readers', ['reader', 'status'])
+READER_RESPONSE_BYTES = Counter(
+    'leopard_reader_response_bytes', 'Size of the responses received by the readers', ['reader'])
+READER_PARSE_SECONDS = Histogram(
+    'leopard_reader_parse_seconds',
+    'Duration of parsing the pages ("html": page and form state, "cases": the case grid)',
+    ['reader', 'step'], buckets=SECONDS_BUCKETS)
+READER_WAIT_SECONDS = Counter(
+    'leopard_reader_wait_seconds',
+    'Time the readers waited before requests ("sleep": random sleep, "rate_limit": shared rate '
+    'limiter)', ['reader', 'reason'])
+UPSTREAM_REJECTIONS = Counter(
+    'leopard_upstream_rejections',
+    'Requests not sent because the circuit of the host was open ("open") or all its request '
+    'slots were taken ("busy")', ['host', 'reason'])
+
+TASK_SECONDS = Histogram(
+    'leopard_task_seconds', 'Duration of the celery tasks', ['task'], buckets=SECONDS_BUCKETS)
+TASK_DB_WRITE_SECONDS = Histogram(
+    'leopard_task_db_write_seconds', 'Duration of the database writes of the tasks', ['task'],
+    buckets=SECONDS_BUCKETS)
+CASES_FOUND = Counter(
+    'leopard_cases_found', 'New cases found by the tasks', ['task'])
+WATCHJOBS_SKIPPED = Counter(
+    'leopard_watchjobs_skipped',
+    'Watchjobs not checked by a cycle, as their check of a previous cycle was still in flight '
+    '("in_flight") or as they did not fit into the time budget of the cycle ("budget")', ['reason'])
+
+SMTP_SEND_SECONDS = Histogram(
+    'leopard_smtp_send_seconds', 'Duration of sending a message to the mail server',
+    buckets=SECONDS_BUCKETS)
+SMTP_CONNECTIONS = Counter(
+    'leopard_smtp_connections', 'SMTP connections opened by the pools')
+EMAILS_SENT = Counter(
+    'leopard_emails_sent', 'Messages sent to the mail server')
+
+
+def timed(task_name):
+    """Decorator recording the duration of a task function in TASK_SECONDS.
+    Args:
+        task_name (str): value of the task label
+    """
+    def decorator(function):
+        @wraps(function)
+        def wrapper(*args, **kwargs):
+            with TASK_SECONDS.labels(task=task_name).time():
+                return function(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def record_response(reader_name, response, started_at=None):
+    """Record a response of a reader.
+    Args:
+        reader_name (str): value of the reader label
+        response (requests.Response): the response, its body is read if it wasn't yet
+        started_at (float): time.perf_counter() when reading the body started, if the time until
+          the headers were received is in `response.elapsed`
+    """
+    size = len(response.content)
+    seconds = response.elapsed.total_seconds()
+    if started_at is not None:
+        seconds += time.perf_counter() - started_at
+    READER_REQUEST_SECONDS.labels(reader=reader_name, method=response.request.method).\
+        observe(seconds)
+    READER_PAGES.labels(reader=reader_name, status=str(response.status_code)).inc()
+    READER_RESPONSE_BYTES.labels(reader=reader_name).inc(size)
+
+
+def get_registry():
+    """Return the registry with the metrics to report: the metrics of all processes writing to
+    PROMETHEUS_MULTIPROC_DIR if that is set, otherwise the ones of this process."""
+    if os.environ.get('PROMETHEUS_MULTIPROC_DIR'):
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+        return registry
+    return REGISTRY
+
+
+def generate_metrics():
+    """Render the metrics in the Prometheus text format.
+    Returns:
+        Tuple[bytes, str]: the metrics and their content type
+    """
+    return generate_latest(get_registry()), CONTENT_TYPE_LATEST
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Serve the metrics of the processes of this '
+                                                 'machine')
+    parser.add_argument('--port', type=int, default=9100)
+    parser.add_argument('--address', default='127.0.0.1')
+    args = parser.parse_args()
+
+    start_http_server(args.port, addr=args.address, registry=get_registry())
+    while True:
+        time.sleep(3600)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,27 +1,89 @@
 """Main web blueprint."""
 
+import hmac
 import logging
+import os
+import threading
+import time
 import urllib.parse
 
-from flask import Blueprint, flash, render_template, url_for, request
+from flask import Blueprint, abort, flash, jsonify, render_template, url_for, request
 from sqlalchemy.exc import IntegrityError
 from sqlalchemy.orm.exc import NoResultFound
 from werkzeug.utils import redirect
 
-from leopard_lavatory.celery.tasks import send_confirm_email, send_welcome_email
-from leopard_lavatory.storage.database import add_request, database_session, confirm_request, delete_user
-from leopard_lavatory.utils import valid_email, valid_address, log_safe
+from leopard_lavatory.celery.tasks import dispatch, send_confirm_email, send_welcome_email
+from leopard_lavatory.storage.database import add_request, database_session, confirm_request, delete_user, \
+    get_gazetteer_entries
+from leopard_lavatory.utils import metrics, valid_email, valid_address, log_safe
+from leopard_lavatory.utils.address_index import AddressIndex
 
 LOG = logging.getLogger(__name__)
 
 bp = Blueprint('main', __name__)
 
+# the address index is reloaded from the gazetteer when it is older than this, to pick up a new
+#  crawl without restarting the web server
+ADDRESS_INDEX_MAX_AGE_SECONDS = int(os.environ.get('LEOPARD_ADDRESS_INDEX_MAX_AGE', '3600'))
+MAX_SUGGESTIONS = 20
+# token of the clients allowed to read the metrics (eg the bearer_token of a prometheus scrape
+#  config), /metrics is disabled without a token; the metrics sidecar (see utils.metrics) needs none
+METRICS_TOKEN = os.environ.get('LEOPARD_METRICS_TOKEN')
+
+_address_index = None
+_address_index_loaded_at = 0
+_address_index_lock = threading.Lock()
+
+
+def get_address_index():
+    """Return the address index, (re)loading it from the gazetteer if it is too old.
+
+    While one request reloads the index, the other requests keep using the old one.
+    Returns:
+        AddressIndex: the index of all streets and properties in the gazetteer
+    """
+    global _address_index, _address_index_loaded_at
+    if _address_index is None or \
+            time.monotonic() - _address_index_loaded_at > ADDRESS_INDEX_MAX_AGE_SECONDS:
+        blocking = _address_index is None
+        if _address_index_lock.acquire(blocking=blocking):
+            try:
+                with database_session() as dbs:
+                    _address_index = AddressIndex(get_gazetteer_entries(dbs))
+                _address_index_loaded_at = time.monotonic()
+                LOG.info(f'Loaded address index with {len(_address_index)} entries')
+            finally:
+                _address_index_lock.release()
+    return _address_index
+
+
+def reset_address_index():
+    """Drop the loaded address index, so that the next request reloads it."""
+    global _address_index
+    _address_index = None
+
+
+def canonical_address(address):
+    """Find the name of the street address or property in the gazetteer that a user means, so
+    that eg "brunnsgatan  1" and "Brunnsg. 1" result in the same watchjob as "Brunnsgatan 1".
+    Args:
+        address (str): the address as typed by the user
+    Returns:
+        Optional[str]: the name from the gazetteer, None if the address is unknown, or the
+          address itself if the gazetteer has not been crawled yet
+    """
+    address_index = get_address_index()
+    if not len(address_index):
+        return address
+    entry = address_index.canonicalize(address)
+    return entry[0] if entry is not None else None
+
 
 def handle_new_request(email, address):
     """Handle new watchjob requests submitted to the website.
 
     This checks the untrusted user input `email` and `address` and, if valid, creates a
-    new database UserRequest record.
+    new database UserRequest record for the address as named in the gazetteer.
     Args:
         email (str): untrusted user input string for the email address
         address (str): untrusted user input string for the address
@@ -32,13 +94,20 @@ def handle_new_request(email, address):
             assert valid_address(address), f'Got invalid address: {log_safe(address)}'
             assert valid_email(email), f'Got invalid email: {log_safe(email)}'
 
+            canonical = canonical_address(address)
+            if canonical is None:
+                LOG.info(f'Got unknown address: {log_safe(address)}')
+                flash(f'Hittade ingen gatuadress eller fastighet som heter {address}.')
+                return
+            address = canonical
+
             # TODO:  do street/fastighet distinction
             request_token = add_request(dbs, email, watchjob_query={'street': address})
             LOG.debug(f'Request stored in database (token: {request_token}).')
 
             confirm_link = urllib.parse.urljoin(request.url_root, url_for('main.confirm', t=request_token))
 
-            send_confirm_email.apply_async(args=[email, confirm_link, address])
+            dispatch(send_confirm_email, [email, confirm_link, address])
 
             flash(f'Tagit emot bevakningsförfrågan. '
                   f'Aktivera den med länken som skickades till {email}.')
@@ -67,7 +136,7 @@ def handle_confirm_request(token):
 
                 delete_link = urllib.parse.urljoin(request.url_root, url_for('main.delete', t=user.delete_token))
 
-                send_welcome_email.apply_async(args=[user.email, delete_link])
+                dispatch(send_welcome_email, [user.email, delete_link])
             else:
                 LOG.debug('Added watchjob to existing user {user.email}')
 
@@ -117,6 +186,36 @@ def index():
         return render_template('index.html')
 
 
+@bp.route('/suggest')
+def suggest():
+    """Suggest street addresses and properties starting with the query string `q`.
+    Returns:
+        werkzeug.wrappers.Response: json with a list of suggestions (name and kind)
+    """
+    prefix = request.args.get('q', '')[:255]
+    limit = min(request.args.get('limit', 10, type=int), MAX_SUGGESTIONS)
+
+    suggestions = get_address_index().search(prefix, limit)
+
+    return jsonify(suggestions=[{'name': name, 'kind': kind} for name, kind in suggestions])
+
+
+@bp.route('/metrics')
+def metrics_endpoint():
+    """Report the metrics of the watch pipeline in the Prometheus text format, to clients with
+    the metrics token only (in an "Authorization: Bearer" header). The client address is not
+    checked, as all clients come from the same address behind a reverse proxy.
+    Returns:
+        werkzeug.wrappers.Response: the metrics
+    """
+    authorization = request.headers.get('Authorization', '')
+    if not METRICS_TOKEN or not hmac.compare_digest(authorization.encode(),
+                                                    'Bearer {}'.format(METRICS_TOKEN).encode()):
+        abort(404)
+    body, content_type = metrics.generate_metrics()
+    return body, 200, {'Content-Type': content_type}
+
+
 @bp.route('/confirm', methods=('GET', 'POST'))
 def confirm():
     """Render the confirmation page and confirm user requests (ie create a user).
@@ -0,0 +1,200 @@
+"""Fixtures for offline reader tests, imitating the insynsbk.stockholm.se search pages."""
+import json
+import threading
+from urllib.parse import parse_qsl, urlsplit
+
+import pytest
+import requests
+from requests.adapters import BaseAdapter
+
+from leopard_lavatory.readers.case import Case
+
+FIELD_PREFIX = 'ctl00$FullContentRegion$ContentRegion$SecondaryContentRegion$'
+
+PAGE_TEMPLATE = '''<!DOCTYPE html>
+<html>
+<head><meta http-equiv="Content-Type" content="text/html; charset=utf-8" /><title>
+    Sök ärenden
+</title></head>
+<body>
+<form name="aspnetForm" method="post" action="./Default.aspx" id="aspnetForm">
+<input type="hidden" name="__EVENTTARGET" id="__EVENTTARGET" value="" />
+<input type="hidden" name="__EVENTARGUMENT" id="__EVENTARGUMENT" value="" />
+<input type="hidden" name="__VIEWSTATE" id="__VIEWSTATE" value="{viewstate}" />
+<input type="hidden" name="__EVENTVALIDATION" id="__EVENTVALIDATION" value="{viewstate}-validation" />
+<input name="{prefix}SearchPropertyAndCase$SearchProperty$AddressInput" type="text" value="{address}" />
+<input name="{prefix}SearchPropertyAndCase$SearchProperty$PropertyIdInput" type="text" value="" />
+<input type="checkbox" name="{prefix}SearchPropertyAndCase$OnlyOpen" />
+<select name="{prefix}SearchPropertyAndCase$Sort">
+  <option value="date">Datum</option>
+  <option value="id" selected="selected">Diarienummer</option>
+</select>
+<input type="submit" name="{prefix}SearchPropertyAndCase$SearchButton" value="Sök" />
+<table class="layout"><tr><td>Meny</td><td>Sök</td></tr></table>
+<table id="ctl00_FullContentRegion_ContentRegion_SecondaryContentRegion_CaseList_CaseGrid">
+<tr class="DataGridHeader">
+<td>Diarienummer</td><td>Fastighet</td><td>Ärendetyp</td><td>Beskrivning</td><td>Inkom</td>
+</tr>
+{rows}
+<tr class="DataGridPager"><td colspan="5"><a href="javascript:__doPostBack('{prefix}CaseList$CaseGrid','Page$Next')">Nästa</a></td></tr>
+</table>
+</form>
+</body>
+</html>
+'''
+
+ROW_TEMPLATE = '''<tr>
+<td class="DataGridItemCell"><a href="Arende.aspx?id={id}">{id}</a></td>
+<td class="DataGridItemCell">
+  {fastighet}
+</td>
+<td class="DataGridItemCell">{type}</td>
+<td class="DataGridItemCell">{description}</td>
+<td class="DataGridItemCell">{date}</td>
+</tr>'''
+
+
+def make_cases(address, num_cases, year=2018):
+    """Generate `num_cases` cases for an address, newest first."""
+    return [Case(id=f'{year}-{number:05}',
+                 fastighet=f'{address.split()[0].upper()} {number % 7 + 1}',
+                 type='Bygglov',
+                 description=f'Ändring av fasad, nr {number}',
+                 date=f'{year}-{(number % 12) + 1:02}-{(number % 28) + 1:02}')
+            for number in range(num_cases, 0, -1)]
+
+
+def render_page(cases, viewstate='vs0', address=''):
+    """Render a search result page with the given cases."""
+    rows = '\n'.join(ROW_TEMPLATE.format(**case._asdict()) for case in cases)
+    return PAGE_TEMPLATE.format(prefix=FIELD_PREFIX, viewstate=viewstate, address=address,
+                                rows=rows)
+
+
+class FakeSearch:
+    """State of the fake search, answering the ASP.NET postbacks with paginated cases."""
+
+    page_size = 10
+
+    def __init__(self, cases_per_address=25):
+        self.cases_per_address = cases_per_address
+        self.requests = []
+        self._sessions = {}
+
+    def respond(self, session_id, method, form):
+        """Return the html for a request of the given session and the submitted form fields."""
+        self.requests.append((method, dict(form)))
+        if method == 'GET':
+            self._sessions[session_id] = {'address': None, 'page': 0, 'viewstate': 'vs0'}
+            return 200, render_page([], viewstate='vs0')
+
+        state = self._sessions.get(session_id)
+        if state is None or form.get('__VIEWSTATE') != state['viewstate']:
+            return 500, '<html><head><title>Runtime Error</title></head><body></body></html>'
+
+        if form.get(FIELD_PREFIX + 'SearchPropertyAndCase$SearchButton'):
+            state['address'] = form[FIELD_PREFIX + 'SearchPropertyAndCase$SearchProperty$AddressInput']
+            state['page'] = 0
+        elif form.get('__EVENTARGUMENT') == 'Page$Next':
+            num_pages = -(-self.cases_per_address // self.page_size)
+            state['page'] = min(state['page'] + 1, num_pages - 1)
+        elif form.get('__EVENTARGUMENT', '').startswith('Page$'):
+            num_pages = -(-self.cases_per_address // self.page_size)
+            state['page'] = min(int(form['__EVENTARGUMENT'][5:]) - 1, num_pages - 1)
+
+        cases = make_cases(state['address'], self.cases_per_address)
+        start = state['page'] * self.page_size
+        state['viewstate'] = f'vs{len(self.requests)}'
+        return 200, render_page(cases[start:start + self.page_size], state['viewstate'],
+                                state['address'])
+
+    def expire_sessions(self):
+        """Forget all sessions, like the server does after a timeout."""
+        self._sessions.clear()
+
+
+class FakeSearchAdapter(BaseAdapter):
+    """Transport adapter for requests that answers with a `FakeSearch` instead of the network.
+    Every adapter (ie every mounted session) is one session of the fake search."""
+
+    def __init__(self, fake_search):
+        super().__init__()
+        self.fake_search = fake_search
+
+    def send(self, request, **kwargs):
+        body = request.body or ''
+        form = dict(parse_qsl(body.decode() if isinstance(body, bytes) else body))
+        status, html = self.fake_search.respond(id(self), request.method, form)
+        response = requests.Response()
+        response.status_code = status
+        response.headers['Content-Type'] = 'text/html; charset=utf-8'
+        response.encoding = 'utf-8'
+        response._content = html.encode('utf-8')
+        response.url = request.url
+        response.request = request
+        return response
+
+    def close(self):
+        pass
+
+
+class FakeKartor:
+    """Fake suggestions of kartor.stockholm.se for a list of street addresses and fastigheter,
+    returning at most the requested number of rows like the real site."""
+
+    def __init__(self, streets, properties):
+        self.rows = sorted([(name, 'fa fa-map-marker') for name in streets] +
+                           [(name, 'fa fa-square-o') for name in properties])
+        self.prefixes = []
+        self._lock = threading.Lock()
+
+    def respond(self, prefix, max_rows):
+        with self._lock:
+            self.prefixes.append(prefix)
+        rows = [{'RESULT': name, 'SYMBOL': symbol} for name, symbol in self.rows
+                if name.lower().startswith(prefix.lower())][:max_rows]
+        return json.dumps({'rows': len(rows), 'dbrows': rows})
+
+
+class FakeKartorAdapter(BaseAdapter):
+    """Transport adapter for requests that answers with a `FakeKartor` instead of the network."""
+
+    def __init__(self, fake_kartor):
+        super().__init__()
+        self.fake_kartor = fake_kartor
+
+    def send(self, request, **kwargs):
+        query = dict(parse_qsl(urlsplit(request.url).query))
+        response = requests.Response()
+        response.status_code = 200
+        if 'maxrows' in query:
+            response.headers['Content-Type'] = 'application/json; charset=utf-8'
+            body = self.fake_kartor.respond(query['1'], int(query['maxrows']))
+        else:
+            response.headers['Content-Type'] = 'text/html; charset=utf-8'
+            body = '<html><head><title>Stockholms stad</title></head><body></body></html>'
+        response.encoding = 'utf-8'
+        response._content = body.encode('utf-8')
+        response.url = request.url
+        response.request = request
+        return response
+
+    def close(self):
+        pass
+
+
+@pytest.fixture
+def fake_search():
+    """The state of a fake insynsbk search."""
+    return FakeSearch()
+
+
+@pytest.fixture
+def offline_sbk_reader(fake_search):
+    """SBKReader answered by the fake search instead of insynsbk.stockholm.se."""
+    from leopard_lavatory.readers.sthlm_sbk import SBKReader
+
+    reader = SBKReader(avg_delay_seconds=0)
+    reader.random_sleep = lambda: None
+    reader.browser.session.mount('http://', FakeSearchAdapter(fake_search))
+    return reader
@@ -0,0 +1,21 @@
+"""Test the record/replay transport of the readers."""
+
+from leopard_lavatory.readers.sthlm_sbk import SBKReader
+from conftest import FakeSearchAdapter, make_cases
+
+
+def test_record_and_replay(tmp_path, fake_search):
+    recording_reader = SBKReader()
+    recording_reader.random_sleep = lambda: None
+    recording_reader.use_cassette(str(tmp_path), record=True,
+                                  adapter=FakeSearchAdapter(fake_search))
+    assert recording_reader.get_cases('Brunnsgatan 1') == make_cases('Brunnsgatan 1', 25)
+    num_requests = len(fake_search.requests)
+    assert len(list(tmp_path.iterdir())) == num_requests
+
+    replaying_reader = SBKReader()
+    replaying_reader.random_sleep = lambda: None
+    replaying_reader.use_cassette(str(tmp_path))
+    assert replaying_reader.get_cases('Brunnsgatan 1') == make_cases('Brunnsgatan 1', 25)
+    # all responses came from the cassette
+    assert len(fake_search.requests) == num_requests
@@ -0,0 +1,61 @@
+"""Test the token bucket rate limiter shared by the readers."""
+import pytest
+
+from leopard_lavatory.readers.rate_limiter import MemoryBucketBackend, RateLimited, RateLimiter, \
+    RedisBucketBackend, parse_rates
+from leopard_lavatory.readers.sthlm_sbk import SBKReader
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+def test_memory_bucket_per_host():
+    clock = FakeClock()
+    limiter = RateLimiter(MemoryBucketBackend(clock), rates={'a.example.com': (0.5, 2)})
+
+    # burst of two, then one token every two seconds
+    assert limiter.try_acquire('a.example.com') == 0
+    assert limiter.try_acquire('a.example.com') == 0
+    assert limiter.try_acquire('a.example.com') == pytest.approx(2)
+
+    clock.now += 1
+    assert limiter.try_acquire('a.example.com') == pytest.approx(1)
+    clock.now += 1
+    assert limiter.try_acquire('a.example.com') == 0
+
+    # other hosts have their own bucket with the default rate
+    assert limiter.try_acquire('b.example.com') == 0
+
+
+def test_non_blocking_reader_raises():
+    limiter = RateLimiter(MemoryBucketBackend(FakeClock()),
+                          rates={'insynsbk.stockholm.se': (0.2, 1)})
+    reader = SBKReader(rate_limiter=limiter, block_on_rate_limit=False)
+
+    reader.throttle(reader.url)
+    with pytest.raises(RateLimited) as error:
+        reader.throttle(reader.url)
+    assert error.value.retry_after == pytest.approx(5)
+
+
+def test_redis_bucket_shared():
+    fakeredis = pytest.importorskip('fakeredis')
+    server = fakeredis.FakeServer()
+    rates = {'a.example.com': (0.1, 1)}
+    limiter_a = RateLimiter(RedisBucketBackend(fakeredis.FakeRedis(server=server)), rates)
+    limiter_b = RateLimiter(RedisBucketBackend(fakeredis.FakeRedis(server=server)), rates)
+
+    assert limiter_a.try_acquire('a.example.com') == 0
+    # the second "worker" has to wait for the bucket of the first one to refill
+    assert 9 < limiter_b.try_acquire('a.example.com') <= 10
+
+
+def test_parse_rates():
+    assert parse_rates('') == {}
+    assert parse_rates('a.example.com=0.5:3, b.example.com=2') == {'a.example.com': (0.5, 3),
+                                                                   'b.example.com': (2.0, 1)}
@@ -0,0 +1,70 @@
+"""Testing the pool of readers."""
+
+import pytest
+
+from leopard_lavatory.readers.rate_limiter import RateLimited
+from leopard_lavatory.readers.reader_pool import ReaderPool
+
+
+class FakeReader:
+    def __init__(self):
+        self.closed = False
+
+    def close(self):
+        self.closed = True
+
+
+def test_reuses_readers():
+    created = []
+
+    def create_reader():
+        created.append(FakeReader())
+        return created[-1]
+
+    pool = ReaderPool(create_reader, size=1)
+    pool.warm()
+    with pool.checkout() as first:
+        pass
+    with pool.checkout() as second:
+        # a second reader while the first one is checked out
+        with pool.checkout() as third:
+            pass
+
+    assert first is second
+    assert third is not second
+    # only one idle reader is kept
+    assert len(created) == 2
+    assert len(pool) == 1
+    assert third.closed or second.closed
+
+
+def test_closes_failed_readers():
+    pool = ReaderPool(FakeReader)
+
+    with pytest.raises(RateLimited):
+        with pool.checkout() as rate_limited:
+            raise RateLimited('localhost', 1.0)
+    # the reader was not used yet
+    assert not rate_limited.closed
+
+    with pytest.raises(ValueError):
+        with pool.checkout() as failed:
+            raise ValueError('Search was rejected')
+    assert failed is rate_limited
+    assert failed.closed
+    assert len(pool) == 0
+
+
+def test_evicts_idle_and_used_up_readers():
+    pool = ReaderPool(FakeReader, max_idle=0)
+    with pool.checkout() as reader:
+        pass
+    assert pool.evict_idle() == 1
+    assert reader.closed
+
+    pool = ReaderPool(FakeReader, max_uses=2)
+    for _ in range(2):
+        with pool.checkout() as reader:
+            pass
+    assert reader.closed
+    assert len(pool) == 0
@@ -1,7 +1,11 @@
 """Test sthlm_sbk reader."""
 import json
+import os
 
-from leopard_lavatory.readers.sthlm_sbk import SBKReader
+from leopard_lavatory.readers import sthlm_sbk
+from leopard_lavatory.readers.sthlm_sbk import SBKReader, extract_form_fields, find_form, \
+    parse_case_grid, parse_html, case_sort_key, take_new_cases
+from conftest import make_cases
 
 
 def test_sthlm_sbk():
@@ -16,3 +20,145 @@ def test_sthlm_sbk():
     print(json.dumps(test_cases, indent=2, ensure_ascii=False))
 
     assert len(test_cases) > 23
+
+
+def test_get_cases_offline(offline_sbk_reader, fake_search):
+    assert offline_sbk_reader.get_cases('Brunnsgatan 1') == make_cases('Brunnsgatan 1', 25)
+    assert offline_sbk_reader.get_cases('Brunnsgatan 1', '2018-00012') == \
+        make_cases('Brunnsgatan 1', 25)[:13]
+
+
+def test_iter_pages_is_lazy(offline_sbk_reader, fake_search):
+    pages = offline_sbk_reader.iter_pages('Brunnsgatan 1')
+    assert len(fake_search.requests) == 0
+
+    # only the search form and the first page are requested for the first page of cases
+    assert next(pages) == make_cases('Brunnsgatan 1', 25)[:10]
+    assert len(fake_search.requests) == 2
+
+    assert [len(cases) for cases in pages] == [10, 5]
+    assert list(offline_sbk_reader.iter_cases('Brunnsgatan 1', '2018-00012')) == \
+        make_cases('Brunnsgatan 1', 25)[:13]
+
+
+def test_records_metrics(offline_sbk_reader, fake_search):
+    from prometheus_client import REGISTRY
+
+    def sample(name, **labels):
+        return REGISTRY.get_sample_value(name, dict(reader='SBKReader', **labels)) or 0
+
+    pages_before = sample('leopard_reader_pages_total', status='200')
+    parses_before = sample('leopard_reader_parse_seconds_count', step='cases')
+
+    offline_sbk_reader.get_cases('Brunnsgatan 1')
+
+    assert sample('leopard_reader_pages_total', status='200') - pages_before == \
+        len(fake_search.requests)
+    # every result page is parsed, ie all requests except the one of the search form
+    assert sample('leopard_reader_parse_seconds_count', step='cases') - parses_before == \
+        len(fake_search.requests) - 1
+    assert sample('leopard_reader_response_bytes_total') > 0
+
+
+def test_case_sort_key():
+    assert case_sort_key('2008-09960') == (2008, 9960)
+    assert case_sort_key('2009-00001') > case_sort_key('2008-09960')
+    assert case_sort_key('2008-10000') > case_sort_key('2008-09960')
+    assert case_sort_key(None) is None
+    assert case_sort_key(0) is None
+    assert case_sort_key('BN 2008/123') is None
+
+
+def test_take_new_cases():
+    cases = [{'id': '2018-00030', 'date': '2018-05-03'},
+             {'id': '2018-00020', 'date': '2018-04-01'},
+             {'id': '2017-00900', 'date': '2017-12-30'}]
+
+    assert take_new_cases(cases, set()) == (cases, False)
+    assert take_new_cases(cases, set(), '2018-00020') == (cases[:1], True)
+    # the watermark case was withdrawn, stop at the first older case
+    assert take_new_cases(cases, set(), '2018-00025') == (cases[:1], True)
+    assert take_new_cases(cases, set(), newer_than_date='2018-01-01') == (cases[:2], True)
+    # an unknown case id format never stops the search by itself
+    assert take_new_cases(cases, set(), 'BN 2018/1') == (cases, False)
+    # the page after the last page repeats the last page
+    assert take_new_cases(cases, {'2018-00030', '2018-00020', '2017-00900'}) == ([], True)
+
+
+def test_search_form_state_is_reused(offline_sbk_reader, fake_search):
+    offline_sbk_reader.get_cases('Brunnsgatan 1')
+    first_watchjob_requests = len(fake_search.requests)
+    offline_sbk_reader.get_cases('Drottninggatan 30')
+    second_watchjob_requests = len(fake_search.requests) - first_watchjob_requests
+
+    # the search form page is only requested once per session: 1 GET + 1 search + 3 next pages
+    #  for the first watchjob, 1 request less for every following watchjob
+    assert [method for method, form in fake_search.requests].count('GET') == 1
+    assert first_watchjob_requests == 5
+    assert second_watchjob_requests == 4
+
+
+def test_rejected_form_state_is_refreshed(offline_sbk_reader, fake_search):
+    offline_sbk_reader.get_cases('Brunnsgatan 1')
+    fake_search.expire_sessions()
+
+    assert offline_sbk_reader.get_cases('Drottninggatan 30') == make_cases('Drottninggatan 30', 25)
+    assert [method for method, form in fake_search.requests].count('GET') == 2
+
+
+def test_crawl_continues_from_checkpoint(offline_sbk_reader, fake_search):
+    cases = make_cases('Brunnsgatan 1', 25)
+    pages = offline_sbk_reader.iter_pages('Brunnsgatan 1')
+    assert [next(pages), next(pages)] == [cases[:10], cases[10:20]]
+    checkpoint = json.loads(json.dumps(offline_sbk_reader.checkpoint()))
+    assert checkpoint['page'] == 2
+
+    # another reader in the same session continues with the next page: 1 next page + 1 page to
+    #  detect the last page
+    num_requests = len(fake_search.requests)
+    reader = SBKReader(avg_delay_seconds=0)
+    reader.browser.session.mount('http://', offline_sbk_reader.browser.session.get_adapter(
+        SBKReader.url))
+    assert list(reader.iter_pages('Brunnsgatan 1', checkpoint=checkpoint)) == [cases[20:]]
+    assert len(fake_search.requests) - num_requests == 2
+
+    # after the session expired, the search is repeated and the crawl jumps to the next page
+    fake_search.expire_sessions()
+    assert list(reader.iter_pages('Brunnsgatan 1', checkpoint=checkpoint)) == [cases[20:]]
+    assert fake_search.requests[-2][1]['__EVENTARGUMENT'] == 'Page$3'
+
+
+def test_failed_page_is_retried(offline_sbk_reader, fake_search, monkeypatch):
+    sleeps = []
+    monkeypatch.setattr(sthlm_sbk.time, 'sleep', sleeps.append)
+    respond = fake_search.respond
+    failures = []
+
+    def respond_with_error(session_id, method, form):
+        if form.get('__EVENTARGUMENT') == 'Page$Next' and not failures:
+            failures.append(form)
+            return 503, '<html><head><title>Service Unavailable</title></head></html>'
+        return respond(session_id, method, form)
+
+    monkeypatch.setattr(fake_search, 'respond', respond_with_error)
+
+    assert offline_sbk_reader.get_cases('Brunnsgatan 1') == make_cases('Brunnsgatan 1', 25)
+    assert sleeps == [sthlm_sbk.PAGE_RETRY_SECONDS]
+
+
+def test_parse_case_grid():
+    with open(os.path.join(os.path.dirname(__file__), 'fixtures', 'sbk_result_page.html'),
+              'rb') as file:
+        page = parse_html(file.read())
+
+    # only the rows of the case grid, not the header, pager or other tables
+    assert parse_case_grid(page) == make_cases('Brunnsgatan 1', 10)
+
+    form_fields = extract_form_fields(find_form(page, SBKReader.form_id))
+    assert len(form_fields['__VIEWSTATE']) > 1000
+    assert form_fields[SBKReader.field_name_prefix + SBKReader.address_field_name] == \
+        'Brunnsgatan 1'
+    # unchecked checkboxes and submit buttons are not submitted, selects use the selected option
+    assert form_fields[SBKReader.field_name_prefix + 'SearchPropertyAndCase$Sort'] == 'id'
+    assert SBKReader.field_name_prefix + 'SearchPropertyAndCase$OnlyOpen' not in form_fields
+    assert SBKReader.field_name_prefix + SBKReader.search_button_name not in form_fields
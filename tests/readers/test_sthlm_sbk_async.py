@@ -0,0 +1,72 @@
+"""Test the asyncio sthlm_sbk reader against a local fake search page."""
+import asyncio
+
+from aiohttp import web
+
+from leopard_lavatory.readers.sthlm_sbk_async import AsyncSBKReader
+from conftest import make_cases
+
+
+def run_with_fake_server(fake_search, coroutine_function, in_flight=None):
+    """Serve the fake search on a local port and run the coroutine function with its url.
+    Requests take a moment and are counted in `in_flight` (current and maximum), if given."""
+    async def handle(request):
+        if in_flight is not None:
+            in_flight['current'] += 1
+            in_flight['max'] = max(in_flight['max'], in_flight['current'])
+            await asyncio.sleep(0.02)
+            in_flight['current'] -= 1
+        session_id = request.cookies.get('ASP.NET_SessionId')
+        if request.method == 'GET':
+            session_id = str(len(fake_search.requests))
+        status, html = fake_search.respond(session_id, request.method, await request.post())
+        response = web.Response(status=status, text=html, content_type='text/html')
+        response.set_cookie('ASP.NET_SessionId', session_id)
+        return response
+
+    async def main():
+        app = web.Application()
+        app.router.add_route('*', '/Arenden/{tail:.*}', handle)
+        runner = web.AppRunner(app)
+        await runner.setup()
+        site = web.TCPSite(runner, '127.0.0.1', 0)
+        await site.start()
+        port = site._server.sockets[0].getsockname()[1]
+        try:
+            return await coroutine_function('http://localhost:{}/Arenden/'.format(port))
+        finally:
+            await runner.cleanup()
+
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(main())
+    finally:
+        loop.close()
+
+
+def test_get_cases_for_addresses(fake_search):
+    async def crawl(url):
+        reader = AsyncSBKReader(max_per_host=2, avg_delay_seconds=0)
+        reader.url = url
+        reader.random_sleep = lambda: asyncio.sleep(0)
+        return await reader.get_cases_for_addresses([('Brunnsgatan 1', None, None),
+                                                     ('Drottninggatan 30', '2018-00015', None)])
+
+    brunnsgatan, drottninggatan = run_with_fake_server(fake_search, crawl)
+
+    assert brunnsgatan == make_cases('Brunnsgatan 1', 25)
+    assert drottninggatan == make_cases('Drottninggatan 30', 25)[:10]
+
+
+def test_max_per_host(fake_search):
+    async def crawl(url):
+        reader = AsyncSBKReader(max_per_host=2, avg_delay_seconds=0)
+        reader.url = url
+        reader.random_sleep = lambda: asyncio.sleep(0)
+        return await reader.get_cases_for_addresses([('Brunnsgatan 1', None, None)] * 5)
+
+    in_flight = {'current': 0, 'max': 0}
+    results = run_with_fake_server(fake_search, crawl, in_flight)
+
+    assert results == [make_cases('Brunnsgatan 1', 25)] * 5
+    assert in_flight['max'] == 2
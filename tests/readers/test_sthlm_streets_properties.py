@@ -1,6 +1,9 @@
 """Testing reader and storage for sthlm_streets_properties."""
 
-from leopard_lavatory.readers.sthlm_streets_properties import SthlmStreetsProperties
+from leopard_lavatory.readers.rate_limiter import MemoryBucketBackend, RateLimiter
+from leopard_lavatory.readers.sthlm_streets_properties import SthlmStreetsProperties, ALPHABET, \
+    crawl_all, split_prefix
+from conftest import FakeKartor, FakeKartorAdapter
 
 
 class TestSthlmStreetsProperties:
@@ -11,3 +14,31 @@ class TestSthlmStreetsProperties:
         # noinspection PyArgumentEqualDefault
         n, s, p = sp_reader.get_suggestion_list('B', 10)
         assert n == len(s) + len(p) == 10
+
+
+def test_crawl_all_splits_saturated_prefixes():
+    streets = [f'Brunnsgatan {number}' for number in range(1, 40)] + \
+        [f'Bragevägen {number}' for number in range(1, 15)] + ['Östermalmsgatan 1']
+    properties = [f'Bälgen {number}' for number in range(1, 30)] + ['Rännilen 19']
+    fake_kartor = FakeKartor(streets, properties)
+    rate_limiter = RateLimiter(MemoryBucketBackend(), rates={}, default_rate=(1000, 1000))
+
+    def create_reader():
+        reader = SthlmStreetsProperties(rate_limiter=rate_limiter)
+        reader.browser.session.mount('https://', FakeKartorAdapter(fake_kartor))
+        return reader
+
+    stored = {}
+
+    def store(prefix, num_rows, s, p, children):
+        assert prefix not in stored
+        stored[prefix] = (s, p, children)
+
+    num_crawled = crawl_all(ALPHABET, store, create_reader, num_workers=3, max_rows=20)
+
+    assert num_crawled == len(stored) == len(fake_kartor.prefixes)
+    assert set(stored['B'][2]) == set(split_prefix('B'))
+    assert stored['Ö'][2] == []
+    # everything is found, although no prefix may return more than 20 rows
+    assert set().union(*(s for s, p, children in stored.values())) == set(streets)
+    assert set().union(*(p for s, p, children in stored.values())) == set(properties)
@@ -0,0 +1,155 @@
+"""Test the adaptive concurrency limit and circuit breaker shared by the readers."""
+import fakeredis
+import pytest
+import requests
+from requests.adapters import BaseAdapter
+
+from leopard_lavatory.readers.rate_limiter import MemoryBucketBackend, RateLimited, RateLimiter
+from leopard_lavatory.readers.sthlm_sbk import SBKReader
+from leopard_lavatory.readers.upstream_health import INITIAL_LATENCY, MemoryHealthBackend, \
+    RedisHealthBackend, UpstreamHealth, UpstreamUnavailable
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture(params=['memory', 'redis'])
+def backend(request):
+    if request.param == 'memory':
+        return MemoryHealthBackend()
+    return RedisHealthBackend(fakeredis.FakeRedis())
+
+
+def test_concurrency_limit_aimd(backend):
+    health = UpstreamHealth(backend, clock=FakeClock(), initial_limit=2, max_limit=4)
+
+    first = health.acquire('a.example.com', blocking=False)
+    second = health.acquire('a.example.com', blocking=False)
+    with pytest.raises(UpstreamUnavailable) as error:
+        health.acquire('a.example.com', blocking=False)
+    assert error.value.reason == 'busy'
+    # other hosts have their own limit
+    health.record('b.example.com', health.acquire('b.example.com', blocking=False), 0.1, True)
+
+    # additive increase: three fast responses at limit 2 allow a third concurrent request
+    health.record('a.example.com', first, 0.1, True)
+    health.record('a.example.com', second, 0.1, True)
+    health.record('a.example.com', health.acquire('a.example.com', blocking=False), 0.1, True)
+    leases = [health.acquire('a.example.com', blocking=False) for _ in range(3)]
+    with pytest.raises(UpstreamUnavailable):
+        health.acquire('a.example.com', blocking=False)
+
+    # multiplicative decrease: a slow response halves the limit to one
+    health.record('a.example.com', leases[0], 30.0, True)
+    with pytest.raises(UpstreamUnavailable):
+        health.acquire('a.example.com', blocking=False)
+    health.record('a.example.com', leases[1], 0.1, True)
+    health.record('a.example.com', leases[2], 0.1, True)
+
+
+def test_busy_retry_after_typical_latency(backend):
+    health = UpstreamHealth(backend, clock=FakeClock(), initial_limit=1)
+
+    lease = health.acquire('a.example.com', blocking=False)
+    with pytest.raises(UpstreamUnavailable) as error:
+        health.acquire('a.example.com', blocking=False)
+    assert error.value.retry_after == INITIAL_LATENCY
+
+    # the fast response raised the limit to two
+    health.record('a.example.com', lease, 3.0, True)
+    lease = health.acquire('a.example.com', blocking=False)
+    health.acquire('a.example.com', blocking=False)
+    with pytest.raises(UpstreamUnavailable) as error:
+        health.acquire('a.example.com', blocking=False)
+    assert error.value.retry_after == pytest.approx(3.0)
+
+    # a released slot is free again
+    health.release('a.example.com', lease)
+    health.acquire('a.example.com', blocking=False)
+
+
+def test_circuit_breaker(backend):
+    clock = FakeClock()
+    health = UpstreamHealth(backend, clock=clock, failure_threshold=3, open_seconds=60)
+
+    for _ in range(3):
+        health.record('a.example.com', health.acquire('a.example.com'), 0.1, False)
+
+    # open: requests are rejected even when blocking, with the time until it is half open
+    with pytest.raises(RateLimited) as error:
+        health.acquire('a.example.com')
+    assert error.value.reason == 'open'
+    assert error.value.retry_after == pytest.approx(60)
+    assert health.open_for('a.example.com') == pytest.approx(60)
+
+    # half open: a single probe, which opens the circuit again if it fails
+    clock.now += 60
+    probe = health.acquire('a.example.com', blocking=False)
+    with pytest.raises(UpstreamUnavailable):
+        health.acquire('a.example.com', blocking=False)
+    health.record('a.example.com', probe, 0.1, False)
+    assert health.open_for('a.example.com') == pytest.approx(60)
+
+    # a successful probe closes it
+    clock.now += 60
+    health.record('a.example.com', health.acquire('a.example.com'), 0.1, True)
+    assert health.open_for('a.example.com') == 0
+    health.acquire('a.example.com', blocking=False)
+
+
+class FailingAdapter(BaseAdapter):
+    """Transport adapter that times out every request."""
+
+    def __init__(self):
+        super().__init__()
+        self.timeouts = []
+
+    def send(self, request, **kwargs):
+        self.timeouts.append(kwargs.get('timeout'))
+        raise requests.exceptions.ReadTimeout('timed out')
+
+    def close(self):
+        pass
+
+
+def test_reader_opens_circuit():
+    health = UpstreamHealth(MemoryHealthBackend(), failure_threshold=2)
+    reader = SBKReader(upstream_health=health, timeout=3)
+    adapter = FailingAdapter()
+    reader.browser.session.mount('http://', adapter)
+
+    for _ in range(2):
+        with pytest.raises(requests.exceptions.Timeout):
+            reader.get_first_page('Brunnsgatan 1')
+    assert adapter.timeouts == [3, 3]
+
+    # no more requests while the circuit is open
+    with pytest.raises(UpstreamUnavailable):
+        reader.get_first_page('Brunnsgatan 1')
+    assert len(adapter.timeouts) == 2
+
+
+def test_reader_takes_slot_before_token():
+    limiter = RateLimiter(MemoryBucketBackend(clock=FakeClock()), rates={}, default_rate=(1.0, 1))
+    health = UpstreamHealth(MemoryHealthBackend(), initial_limit=1)
+    reader = SBKReader(rate_limiter=limiter, block_on_rate_limit=False, upstream_health=health)
+    host = reader.url.split('/')[2]
+
+    # a request rejected as the host is busy doesn't spend the token
+    lease = health.acquire(host)
+    with pytest.raises(UpstreamUnavailable) as error:
+        reader.open_search_form()
+    assert error.value.reason == 'busy'
+    health.release(host, lease)
+    assert limiter.try_acquire(host) == 0
+
+    # a rate limited request releases its slot
+    with pytest.raises(RateLimited) as error:
+        reader.open_search_form()
+    assert not isinstance(error.value, UpstreamUnavailable)
+    health.acquire(host, blocking=False)
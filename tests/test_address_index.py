@@ -0,0 +1,55 @@
+"""Testing the address index used for address suggestions."""
+
+from leopard_lavatory.utils.address_index import AddressIndex, fold_swedish
+
+
+class TestAddressIndex:
+
+    def test_fold_swedish(self):
+        assert fold_swedish('  Västerlånggatan   1 ') == 'västerlånggatan 1'
+        assert fold_swedish('CAFÉ') == 'cafe'
+        assert fold_swedish('Ærøgatan') == 'ärögatan'
+
+    def test_search(self):
+        index = AddressIndex([('street', 'Brunnsgatan 1'), ('street', 'Brunnsgatan 2'),
+                              ('street', 'Bryggargatan 9'), ('property', 'Bälgen 8'),
+                              ('street', 'Baltzar von Platens gata 1'), ('property', 'Åkeshov 1:1'),
+                              ('street', 'Östermalmsgatan 1'), ('street', 'Zinkens väg 3')])
+
+        assert index.search('brunns') == [('Brunnsgatan 1', 'street'), ('Brunnsgatan 2', 'street')]
+        assert index.search('BRUNNSGATAN  2') == [('Brunnsgatan 2', 'street')]
+        assert index.search('b', limit=3) == [('Baltzar von Platens gata 1', 'street'),
+                                              ('Brunnsgatan 1', 'street'),
+                                              ('Brunnsgatan 2', 'street')]
+        # ä is not a, and it is sorted after z
+        assert index.search('ba') == [('Baltzar von Platens gata 1', 'street')]
+        assert index.search('bä') == [('Bälgen 8', 'property')]
+        assert [name for name, kind in index.search('b', limit=10)][-1] == 'Bälgen 8'
+        assert index.search('åkeshov') == [('Åkeshov 1:1', 'property')]
+        assert index.search('') == []
+        assert index.search('x') == []
+
+    def test_canonicalize(self):
+        index = AddressIndex([('street', 'Brunnsgatan 1'), ('street', 'Brunnsgatan 12'),
+                              ('street', 'Bragevägen 4'), ('property', 'Bälgen 8'),
+                              ('street', 'Västerlånggatan 27')])
+
+        assert index.canonicalize('Brunnsgatan 1') == ('Brunnsgatan 1', 'street')
+        assert index.canonicalize(' brunnsgatan  1') == ('Brunnsgatan 1', 'street')
+        assert index.canonicalize('Brunnsg. 1') == ('Brunnsgatan 1', 'street')
+        assert index.canonicalize('Bragev. 4') == ('Bragevägen 4', 'street')
+        # typos
+        assert index.canonicalize('Brunsgatan 12') == ('Brunnsgatan 12', 'street')
+        assert index.canonicalize('Vasterlanggatan 27') == ('Västerlånggatan 27', 'street')
+        # a fuzzy match needs the same numbers
+        assert index.canonicalize('Brunnsgatan 2') is None
+        assert index.canonicalize('Drottninggatan 1') is None
+
+    def test_search_large_index(self):
+        # the timing of the search is measured by benchmarks/bench_address_index.py
+        index = AddressIndex(('street', 'Gata {}'.format(number)) for number in range(200000))
+
+        assert index.search('gata 1999', limit=3) == [('Gata 1999', 'street'), ('Gata 19990', 'street'),
+                                                      ('Gata 199900', 'street')]
+        assert len(index.search('gata 1', limit=10)) == 10
+        assert index.search('gata 200000') == []
@@ -0,0 +1,27 @@
+"""Testing the case index used for city wide sweeps."""
+
+from leopard_lavatory.utils.case_index import CaseIndex
+
+
+class TestCaseIndex:
+
+    def test_match_all(self):
+        index = CaseIndex()
+        index.add(1, ['Brunnsgatan 1', 'Bälgen 8'])
+        index.add(2, ['Drottninggatan 30', 'bälgen  8'])
+        index.add(3, ['Värmdövägen 1b', None])
+
+        cases = [{'id': '2018-00003', 'fastighet': 'BÄLGEN 8'},
+                 {'id': '2018-00002', 'fastighet': 'Rännilen 19'},
+                 {'id': '2018-00001', 'fastighet': 'Bälgen 8'}]
+
+        matches = index.match_all(cases)
+
+        assert set(matches) == {1, 2}
+        assert [case['id'] for case in matches[1]] == ['2018-00003', '2018-00001']
+        assert matches[2] == matches[1]
+
+    def test_match_without_fastighet(self):
+        index = CaseIndex()
+        index.add(1, ['Bälgen 8'])
+        assert index.match({'id': '2018-00001', 'fastighet': ''}) == set()
@@ -0,0 +1,34 @@
+"""Testing the polling schedule of the watchjobs."""
+
+from collections import Counter
+from datetime import datetime, timedelta
+
+from leopard_lavatory.celery import schedule
+
+
+class TestSchedule:
+
+    def test_next_run_at_is_spread_and_stable(self):
+        now = datetime(2018, 6, 1, 8, 0, 0)
+        runs = {watchjob_id: schedule.next_run_at(now, watchjob_id, 3600)
+                for watchjob_id in range(1, 3601)}
+
+        assert all(now < run_at <= now + timedelta(hours=1) for run_at in runs.values())
+        # spread over the whole hour, not all at minute 0
+        runs_per_minute = Counter(run_at.minute for run_at in runs.values())
+        assert len(runs_per_minute) == 60
+        assert max(runs_per_minute.values()) < 3 * 3600 / 60
+
+        # the next run after a run is exactly one interval later
+        run_at = runs[17]
+        assert schedule.next_run_at(run_at, 17, 3600) == run_at + timedelta(hours=1)
+        assert schedule.next_run_at(run_at - timedelta(minutes=5), 17, 3600) == run_at
+
+    def test_next_interval(self):
+        # busy addresses are checked more often, down to the minimum
+        assert schedule.next_interval(3600, 2) == 1800
+        assert schedule.next_interval(schedule.MIN_POLL_INTERVAL, 1) == schedule.MIN_POLL_INTERVAL
+        # quiet ones back off, up to the maximum
+        assert schedule.next_interval(3600, 0) == 5400
+        assert schedule.next_interval(schedule.MAX_POLL_INTERVAL, 0) == schedule.MAX_POLL_INTERVAL
+        assert schedule.next_interval(None, 0) == 5400
@@ -0,0 +1,43 @@
+"""Testing the msgpack serializer for the celery messages."""
+
+import json
+
+from kombu.serialization import dumps, loads
+
+from leopard_lavatory.celery.serialization import SERIALIZER_NAME
+from leopard_lavatory.readers.case import Case
+
+
+def make_case(number):
+    return Case(id=f'2018-{number:05}', fastighet='BÄLGEN 8', type='Bygglov',
+                description='Ändring av fasad', date='2018-06-01')
+
+
+class TestSerialization:
+
+    def test_round_trip(self):
+        cases = [make_case(number) for number in range(3)]
+        # the arguments and options of a task message (celery message protocol 2)
+        body = ((cases, 17), {}, {'callbacks': None, 'chain': None})
+
+        content_type, content_encoding, data = dumps(body, serializer=SERIALIZER_NAME)
+        (args, kwargs, embed) = loads(data, content_type, content_encoding)
+
+        assert args == [cases, 17]
+        assert all(type(case) is Case for case in args[0])
+        assert args[0][0]['fastighet'] == 'BÄLGEN 8'
+        assert embed == {'callbacks': None, 'chain': None}
+
+    def test_smaller_than_json(self):
+        cases = [make_case(number) for number in range(200)]
+
+        _, _, data = dumps([cases], serializer=SERIALIZER_NAME)
+        json_data = json.dumps([[case._asdict() for case in cases]]).encode('utf-8')
+
+        assert len(data) < 0.6 * len(json_data)
+
+    def test_case_is_dict_like(self):
+        case = make_case(1)
+        assert case['id'] == case.id == case[0] == '2018-00001'
+        assert case.get('address') is None
+        assert case._asdict()['date'] == '2018-06-01'
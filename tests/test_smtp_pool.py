@@ -0,0 +1,137 @@
+"""Testing the pooled SMTP connections against a local SMTP sink."""
+
+import smtplib
+import socketserver
+import threading
+
+import pytest
+
+from leopard_lavatory.emailer import create_message
+from leopard_lavatory.emailer.smtp_pool import SMTPPool
+
+
+class SinkHandler(socketserver.StreamRequestHandler):
+    """Minimal SMTP server side: accepts every message, and closes the connection after
+    `drop_after` messages if set (before the reply to the last message if `drop_before_reply`)."""
+
+    def reply(self, line):
+        self.wfile.write(line.encode() + b'\r\n')
+
+    def handle(self):
+        sink = self.server
+        with sink.lock:
+            sink.connections += 1
+        self.reply('220 sink ESMTP')
+        num_messages = 0
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            command = line.decode().strip().upper()
+            if command.startswith('QUIT'):
+                self.reply('221 bye')
+                return
+            if command.startswith('NOOP'):
+                with sink.lock:
+                    sink.noops += 1
+            if not command.startswith('DATA'):
+                # EHLO, MAIL, RCPT, NOOP, RSET
+                self.reply('250 ok')
+                continue
+
+            self.reply('354 end data with <CR><LF>.<CR><LF>')
+            data = []
+            for data_line in iter(self.rfile.readline, b''):
+                if data_line == b'.\r\n':
+                    break
+                data.append(data_line)
+            with sink.lock:
+                sink.messages.append(b''.join(data))
+            num_messages += 1
+            if sink.drop_after and num_messages >= sink.drop_after and sink.drop_before_reply:
+                return
+            self.reply('250 queued')
+            if sink.drop_after and num_messages >= sink.drop_after:
+                return
+
+
+class SMTPSink(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, drop_after=None):
+        super().__init__(('localhost', 0), SinkHandler)
+        self.drop_after = drop_after
+        self.drop_before_reply = False
+        self.noops = 0
+        self.connections = 0
+        self.messages = []
+        self.lock = threading.Lock()
+
+
+@pytest.fixture
+def sink():
+    server = SMTPSink()
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def make_messages(number):
+    return [create_message(f'user{index}@example.com', f'Test {index}', f'Text {index}', f'<p>{index}</p>')
+            for index in range(number)]
+
+
+def test_reuses_connection(sink):
+    pool = SMTPPool('localhost', sink.server_address[1])
+
+    assert pool.send(make_messages(5)) == 5
+    assert pool.send(make_messages(3)) == 3
+    pool.close()
+
+    assert len(sink.messages) == 8
+    assert sink.connections == 1
+    # no round trip to check the connection before every message
+    assert sink.noops == 0
+
+
+def test_reconnects_when_connection_lost(sink):
+    sink.drop_after = 2
+    pool = SMTPPool('localhost', sink.server_address[1])
+
+    assert pool.send(make_messages(5)) == 5
+    pool.close()
+
+    assert len(sink.messages) == 5
+    assert b'Subject: Test 4' in sink.messages[-1]
+    assert sink.connections == 3
+
+
+def test_does_not_resend_accepted_message(sink):
+    sink.drop_after = 2
+    sink.drop_before_reply = True
+    pool = SMTPPool('localhost', sink.server_address[1])
+
+    with pytest.raises(smtplib.SMTPServerDisconnected):
+        pool.send(make_messages(3))
+    pool.close()
+
+    # the second message was accepted before the connection was lost, and is not sent again
+    assert len(sink.messages) == 2
+    assert sink.connections == 1
+
+
+def test_limits_connections(sink):
+    pool = SMTPPool('localhost', sink.server_address[1], size=2)
+
+    threads = [threading.Thread(target=pool.send, args=(make_messages(10),)) for _ in range(6)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    pool.close()
+
+    assert len(sink.messages) == 60
+    assert sink.connections <= 2
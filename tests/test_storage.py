@@ -1,7 +1,12 @@
 """Test storage package."""
 import json
+from datetime import datetime
+
+from leopard_lavatory.readers.case import Case
+from sqlalchemy import create_engine, inspect, text
 
 from leopard_lavatory.storage.database import *
+from leopard_lavatory.storage.upgrade import upgrade
 
 
 class TestDatabase:
@@ -93,3 +98,96 @@ class TestDatabase:
 
             # no other cleanup required
             dbs.delete(watchjob)
+
+    def test_gazetteer_crawl_state(self):
+        with database_session() as dbs:
+            add_gazetteer_prefixes(dbs, ['A', 'B'])
+            assert sorted(get_pending_gazetteer_prefixes(dbs)) == ['A', 'B']
+
+            add_gazetteer_result(dbs, 'A', 1, {'Arvfurstens palats 1': {'RESULT': 'Arvfurstens palats 1'}}, {},
+                                 [])
+            add_gazetteer_result(dbs, 'B', 3, {'Brunnsgatan 1': {}}, {'Bälgen 8': {}}, ['Ba', 'Bä'])
+            # the same entry from another prefix is not added twice
+            add_gazetteer_result(dbs, 'Bä', 1, {}, {'Bälgen 8': {}}, [])
+
+            # an interrupted crawl continues with the longer prefixes of the split one
+            assert get_pending_gazetteer_prefixes(dbs) == ['Ba']
+            assert sorted(get_gazetteer_names(dbs)) == ['Arvfurstens palats 1', 'Brunnsgatan 1', 'Bälgen 8']
+            assert get_gazetteer_names(dbs, 'property') == ['Bälgen 8']
+
+            add_gazetteer_result(dbs, 'Ba', 1, {}, {}, [])
+            assert get_pending_gazetteer_prefixes(dbs) == []
+
+            # a new crawl starts with all prefixes pending, the entries are kept
+            start_gazetteer_crawl(dbs, ['A', 'B'])
+            assert sorted(get_pending_gazetteer_prefixes(dbs)) == ['A', 'B']
+            add_gazetteer_result(dbs, 'B', 3, {}, {}, ['Ba', 'Bä'])
+            assert sorted(get_pending_gazetteer_prefixes(dbs)) == ['A', 'Ba', 'Bä']
+            assert len(get_gazetteer_names(dbs)) == 3
+
+            # clean up database
+            dbs.query(GazetteerEntry).delete()
+            dbs.query(GazetteerPrefix).delete()
+
+    def test_upsert_cases(self):
+        cases = [Case(id='2018-00002', fastighet='BÄLGEN 8', type='Bygglov', description='Fasad',
+                      date='2018-06-02'),
+                 Case(id='2018-00001', fastighet='BÄLGEN 8', type='Marklov', description='Träd',
+                      date='2018-06-01')]
+        with database_session() as dbs:
+            user, watchjob = add_user_watchjob(dbs, 'cases@example.com', {'street': 'Bälgen 8'})
+            dbs.flush()
+            start = datetime.now()
+
+            assert upsert_cases(dbs, cases) == ['2018-00002', '2018-00001']
+            # cases are only stored once, and updated
+            assert upsert_cases(dbs, [cases[1]._replace(description='Fällning av träd')]) == \
+                ['2018-00001']
+            assert dbs.query(StoredCase).filter(StoredCase.case_id.in_(['2018-00001', '2018-00002'])). \
+                count() == 2
+
+            stored = get_cases(dbs, ['2018-00001', '2018-00002', '2018-00003'])
+            assert [(case.case_id, case.description) for case in stored] == \
+                [('2018-00001', 'Fällning av träd'), ('2018-00002', 'Fasad')]
+
+            # cases are only related once to a watchjob
+            assert add_watchjob_cases(dbs, watchjob.id, ['2018-00001']) == ['2018-00001']
+            assert add_watchjob_cases(dbs, watchjob.id, ['2018-00002', '2018-00001']) == \
+                ['2018-00002']
+            assert [case.case_id for case in get_watchjob_cases_since(dbs, watchjob.id, start)] == \
+                ['2018-00002', '2018-00001']
+            assert get_watchjob_cases_since(dbs, watchjob.id, datetime.now()) == []
+
+            # clean up database
+            dbs.delete(user)
+            dbs.delete(watchjob)
+            dbs.flush()
+            dbs.query(StoredCase).filter(StoredCase.case_id.in_(['2018-00001', '2018-00002'])). \
+                delete(synchronize_session=False)
+
+    def test_upgrade(self, tmp_path):
+        engine = create_engine('sqlite:///{}'.format(tmp_path / 'old.sqlite'))
+        with engine.begin() as connection:
+            # the schema before the upgrades
+            connection.execute(text('CREATE TABLE user (id INTEGER PRIMARY KEY, created_at DATETIME, '
+                                    'modified_at DATETIME, email VARCHAR(255), delete_token VARCHAR(255))'))
+            connection.execute(text('CREATE TABLE watchjob (id INTEGER PRIMARY KEY, created_at DATETIME, '
+                                    'modified_at DATETIME, query VARCHAR(255), last_case_id INTEGER)'))
+            connection.execute(text("INSERT INTO watchjob (id, query, last_case_id) VALUES "
+                                    "(1, '{}', 0), (2, '{}', '2018-00001')"))
+
+        assert sorted(upgrade(engine)) == ['user.last_digest_at', 'watchjob.fastigheter', 'watchjob.lease_id',
+                                           'watchjob.lease_until', 'watchjob.next_run_at',
+                                           'watchjob.poll_interval']
+        assert upgrade(engine) == []
+        assert 'crawlcheckpoint' in inspect(engine).get_table_names()
+
+        dbs = Session(bind=engine)
+        try:
+            watchjobs = dbs.query(Watchjob).order_by(Watchjob.id).all()
+            assert [watchjob.last_case_id for watchjob in watchjobs] == [None, '2018-00001']
+            assert [watchjob.poll_interval for watchjob in watchjobs] == [3600, 3600]
+            assert [watchjob.fastigheter for watchjob in watchjobs] == ['[]', '[]']
+        finally:
+            dbs.close()
+        engine.dispose()
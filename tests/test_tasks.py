@@ -0,0 +1,374 @@
+"""Testing the dispatch of the celery tasks."""
+
+import smtplib
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+
+import pytest
+import requests
+
+from leopard_lavatory.celery import tasks
+from leopard_lavatory.celery.local_executor import LocalExecutor
+from leopard_lavatory.readers.case import Case
+from leopard_lavatory.readers.upstream_health import UpstreamUnavailable
+from leopard_lavatory.storage.database import StoredCase, Sweep, User, Watchjob, add_user_watchjob, add_watchjob_cases, \
+    database_session, upsert_cases, watchjob_case
+
+
+class FakeCheckWatchjob:
+    """Records the batches dispatched with check_watchjob.chunks instead of sending them."""
+
+    def __init__(self):
+        self.batches = []
+
+    def chunks(self, batch, size):
+        self.batches.append((list(batch), size))
+        return self
+
+    def apply_async(self):
+        pass
+
+
+class FakeConnection:
+    """Records the messages sent over a connection instead of sending them."""
+
+    def __init__(self, refused=()):
+        self.messages = []
+        # recipients the server refuses
+        self.refused = set(refused)
+
+    def __call__(self):
+        return self
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        pass
+
+    def send(self, message):
+        if message['To'] in self.refused:
+            raise smtplib.SMTPRecipientsRefused({message['To']: (550, b'No such user')})
+        self.messages.append(message)
+
+
+class FakeLocalCheckWatchjob:
+    """Finds one case per watchjob, after rescheduling the first watchjob once."""
+
+    name = 'leopard_lavatory.celery.tasks.check_watchjob'
+
+    def __init__(self):
+        self.checked = []
+
+    def __call__(self, watchjob_id, query_json, last_case_id, lease_id, deadline):
+        if not self.checked:
+            tasks.dispatch(self, [watchjob_id, query_json, last_case_id, lease_id, None], 0.1)
+        self.checked.append(watchjob_id)
+        return 1
+
+
+def test_run_all_watchjobs_in_batches(monkeypatch):
+    with database_session() as dbs:
+        for number in range(7):
+            add_user_watchjob(dbs, f'batch{number}@example.com', {'street': f'Batchgatan {number}'})
+
+    fake_check_watchjob = FakeCheckWatchjob()
+    monkeypatch.setattr(tasks, 'check_watchjob', fake_check_watchjob)
+    monkeypatch.setattr(tasks, 'DISPATCH_BATCH_SIZE', 3)
+    monkeypatch.setattr(tasks, 'SWEEP_MODE', False)
+    monkeypatch.setattr(tasks, 'upstream_open_for', lambda: 0)
+
+    tasks.run_all_watchjobs()
+
+    # one message per batch of 3 watchjobs
+    assert [size for batch, size in fake_check_watchjob.batches] == [3, 3, 1]
+    watchjob_ids = [watchjob_id for batch, size in fake_check_watchjob.batches
+                    for watchjob_id, query, last_case_id, lease_id, deadline in batch]
+    assert watchjob_ids == sorted(watchjob_ids)
+
+    # clean up database
+    with database_session() as dbs:
+        for watchjob in dbs.query(Watchjob).filter(Watchjob.id.in_(watchjob_ids)):
+            for user in watchjob.users:
+                dbs.delete(user)
+            dbs.delete(watchjob)
+
+
+def test_run_due_watchjobs(monkeypatch):
+    with database_session() as dbs:
+        watchjobs = [add_user_watchjob(dbs, f'due{number}@example.com',
+                                       {'street': f'Duegatan {number}'})[1] for number in range(4)]
+        dbs.flush()
+        watchjobs[0].next_run_at = datetime.now() + timedelta(minutes=10)
+        watchjobs[1].next_run_at = datetime.now() - timedelta(minutes=1)
+        watchjob_ids = [watchjob.id for watchjob in watchjobs]
+
+    check_watchjob = tasks.check_watchjob
+    fake_check_watchjob = FakeCheckWatchjob()
+    monkeypatch.setattr(tasks, 'check_watchjob', fake_check_watchjob)
+    monkeypatch.setattr(tasks, 'DISPATCH_BATCH_SIZE', 2)
+
+    # nothing is dispatched while the circuit of insynsbk is open
+    monkeypatch.setattr(tasks, 'upstream_open_for', lambda: 30.0)
+    assert tasks.run_due_watchjobs() == 0
+    assert fake_check_watchjob.batches == []
+    monkeypatch.setattr(tasks, 'upstream_open_for', lambda: 0)
+
+    # new watchjobs (never run) first, then the longest overdue
+    assert tasks.run_due_watchjobs() == 3
+    assert [watchjob_id for batch, size in fake_check_watchjob.batches
+            for watchjob_id, query, last_case_id, lease_id, deadline in batch] == \
+        [watchjob_ids[2], watchjob_ids[3], watchjob_ids[1]]
+    lease_id, deadline = fake_check_watchjob.batches[0][0][0][3:]
+
+    # the dispatched watchjobs are scheduled for their next run
+    assert tasks.run_due_watchjobs() == 0
+
+    # a due watchjob is not dispatched again while its check is in flight
+    with database_session() as dbs:
+        dbs.get(Watchjob, watchjob_ids[2]).next_run_at = datetime.now() - timedelta(minutes=1)
+    assert tasks.run_due_watchjobs() == 0
+
+    # a check that starts after the deadline of its cycle is skipped, and the watchjob is
+    #  dispatched first by the next cycle
+    assert check_watchjob(watchjob_ids[3], '{"street": "Duegatan 3"}', None, lease_id,
+                          time.time() - 1) == 0
+    with database_session() as dbs:
+        watchjob = dbs.get(Watchjob, watchjob_ids[3])
+        assert (watchjob.next_run_at, watchjob.lease_until) == (None, None)
+    assert tasks.run_due_watchjobs() == 1
+    assert fake_check_watchjob.batches[-1][0][0][0] == watchjob_ids[3]
+
+    # clean up database
+    with database_session() as dbs:
+        for watchjob in dbs.query(Watchjob).filter(Watchjob.id.in_(watchjob_ids)):
+            for user in watchjob.users:
+                dbs.delete(user)
+            dbs.delete(watchjob)
+
+
+def test_local_executor(monkeypatch):
+    with database_session() as dbs:
+        for number in range(5):
+            add_user_watchjob(dbs, f'local{number}@example.com', {'street': f'Lokalgatan {number}'})
+        watchjob_ids = [watchjob.id for watchjob in
+                        dbs.query(Watchjob).filter(Watchjob.query.like('%Lokalgatan%'))]
+
+    fake_check_watchjob = FakeLocalCheckWatchjob()
+    monkeypatch.setattr(tasks, 'check_watchjob', fake_check_watchjob)
+    monkeypatch.setattr(tasks, 'EXECUTION_MODE', 'thread')
+    monkeypatch.setattr(tasks, 'DISPATCH_BATCH_SIZE', 2)
+    monkeypatch.setattr(tasks, 'SWEEP_MODE', False)
+    monkeypatch.setattr(tasks, 'upstream_open_for', lambda: 0)
+
+    executor = LocalExecutor(workers=3)
+    cycle = executor.run_cycle('run_all_watchjobs')
+    executor.shutdown()
+
+    # the checks dispatched by run_all_watchjobs and the rescheduled one are part of its cycle
+    assert set(watchjob_ids) <= set(fake_check_watchjob.checked)
+    assert len(fake_check_watchjob.checked) == len(set(fake_check_watchjob.checked)) + 1
+    assert cycle.tasks['run_all_watchjobs'] == 1
+    assert cycle.tasks['check_watchjob'] == len(fake_check_watchjob.checked)
+    assert cycle.new_cases == len(fake_check_watchjob.checked)
+    assert cycle.failures == 0
+    assert cycle.watchjobs_per_minute > 0
+
+    # clean up database
+    with database_session() as dbs:
+        for watchjob in dbs.query(Watchjob).filter(Watchjob.id.in_(watchjob_ids)):
+            for user in watchjob.users:
+                dbs.delete(user)
+            dbs.delete(watchjob)
+
+
+class FailingReaderPool:
+    """Checks out a reader whose every crawl fails with the given error."""
+
+    def __init__(self, error):
+        self.error = error
+        self.crawls = []
+
+    @contextmanager
+    def checkout(self):
+        yield self
+
+    def iter_pages(self, address, newer_than_case, newer_than_date, resume_state):
+        self.crawls.append(address)
+        raise self.error
+
+
+@pytest.mark.parametrize('error', [requests.ConnectionError('connection refused'),
+                                   UpstreamUnavailable('insynsbk.stockholm.se', 0.0, 'open')])
+def test_local_executor_gives_up_failing_checks(monkeypatch, error):
+    with database_session() as dbs:
+        watchjob = add_user_watchjob(dbs, 'failing@example.com', {'street': 'Felgatan 1'})[1]
+        dbs.flush()
+        watchjob_id = watchjob.id
+
+    reader_pool = FailingReaderPool(error)
+    monkeypatch.setattr(tasks, 'get_reader_pool', lambda: reader_pool)
+    monkeypatch.setattr(tasks, 'EXECUTION_MODE', 'thread')
+    monkeypatch.setattr(tasks, 'SWEEP_MODE', False)
+    monkeypatch.setattr(tasks, 'upstream_open_for', lambda: 0)
+    monkeypatch.setattr(tasks, 'CRAWL_RETRY_SECONDS', 0.01)
+    monkeypatch.setattr(tasks, 'CRAWL_MAX_RETRIES', 2)
+
+    executor = LocalExecutor(workers=2)
+    cycles = []
+    thread = threading.Thread(target=lambda: cycles.append(executor.run_cycle('run_all_watchjobs')),
+                              daemon=True)
+    thread.start()
+    thread.join(timeout=30)
+    assert not thread.is_alive(), 'the failing check is retried forever'
+    executor.shutdown()
+
+    # the first attempt and two retries with backoff, then the lease is released
+    assert reader_pool.crawls.count('Felgatan 1') == 3
+    assert cycles[0].failures == 0
+    with database_session() as dbs:
+        assert dbs.get(Watchjob, watchjob_id).lease_until is None
+
+    # clean up database
+    with database_session() as dbs:
+        watchjob = dbs.get(Watchjob, watchjob_id)
+        for user in watchjob.users:
+            dbs.delete(user)
+        dbs.delete(watchjob)
+
+
+class RecentCasesReaderPool:
+    """Checks out a reader that records the sweeps and finds no cases."""
+
+    def __init__(self):
+        self.sweeps = []
+
+    @contextmanager
+    def checkout(self):
+        yield self
+
+    def get_recent_cases(self, newer_than_case=None, newer_than_date=None):
+        self.sweeps.append((newer_than_case, newer_than_date))
+        return []
+
+
+def test_first_sweep_reads_first_page(monkeypatch):
+    with database_session() as dbs:
+        dbs.query(Sweep).delete()
+
+    reader_pool = RecentCasesReaderPool()
+    monkeypatch.setattr(tasks, 'get_reader_pool', lambda: reader_pool)
+    monkeypatch.setattr(tasks, 'dispatch', lambda task, args=(), countdown=None: None)
+
+    tasks.sweep_watchjobs()
+
+    # neither a last case nor a date watermark: only the first page of the whole city
+    assert reader_pool.sweeps == [(None, None)]
+
+    # clean up database
+    with database_session() as dbs:
+        dbs.query(Sweep).delete()
+
+
+def test_send_digests(monkeypatch):
+    with database_session() as dbs:
+        user_a, watchjob_1 = add_user_watchjob(dbs, 'digest_a@example.com', {'street': 'Digestgatan 1'})
+        watchjob_2 = add_user_watchjob(dbs, 'digest_a@example.com', {'street': 'Digestgatan 2'})[1]
+        user_b = add_user_watchjob(dbs, 'digest_b@example.com', {'street': 'Digestgatan 1'})[0]
+        dbs.flush()
+        watchjob_ids = [watchjob_1.id, watchjob_2.id]
+        add_watchjob_cases(dbs, watchjob_1.id, upsert_cases(dbs, [
+            Case('2020-91002', 'DIGEST 1', 'Bygglov', 'Nybyggnad', '2020-02-01'),
+            Case('2020-91001', 'DIGEST 1', 'Marklov', 'Trädfällning', '2020-01-01')]))
+        add_watchjob_cases(dbs, watchjob_2.id, upsert_cases(dbs, [
+            Case('2020-91003', 'DIGEST 2', 'Rivningslov', 'Rivning av förråd', '2020-03-01')]))
+        delete_tokens = {user_a.email: user_a.delete_token, user_b.email: user_b.delete_token}
+
+    fake_connection = FakeConnection()
+    monkeypatch.setattr(tasks, 'smtp_connection', fake_connection)
+    monkeypatch.delenv('FLASK_MAIL_RECIPIENT', raising=False)
+    monkeypatch.setattr(tasks, 'DIGEST_SETTLE_SECONDS', 0)
+    rendered = []
+    render_case_fragments = tasks.create_case_fragments
+
+    def create_case_fragments(address, cases):
+        rendered.append(address)
+        return render_case_fragments(address, cases)
+
+    monkeypatch.setattr(tasks, 'create_case_fragments', create_case_fragments)
+
+    tasks.send_digests()
+
+    # one message per user, the cases of a watchjob are rendered once for all of its users
+    messages = {message['To']: message for message in fake_connection.messages
+                if message['To'] in delete_tokens}
+    bodies = {email: message.get_body(('plain',)).get_content() for email, message in messages.items()}
+    assert sorted(messages) == ['digest_a@example.com', 'digest_b@example.com']
+    assert rendered.count('Digestgatan 1') == 1
+    assert '2020-91001' in bodies['digest_a@example.com']
+    assert '2020-91003' in messages['digest_a@example.com'].get_body(('html',)).get_content()
+    assert '2020-91003' not in bodies['digest_b@example.com']
+    for email, body in bodies.items():
+        assert delete_tokens[email] in body
+
+    # the next digest only has the cases found since
+    fake_connection.messages.clear()
+    tasks.send_digests()
+    assert not [message for message in fake_connection.messages if message['To'] in delete_tokens]
+
+    # a case found just now may not be committed by all checks yet, it is left to the next digest
+    with database_session() as dbs:
+        add_watchjob_cases(dbs, watchjob_ids[0], upsert_cases(dbs, [
+            Case('2020-91004', 'DIGEST 1', 'Bygglov', 'Tillbyggnad', '2020-04-01')]))
+    tasks.send_digests(settle_seconds=60)
+    assert not [message for message in fake_connection.messages if message['To'] in delete_tokens]
+    tasks.send_digests()
+    assert sorted(message['To'] for message in fake_connection.messages if message['To'] in delete_tokens) == \
+        ['digest_a@example.com', 'digest_b@example.com']
+
+    # clean up database
+    with database_session() as dbs:
+        dbs.execute(watchjob_case.delete().where(watchjob_case.c.watchjob_id.in_(watchjob_ids)))
+        dbs.query(StoredCase).filter(StoredCase.case_id.in_(['2020-91001', '2020-91002', '2020-91003',
+                                                             '2020-91004'])). \
+            delete(synchronize_session=False)
+        for watchjob in dbs.query(Watchjob).filter(Watchjob.id.in_(watchjob_ids)):
+            for user in watchjob.users:
+                dbs.delete(user)
+            dbs.delete(watchjob)
+
+
+def test_send_digests_refused_recipient(monkeypatch):
+    with database_session() as dbs:
+        refused, watchjob = add_user_watchjob(dbs, 'refused@example.com', {'street': 'Refusgatan 1'})
+        accepted = add_user_watchjob(dbs, 'accepted@example.com', {'street': 'Refusgatan 1'})[0]
+        dbs.flush()
+        user_ids = [refused.id, accepted.id]
+        watchjob_id = watchjob.id
+        add_watchjob_cases(dbs, watchjob_id, upsert_cases(dbs, [
+            Case('2020-92001', 'REFUS 1', 'Bygglov', 'Nybyggnad', '2020-02-01')]))
+
+    fake_connection = FakeConnection(refused=['refused@example.com'])
+    monkeypatch.setattr(tasks, 'smtp_connection', fake_connection)
+    monkeypatch.delenv('FLASK_MAIL_RECIPIENT', raising=False)
+
+    tasks.send_digests(settle_seconds=0)
+
+    # the refused recipient (the first user) doesn't keep the others from their digests, and gets
+    #  the cases with the next digest
+    assert 'accepted@example.com' in [message['To'] for message in fake_connection.messages]
+    with database_session() as dbs:
+        refused, accepted = [dbs.get(User, user_id) for user_id in user_ids]
+        assert refused.last_digest_at is None
+        assert accepted.last_digest_at is not None
+
+    # clean up database
+    with database_session() as dbs:
+        dbs.execute(watchjob_case.delete().where(watchjob_case.c.watchjob_id == watchjob_id))
+        dbs.query(StoredCase).filter(StoredCase.case_id == '2020-92001').delete(synchronize_session=False)
+        watchjob = dbs.get(Watchjob, watchjob_id)
+        for user in watchjob.users:
+            dbs.delete(user)
+        dbs.delete(watchjob)
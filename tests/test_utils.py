@@ -1,6 +1,7 @@
 """Testing the utils package."""
 
-from leopard_lavatory.utils import create_token, valid_email, valid_address, log_safe
+from leopard_lavatory.utils import create_token, valid_email, valid_address, log_safe, \
+    normalize_address
 
 
 class TestUtils:
@@ -33,6 +34,11 @@ class TestUtils:
         assert not valid_address('illegal character "')
         assert not valid_address("illegal character '")
 
+    def test_normalize_address(self):
+        assert normalize_address('Brunnsgatan 1') == 'brunnsgatan 1'
+        assert normalize_address(' brunnsgatan  1 ') == 'brunnsgatan 1'
+        assert normalize_address('BÄLGEN 8') == normalize_address('Bälgen 8')
+
     def test_log_safe(self):
         assert len(log_safe('a' * 400)) <= 303, 'long inputs must be cut short'
         assert log_safe('a' * 400).endswith('...'), 'cut inputs must end in ...'
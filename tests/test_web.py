@@ -56,3 +56,47 @@ def test_delete_get_without_token(client):
 
 
 # TODO how to test with existing data, ie deleting an account?
+
+
+def test_suggest(client):
+    from leopard_lavatory.storage.database import GazetteerEntry, GazetteerPrefix, \
+        add_gazetteer_result, database_session
+    from leopard_lavatory.web.main import reset_address_index
+
+    with database_session() as dbs:
+        add_gazetteer_result(dbs, 'B', 2, {'Brunnsgatan 1': {}}, {'Bälgen 8': {}}, [])
+    reset_address_index()
+
+    rv = client.get('/suggest', query_string=dict(q='bä'))
+    assert rv.get_json() == {'suggestions': [{'name': 'Bälgen 8', 'kind': 'property'}]}
+    assert client.get('/suggest', query_string=dict(q='')).get_json() == {'suggestions': []}
+
+    # with a gazetteer, unknown addresses are rejected
+    rv = client.post('/', data=dict(
+        email='test@example.com',
+        address='Okändgatan 1'
+    ), follow_redirects=True)
+    assert 'Hittade ingen'.encode() in rv.data
+    assert b'Aktivera' not in rv.data
+
+    # clean up database
+    with database_session() as dbs:
+        dbs.query(GazetteerEntry).delete()
+        dbs.query(GazetteerPrefix).delete()
+    reset_address_index()
+
+
+def test_metrics(client, monkeypatch):
+    from leopard_lavatory.web import main
+
+    # disabled without a token
+    assert client.get('/metrics').status_code == 404
+
+    monkeypatch.setattr(main, 'METRICS_TOKEN', 'metricstoken')
+    rv = client.get('/metrics', headers={'Authorization': 'Bearer metricstoken'})
+    assert rv.status_code == 200
+    assert b'leopard_task_seconds' in rv.data
+
+    # only for clients with the token, also local ones (eg behind a reverse proxy)
+    assert client.get('/metrics').status_code == 404
+    assert client.get('/metrics', headers={'Authorization': 'Bearer wrong'}).status_code == 404